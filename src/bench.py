@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+This file is part of CatPuppetBridge.
+
+CatPuppetBridge is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+CatPuppetBridge is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+CatPuppetBridge. If not, see <https://www.gnu.org/licenses/>.
+
+Copyright (C) 2025 Lisa Marie Maginnis
+
+Offline benchmarks for CatPuppetBridge, needs no Discord account or IRC network
+"""
+
+import argparse
+import logging
+import sys
+
+from benchmarks import load, members, micro, replay, soak
+
+BENCHMARKS = {
+    'load': load,
+    'members': members,
+    'micro': micro,
+    'replay': replay,
+    'soak': soak,
+}
+
+def main():
+    """ Parse arguments and run a benchmark """
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[-1])
+    parser.add_argument('--log-level', default='WARNING', help='bridge log level')
+    commands = parser.add_subparsers(dest='benchmark', required=True)
+    for name, module in BENCHMARKS.items():
+        summary = module.__doc__.strip().splitlines()[-1]
+        module.add_arguments(commands.add_parser(name, help=summary))
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(threadName)s %(message)s',
+                        level=args.log_level.upper())
+    sys.exit(BENCHMARKS[args.benchmark].run(args))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,421 @@
+"""
+This file is part of CatPuppetBridge.
+
+CatPuppetBridge is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+CatPuppetBridge is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+CatPuppetBridge. If not, see <https://www.gnu.org/licenses/>.
+
+Copyright (C) 2025 Lisa Marie Maginnis
+
+Run the bridge offline against a local irc.server and an in-memory Discord guild
+"""
+
+import asyncio
+import configparser
+import json
+import logging
+import subprocess
+import sys
+import threading
+import time
+
+import discord
+import psutil
+
+import main
+from modules.bridge_queue import AsyncBridgeQueue
+from modules.discord_bridge import DiscordBot
+from modules.registry import registry
+from modules.stats_data import StatsData, histogram_percentile
+from modules.thread_stats import ThreadAccounting
+
+PUPPET_SUFFIX = '_d2'
+
+class IRCServerProcess():
+    """ python -m irc.server in a child process, so its CPU isn't counted as the bridge's """
+
+    def __init__(self, port: int):
+        self.port = port
+        self.process = None
+
+    def start(self):
+        """ Start the server and wait until it is listening """
+        # pylint: disable=consider-using-with
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'irc.server', '-a', '127.0.0.1', '-p', str(self.port)],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        for line in self.process.stdout:
+            if 'Listening on' in line:
+                break
+        # Keep draining output so the server never blocks on a full pipe
+        threading.Thread(target=self.process.stdout.read, name='bench-irc-server-output',
+                         daemon=True).start()
+
+    def stop(self):
+        """ Stop the server """
+        if self.process:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+# pylint: disable=too-few-public-methods,too-many-instance-attributes
+class FakeMember():
+    """ The parts of discord.Member the bridge reads """
+
+    def __init__(self, member_id: int, name: str, display_name: str = None):
+        self.id = member_id
+        self.name = name
+        self.display_name = display_name or name
+        self.global_name = self.display_name
+        self.status = discord.Status.online
+        self.avatar = None
+        self.bot = False
+        self.roles = []
+        self.mention = f'<@{member_id}>'
+        self.dms = []
+
+    async def send(self, content):
+        """ Record a direct message """
+        self.dms.append((time.monotonic(), content))
+
+    def __repr__(self):
+        return f'<FakeMember {self.id} {self.display_name}>'
+
+class FakeWebhook():
+    """ Webhook recording what the bridge sends, instead of posting it """
+
+    name = 'CatPuppetBridge'
+
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, content, username=None, avatar_url=None):
+        """ Record a sent message """
+        self.sent.append((time.monotonic(), username, content, avatar_url))
+
+class FakeChannel():
+    """ Guild text channel with a single bridge webhook """
+
+    def __init__(self, channel_id: int, name: str):
+        self.id = channel_id
+        self.name = name
+        self.webhook = FakeWebhook()
+
+    async def webhooks(self):
+        """ List webhooks on the channel """
+        return [self.webhook]
+
+    async def create_webhook(self, name=None):  # pylint: disable=unused-argument
+        """ Create the bridge webhook """
+        return self.webhook
+
+    def __str__(self):
+        return self.name
+
+class FakeMessage():
+    """ The parts of discord.Message the bridge reads """
+
+    def __init__(self, author: FakeMember, channel: FakeChannel, content: str, message_id: int):
+        self.id = message_id
+        self.author = author
+        self.channel = channel
+        self.content = content
+        self.attachments = []
+        self.embeds = []
+        self.reference = None
+        self.webhook_id = None
+
+class FakeGuild():
+    """ In-memory guild with fast member lookups """
+
+    def __init__(self):
+        self.members = []
+        self.by_id = {}
+
+    def add_member(self, member: FakeMember):
+        """ Add or replace a member """
+        if member.id in self.by_id:
+            self.members.remove(self.by_id[member.id])
+        self.members.append(member)
+        self.by_id[member.id] = member
+
+    def remove_member(self, member_id: int):
+        """ Remove a member """
+        member = self.by_id.pop(member_id, None)
+        if member is not None:
+            self.members.remove(member)
+
+    def get_member(self, member_id: int):
+        """ Look up a cached member """
+        return self.by_id.get(member_id)
+
+    async def fetch_member(self, member_id: int):
+        """ Look up a member, as the API would """
+        return self.by_id.get(member_id)
+
+class BenchDiscordBot(DiscordBot):
+    """ DiscordBot reading an in-memory guild, and posting to fake webhooks """
+    bench_guild = None
+    bench_user = None
+    bench_emojis = ()
+
+    def __init__(self, queues, irc_to_discord_links, discord_config, data, guild):
+        # pylint: disable=too-many-arguments,too-many-positional-arguments
+        super().__init__(queues, irc_to_discord_links, discord_config, data)
+        self.bench_guild = guild
+        self.bench_user = FakeMember(1, 'CatPuppetBridge')
+        self.bench_user.bot = True
+
+    @property
+    def guilds(self):
+        return [self.bench_guild]
+
+    @property
+    def user(self):
+        return self.bench_user
+
+    @property
+    def emojis(self):
+        return list(self.bench_emojis)
+
+    def get_user(self, user_id, /):
+        return self.bench_guild.get_member(user_id)
+
+    async def fetch_user(self, user_id, /):
+        return self.bench_guild.get_member(user_id)
+
+    async def accessible_channels(self, user_id: int, member=None):
+        # Fake channels aren't GuildChannels, every member sees every channel
+        return [channel.id for channel in self.discord_channel_mapping.values()]
+
+class BenchBridge():
+    """
+    The bridge as main() runs it, minus the admin bot: listener and puppet
+    dispatcher threads against a local IRC server, and DiscordBot on an
+    asyncio loop thread with a fake guild.
+    """
+
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    def __init__(self, port: int, channels: int = 2, flood_rate: float = 0,
+                 coalesce_window: float = 0, queue_config=None, dry_run: bool = False):
+        self.stats = StatsData()
+        self.stats.update('uptime', time.time())
+        self.guild = FakeGuild()
+        self.channels = [FakeChannel(1000 + index, f'#bench{index}') for index in range(channels)]
+        self.discord_to_irc_links = {str(channel.id): channel.name for channel in self.channels}
+        self.irc_to_discord_links = {channel.name: str(channel.id) for channel in self.channels}
+        self.irc_config = {
+            'puppet_suffix': PUPPET_SUFFIX, 'tls': 'no', 'server': '127.0.0.1', 'port': port,
+            'channels': [channel.name for channel in self.channels],
+            'bot_channel': '#bots', 'bot_nickname': 'bridge', 'listener_nickname': 'listener',
+            'webirc_password': 'bench', 'flood_burst': 10, 'flood_rate': flood_rate,
+            'relay_membership': False, 'membership_window': 5, 'dry_run': dry_run}
+        self.discord_config = {
+            'puppet_suffix': PUPPET_SUFFIX, 'puppet_min_size': 3, 'log_level': logging.WARNING,
+            'mode': 'discord', 'api': '', 'gateway': '', 'presence_debounce': 30,
+            'membership_window': 2, 'coalesce_window': coalesce_window,
+            'coalesce_max_delay': 1.5, 'dry_run': dry_run}
+        if queue_config is None:
+            queue_config = main.read_queue_config(configparser.ConfigParser(), 'bench')
+        self.configs = {'queue_config': queue_config,
+                        'irc_config': {'PuppetSuffix': PUPPET_SUFFIX},
+                        'discord_to_irc_links': self.discord_to_irc_links}
+        self.queues = {
+            'irc_to_discord_queue': main.make_queue(queue_config, 'irc_to_discord_queue',
+                                                    self.stats, AsyncBridgeQueue),
+            'puppet_queue': main.make_queue(queue_config, 'puppet_queue', self.stats),
+            'dm_out_queue': main.make_queue(queue_config, 'dm_out_queue', self.stats,
+                                            AsyncBridgeQueue)}
+        self.puppet_queues = {}
+        main.register_queue_gauges(self.stats, self.queues, self.puppet_queues)
+        self.bot = None
+        self.loop = None
+
+    def start(self):
+        """ Start every bridge thread, returns once Discord's side is running """
+        threading.Thread(target=main.run_irclistener,
+                         args=[self.queues['irc_to_discord_queue'], self.irc_config, self.stats],
+                         name='listener', daemon=True).start()
+        threading.Thread(target=main.run_puppet_dispatcher,
+                         args=[self.configs, self.irc_config, self.queues, self.puppet_queues,
+                               self.stats],
+                         name='dispatcher', daemon=True).start()
+        started = threading.Event()
+        threading.Thread(target=self.run_discord, args=[started], name='discord-loop',
+                         daemon=True).start()
+        started.wait()
+        wait_for(lambda: any(name == 'listener' and bot.connection.is_connected()
+                             for name, bot in registry.items('connections')), 10)
+
+    def run_discord(self, started):
+        """ Run DiscordBot's queue workers on this thread's event loop """
+        async def run():
+            self.loop = asyncio.get_running_loop()
+            self.bot = BenchDiscordBot(self.queues, self.irc_to_discord_links,
+                                       self.discord_config, self.stats, self.guild)
+            self.bot.loop = self.loop
+            self.bot.discord_channel_mapping = {channel.name: channel
+                                                for channel in self.channels}
+            self.bot.lag_task = True
+            self.bot.ready = True
+            self.loop.create_task(self.bot.process_queue())
+            self.loop.create_task(self.bot.process_dm_queue())
+            started.set()
+            await asyncio.Event().wait()
+        asyncio.run(run())
+
+    def call(self, coroutine):
+        """ Run a DiscordBot coroutine on its loop from another thread """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def add_members(self, count: int, first_id: int = 10000) -> list:
+        """ Add members to the guild """
+        members = [FakeMember(first_id + index, f'member{index}') for index in range(count)]
+        for member in members:
+            self.guild.add_member(member)
+        return members
+
+    def send_discord_message(self, member, channel, content, message_id):
+        """ Deliver a message from a member to the bridge """
+        return self.call(self.bot.on_message(FakeMessage(member, channel, content, message_id)))
+
+    def ready_puppets(self) -> int:
+        """ Number of puppets connected and ready """
+        return sum(1 for _, puppet in registry.items('puppets') if puppet.ready)
+
+    def delivered(self) -> int:
+        """ Messages posted to every fake webhook """
+        return sum(len(channel.webhook.sent) for channel in self.channels)
+
+class IRCTalkers():
+    """ Plain IRC users in every bench channel, talking at a fixed total rate """
+
+    def __init__(self, port: int, count: int, channels: list):
+        self.port = port
+        self.count = count
+        self.channels = channels
+        self.reactor = None
+        self.connections = []
+        self.joined = 0
+
+    def connect(self):
+        """ Connect every talker and wait until they have all joined """
+        import irc.client  # pylint: disable=import-outside-toplevel
+        self.reactor = irc.client.Reactor()
+        self.reactor.add_global_handler('welcome', lambda c, e: c.join(','.join(self.channels)))
+        self.reactor.add_global_handler('join', self.on_join)
+        for index in range(self.count):
+            self.connections.append(self.reactor.server().connect('127.0.0.1', self.port,
+                                                                  f'talker{index}'))
+        wait_for(lambda: self.reactor.process_once(0.05) or
+                 self.joined >= self.count * len(self.channels), 10)
+
+    def on_join(self, connection, event):
+        """ Count our own joins """
+        if event.source.nick == connection.get_nickname():
+            self.joined += 1
+
+    def talk(self, rate: float, duration: float) -> int:
+        """ Send lines round robin over talkers and channels, returns the number sent """
+        def send(sent):
+            connection = self.connections[sent % self.count]
+            channel = self.channels[sent % len(self.channels)]
+            connection.privmsg(channel, f"bench line {sent} from {connection.get_nickname()}")
+        return paced(rate, duration, send, lambda: self.reactor.process_once(0.005))
+
+def paced(rate: float, duration: float, send, idle=lambda: time.sleep(0.005)) -> int:
+    """ Call send(n) rate times a second for duration seconds, returns the number of calls """
+    sent = 0
+    started = time.monotonic()
+    while time.monotonic() - started < duration:
+        due = int((time.monotonic() - started) * rate)
+        while sent < due:
+            send(sent)
+            sent += 1
+        idle()
+    return sent
+
+def wait_for(predicate, timeout: float, interval: float = 0.05) -> bool:
+    """ Poll predicate until it is true or timeout seconds pass """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(interval)
+    return False
+
+def histogram_delta(after: dict, before: dict) -> dict:
+    """ Subtract two histogram snapshots """
+    delta = {}
+    for key, histogram in after.items():
+        previous = before.get(key, [0] * len(histogram))
+        delta[key] = [value - old for value, old in zip(histogram, previous)]
+    return delta
+
+def latency_summary(histogram) -> dict:
+    """ Count and p50/p95/p99 in milliseconds of a histogram """
+    if not histogram or not sum(histogram[:-1]):
+        return {'count': 0}
+    summary = {'count': sum(histogram[:-1])}
+    for percentile in (0.5, 0.95, 0.99):
+        summary[f'p{int(percentile * 100)}_ms'] = round(
+            histogram_percentile(histogram, percentile) * 1000, 2)
+    return summary
+
+class ResourceMeter():
+    """ CPU used by bridge threads (not bench-* threads) and RSS over a run """
+
+    def __init__(self):
+        self.accounting = ThreadAccounting()
+        self.before = {}
+        self.started = 0.0
+
+    def bridge_cpu(self) -> dict:
+        """ CPU seconds so far by thread group, bench threads excluded """
+        self.accounting.sample()
+        return {group: seconds for group, seconds in self.accounting.group_cpu.items()
+                if not group.startswith('bench') and group != 'MainThread'}
+
+    def start(self):
+        """ Start measuring """
+        self.before = self.bridge_cpu()
+        self.started = time.monotonic()
+
+    def stop(self) -> dict:
+        """ Stop measuring and summarise """
+        elapsed = time.monotonic() - self.started
+        after = self.bridge_cpu()
+        groups = {group: round(seconds - self.before.get(group, 0.0), 3)
+                  for group, seconds in after.items()}
+        cpu = sum(groups.values())
+        return {'cpu_seconds': round(cpu, 3),
+                'cpu_percent': round(cpu * 100 / elapsed, 1) if elapsed else 0.0,
+                'cpu_by_thread_group': {group: seconds for group, seconds in
+                                        sorted(groups.items(), key=lambda item: -item[1])
+                                        if seconds > 0},
+                'rss_mb': round(psutil.Process().memory_info().rss / 1024**2, 1),
+                'threads': threading.active_count()}
+
+def print_report(title: str, report: dict, json_path: str = None):
+    """ Print a report, and write it as JSON if asked to """
+    print(f"== {title} ==")
+    for key, value in report.items():
+        if isinstance(value, dict):
+            print(f"{key}:")
+            for name, item in value.items():
+                print(f"  {name}: {item}")
+        else:
+            print(f"{key}: {value}")
+    if json_path:
+        with open(json_path, 'w', encoding='utf8') as output:
+            json.dump(report, output, indent=2)
@@ -0,0 +1,113 @@
+"""
+This file is part of CatPuppetBridge.
+
+CatPuppetBridge is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+CatPuppetBridge is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+CatPuppetBridge. If not, see <https://www.gnu.org/licenses/>.
+
+Copyright (C) 2025 Lisa Marie Maginnis
+
+Throughput and latency of both relay directions under steady load
+"""
+
+import logging
+import threading
+import time
+
+from benchmarks.harness import (BenchBridge, IRCServerProcess, IRCTalkers, ResourceMeter,
+                                histogram_delta, latency_summary, paced, print_report, wait_for)
+
+def add_arguments(parser):
+    """ Options for the load benchmark """
+    parser.add_argument('--members', type=int, default=10,
+                        help='simulated Discord members talking, each gets a puppet')
+    parser.add_argument('--talkers', type=int, default=5, help='plain IRC users talking')
+    parser.add_argument('--channels', type=int, default=2, help='bridged channels')
+    parser.add_argument('--discord-rate', type=float, default=20,
+                        help='Discord messages per second, over all members')
+    parser.add_argument('--irc-rate', type=float, default=20,
+                        help='IRC lines per second, over all talkers')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to measure for')
+    parser.add_argument('--port', type=int, default=16667, help='port for the local irc.server')
+    parser.add_argument('--flood-rate', type=float, default=0,
+                        help="puppets' IRC flood_rate, 0 disables flood control")
+    parser.add_argument('--coalesce-window', type=float, default=0,
+                        help='coalesce_window for IRC to Discord messages')
+    parser.add_argument('--dry-run', action='store_true',
+                        help="run the bridge with dry_run, puppets don't connect")
+    parser.add_argument('--json', help='also write the report to this file')
+
+def drive_discord(bridge, members, rate, duration, first_id=1):
+    """ Send Discord messages round robin over members and channels, returns the number sent """
+    def send(sent):
+        bridge.send_discord_message(members[sent % len(members)],
+                                    bridge.channels[sent % len(bridge.channels)],
+                                    f"bench message {sent} :cat:", first_id + sent)
+    return paced(rate, duration, send)
+
+def warm_up(bridge, talkers, members):
+    """ Start every puppet and connect every talker before measuring """
+    for index, member in enumerate(members):
+        bridge.send_discord_message(member, bridge.channels[0], 'hello', index).result(10)
+    if not wait_for(lambda: bridge.ready_puppets() >= len(members), 10 + len(members) / 5):
+        raise RuntimeError(f"only {bridge.ready_puppets()} of {len(members)} puppets connected")
+    talkers.connect()
+    # Let the warmup messages drain
+    time.sleep(1)
+
+def summarise(args, sent: dict, latency: dict) -> dict:
+    """ Throughput and latency percentiles of each direction """
+    report = {'duration_s': args.duration, 'members': args.members,
+              'talkers': args.talkers, 'channels': args.channels}
+    for direction, source in (('discord_to_irc', 'discord'), ('irc_to_discord', 'irc')):
+        summary = latency_summary(latency.get(('delivery_latency', direction)))
+        summary['sent'] = sent[source]
+        summary['msgs_per_s'] = round(summary['count'] / args.duration, 1)
+        report[direction] = summary
+    return report
+
+def run(args):
+    """ Run the load benchmark and print its report """
+    server = IRCServerProcess(args.port)
+    server.start()
+    try:
+        bridge = BenchBridge(args.port, args.channels, args.flood_rate, args.coalesce_window,
+                             dry_run=args.dry_run)
+        bridge.start()
+        members = bridge.add_members(args.members)
+        talkers = IRCTalkers(args.port, args.talkers, [channel.name for channel in bridge.channels])
+        warm_up(bridge, talkers, members)
+
+        meter = ResourceMeter()
+        latency_before = bridge.stats.histogram_snapshot()
+        delivered_before = bridge.delivered()
+        meter.start()
+        result = {}
+        discord_thread = threading.Thread(
+            target=lambda: result.update(discord=drive_discord(
+                bridge, members, args.discord_rate, args.duration, len(members))),
+            name='bench-discord-driver')
+        discord_thread.start()
+        result['irc'] = talkers.talk(args.irc_rate, args.duration)
+        discord_thread.join()
+        # Give in flight messages a moment to arrive, but don't count it as load time
+        time.sleep(1)
+        resources = meter.stop()
+
+        report = summarise(args, result, histogram_delta(bridge.stats.histogram_snapshot(),
+                                                         latency_before))
+        report['webhook_posts'] = bridge.delivered() - delivered_before
+        report.update(resources)
+        print_report('load', report, args.json)
+    finally:
+        # Bridge threads are daemons, keep their reconnect warnings out of the report
+        logging.disable()
+        server.stop()
@@ -0,0 +1,116 @@
+"""
+This file is part of CatPuppetBridge.
+
+CatPuppetBridge is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+CatPuppetBridge is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+CatPuppetBridge. If not, see <https://www.gnu.org/licenses/>.
+
+Copyright (C) 2025 Lisa Marie Maginnis
+
+Memory per 1k guild members for each MemberCache policy
+"""
+
+import asyncio
+import gc
+import time
+import tracemalloc
+
+import discord
+
+from benchmarks.harness import print_report
+from modules.discord_bridge import DiscordBot
+from modules.stats_data import StatsData
+
+GUILD_ID = 1
+
+def add_arguments(parser):
+    """ Options for the member cache benchmark """
+    parser.add_argument('--members', type=int, default=20000, help='guild members')
+    parser.add_argument('--online', type=float, default=0.2,
+                        help='fraction of members online, with a presence')
+    parser.add_argument('--talkers', type=int, default=500,
+                        help='members who send a message, and so get a puppet')
+    parser.add_argument('--cache-size', type=int, default=1000, help='MemberCacheSize for lean')
+    parser.add_argument('--json', help='also write the report to this file')
+
+def member_payload(user_id: int) -> dict:
+    """ A GUILD_MEMBER as the gateway sends it """
+    return {'user': {'id': str(user_id), 'username': f'member{user_id}', 'discriminator': '0',
+                     'global_name': f'Member {user_id}', 'avatar': f'{user_id:032x}'},
+            'roles': [], 'joined_at': '2025-01-01T00:00:00+00:00', 'deaf': False,
+            'mute': False, 'flags': 0}
+
+def presence_payload(user_id: int) -> dict:
+    """ A PRESENCE_UPDATE for an online member """
+    return {'user': {'id': str(user_id)}, 'guild_id': str(GUILD_ID), 'status': 'online',
+            'activities': [], 'client_status': {'desktop': 'online'}}
+
+def guild_payload(args, policy: str) -> dict:
+    """
+    GUILD_CREATE for the guild. The full policy then chunks every member in,
+    so they are all included here. Large guilds only send online members.
+    """
+    online = range(10000, 10000 + int(args.members * args.online))
+    members = range(10000, 10000 + args.members) if policy == 'full' else online
+    return {'id': str(GUILD_ID), 'name': 'bench', 'member_count': args.members,
+            'roles': [{'id': str(GUILD_ID), 'name': '@everyone', 'permissions': '1024',
+                       'position': 0, 'color': 0, 'hoist': False, 'managed': False,
+                       'mentionable': False}],
+            'members': [member_payload(user_id) for user_id in members],
+            'presences': [presence_payload(user_id) for user_id in online],
+            'channels': [], 'emojis': [], 'stickers': [], 'features': [], 'large': True}
+
+def make_bot(args, policy: str) -> DiscordBot:
+    """ A DiscordBot using a member cache policy, not logged in """
+    discord_config = {'puppet_suffix': '_d2', 'puppet_min_size': 3, 'log_level': 'WARNING',
+                      'mode': 'discord', 'member_cache': policy,
+                      'member_cache_size': args.cache_size}
+    return DiscordBot({}, {}, discord_config, StatsData())
+
+async def talk(bot: DiscordBot, guild: discord.Guild, args):
+    """ Look talkers up as on_message does, with the member their message carries """
+    for user_id in range(10000, 10000 + args.talkers):
+        author = discord.Member(data=member_payload(user_id), guild=guild,
+                                state=bot._connection)  # pylint: disable=protected-access
+        member = await bot.find_member(user_id, author)
+        if bot.member_cache is not None:
+            bot.member_cache.pin(member)
+
+def measure(args, policy: str) -> dict:
+    """ Memory held by one bot's guild and members after the talkers have talked """
+    gc.collect()
+    tracemalloc.start()
+    bot = make_bot(args, policy)
+    state = bot._connection  # pylint: disable=protected-access
+    baseline = tracemalloc.get_traced_memory()[0]
+
+    payload = guild_payload(args, policy)
+    started = time.perf_counter()
+    guild = discord.Guild(data=payload, state=state)
+    state._add_guild(guild)  # pylint: disable=protected-access
+    del payload
+    ready = time.perf_counter() - started
+    asyncio.run(talk(bot, guild, args))
+
+    gc.collect()
+    held = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+    return {'cached_members': len(guild.members), 'held_mb': round(held / 2**20, 1),
+            'kb_per_1k_members': round(held / 1024 / args.members * 1000, 1),
+            'guild_build_ms': round(ready * 1000, 1)}
+
+def run(args):
+    """ Measure both policies and print the report """
+    report = {'members': args.members, 'online': args.online, 'talkers': args.talkers,
+              'cache_size': args.cache_size}
+    for policy in ('full', 'lean'):
+        report[policy] = measure(args, policy)
+    print_report('members', report, args.json)
@@ -0,0 +1,200 @@
+"""
+This file is part of CatPuppetBridge.
+
+CatPuppetBridge is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+CatPuppetBridge is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+CatPuppetBridge. If not, see <https://www.gnu.org/licenses/>.
+
+Copyright (C) 2025 Lisa Marie Maginnis
+
+Microbenchmarks of per-message and per-member functions, compared to baselines
+"""
+
+import json
+import os
+import timeit
+
+from benchmarks.harness import BenchDiscordBot, FakeMember
+from modules.address_generator import ula_address_from_string
+from modules.discord_filters import DiscordFilters
+from modules.irc_bridge import IRCPuppet
+from modules.records import PuppetCommand
+
+BASELINES = os.path.join(os.path.dirname(__file__), 'baselines.json')
+REFERENCE_CALLS = 200
+
+CORPORA = {
+    'ascii': "hey, did anyone try the new build? it crashed on startup for me "
+             "but only with the debug flag set, logs are in the usual place",
+    'emoji': "lol :joy: :joy: that's great :heart: :cat: :thumbsup: :fire: "
+             "😂😂 :sparkles: ok :wave: :partyparrot: :custom12: :tada: 🎉",
+    'cjk': "大家好，这个版本在我的机器上启动时崩溃了。日志在老地方。"
+           "よろしくお願いします。한국어도 됩니다. 新しいビルドを試しましたか？",
+    'paste': ' '.join(f"line{index}: value={index * 37 % 1000} status=ok 状態 ✓"
+                      for index in range(120)),
+}
+
+TIME_CORPUS = "meeting <t:1735689600:F>, reminder <t:1735693200:R> and <t:1735696800> " \
+              "then <t:1735700400:t> see you"
+
+class FakeEmoji():
+    """ A guild custom emoji """
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, emoji_id: int, name: str):
+        self.id = emoji_id
+        self.name = name
+
+    def __str__(self):
+        return f'<:{self.name}:{self.id}>'
+
+def run_sync(coroutine):
+    """ Run a coroutine which never suspends, without an event loop """
+    try:
+        coroutine.send(None)
+    except StopIteration as done:
+        return done.value
+    raise RuntimeError("coroutine suspended")
+
+def make_bot(custom_emojis: int = 50) -> BenchDiscordBot:
+    """ A DiscordBot with only what the benchmarked functions read """
+    bot = BenchDiscordBot.__new__(BenchDiscordBot)
+    bot.listener_config = {'puppet_suffix': '_d2', 'puppet_min_size': 3}
+    bot.bench_emojis = [FakeEmoji(900 + index, f'custom{index}') for index in range(custom_emojis)]
+    return bot
+
+def make_members(count: int) -> list:
+    """ Members with varied names, some needing shortening or cleaning up """
+    names = ['alice', 'Bob the Builder', '9lives', 'ünïcödé', 'x' * 40, 'cat_person']
+    return [FakeMember(10000 + index, f'{names[index % len(names)]}{index}',
+                       f'{names[(index + 1) % len(names)]} {index}') for index in range(count)]
+
+def make_filters(bot, nicks: int) -> DiscordFilters:
+    """ DiscordFilters with nicks registered for mentions """
+    filters = DiscordFilters(bot)
+    filters.mention_lookup = {}
+    for member in make_members(nicks):
+        nickname = run_sync(bot.generate_irc_nickname(member))
+        filters.mention_lookup[nickname + '_d2'] = member
+    run_sync(filters.compile_mention_lookup_re())
+    return filters
+
+def make_puppet() -> IRCPuppet:
+    """ An IRCPuppet with only what split_irc_message reads """
+    puppet = IRCPuppet.__new__(IRCPuppet)
+    puppet.config = {'nickname': 'alice[alice]_d2', 'webirc_hostname': 'discord.bridge'}
+    return puppet
+
+def mention_case(bot, nicks: int):
+    """ A line mentioning a few registered nicks, among ordinary words """
+    filters = make_filters(bot, nicks)
+    names = list(filters.mention_lookup)
+    line = f"{names[0]}: ping {names[nicks // 2]} and {names[-1]}, " + CORPORA['ascii']
+    return lambda: filters.lookup_mention(line)
+
+def cases() -> dict:
+    """ Benchmark name: function to time """
+    bot = make_bot()
+    puppet = make_puppet()
+    filters = DiscordFilters(bot)
+    members = make_members(100)
+    benchmarks = {}
+    for corpus, text in CORPORA.items():
+        msg = PuppetCommand('send', 0, data=text * (4 if corpus == 'paste' else 1),
+                             channel='#bench')
+        benchmarks[f'split_irc_message/{corpus}'] = lambda msg=msg: puppet.split_irc_message(msg)
+        benchmarks[f'replace_emojis/{corpus}'] = \
+            lambda text=text: run_sync(bot.replace_emojis(text))
+        benchmarks[f'irc_safe_nickname/{corpus}'] = \
+            lambda text=text: bot.irc_safe_nickname(text[:32])
+    benchmarks['generate_irc_nickname/100_members'] = \
+        lambda: [run_sync(bot.generate_irc_nickname(member)) for member in members]
+    for nicks in (10, 1000, 10000):
+        benchmarks[f'lookup_mention/{nicks}_nicks'] = mention_case(bot, nicks)
+    for nicks in (10, 1000):
+        mentions = make_filters(bot, nicks)
+        benchmarks[f'compile_mention_lookup_re/{nicks}_nicks'] = \
+            lambda mentions=mentions: run_sync(mentions.compile_mention_lookup_re())
+    benchmarks['replace_time/mixed'] = lambda: filters.replace_time(TIME_CORPUS)
+    benchmarks['replace_time/ascii'] = lambda: filters.replace_time(CORPORA['ascii'])
+    benchmarks['ula_address_from_string/100_nicks'] = \
+        lambda: [ula_address_from_string(member.name) for member in members]
+    return benchmarks
+
+def calibration_workload(data=tuple(f"{index * 7919 % 1000}:{index}" for index in range(500))):
+    """ Fixed mix of string, sort and dict work to measure how fast this machine is now """
+    return len({item.upper(): item for item in sorted(data)})
+
+def measure(function, reference, repeat: int) -> tuple:
+    """
+    Best of repeat runs in microseconds per call, and relative to the calibration
+    workload timed between those runs. The relative time is what is compared to
+    the baselines, so they survive a different or busier machine.
+    """
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    best = reference_best = float('inf')
+    for _ in range(repeat):
+        best = min(best, timer.timeit(number) / number)
+        reference_best = min(reference_best, reference.timeit(REFERENCE_CALLS) / REFERENCE_CALLS)
+    return best * 1e6, best / reference_best
+
+def add_arguments(parser):
+    """ Options for the microbenchmarks """
+    parser.add_argument('--filter', default='', help='only run benchmarks containing this')
+    parser.add_argument('--repeat', type=int, default=5, help='runs to take the best of')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='fraction slower than the baseline which counts as a regression')
+    parser.add_argument('--baselines', default=BASELINES, help='baseline file')
+    parser.add_argument('--save', action='store_true',
+                        help='store the results as the new baselines')
+    parser.add_argument('--json', help='also write the results to this file')
+
+def run(args) -> int:
+    """ Run the microbenchmarks, returns 1 if any regressed past the tolerance """
+    baselines = {}
+    if os.path.exists(args.baselines):
+        with open(args.baselines, encoding='utf8') as baseline_file:
+            baselines = json.load(baseline_file)
+
+    reference = timeit.Timer(calibration_workload)
+    results = {}
+    regressions = []
+    print(f"{'benchmark':<44} {'us/call':>12} {'relative':>10} {'baseline':>10} {'change':>8}")
+    for name, function in cases().items():
+        if args.filter not in name:
+            continue
+        micros, relative = measure(function, reference, args.repeat)
+        results[name] = {'us': round(micros, 3), 'relative': round(relative, 4)}
+        baseline = baselines.get(name, {}).get('relative')
+        change = ''
+        if baseline:
+            ratio = relative / baseline - 1
+            change = f"{ratio:+.0%}"
+            if ratio > args.tolerance:
+                regressions.append(name)
+                change += ' !'
+        print(f"{name:<44} {micros:>12.3f} {relative:>10.4f} {baseline or '-':>10} {change:>8}")
+
+    if args.save:
+        baselines.update(results)
+        with open(args.baselines, 'w', encoding='utf8') as baseline_file:
+            json.dump(dict(sorted(baselines.items())), baseline_file, indent=2)
+            baseline_file.write('\n')
+        print(f"saved baselines to {args.baselines}")
+    if args.json:
+        with open(args.json, 'w', encoding='utf8') as output:
+            json.dump(results, output, indent=2)
+    if regressions and not args.save:
+        print(f"{len(regressions)} regressed more than {args.tolerance:.0%}: "
+              f"{', '.join(regressions)}")
+        return 1
+    return 0
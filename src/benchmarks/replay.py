@@ -0,0 +1,215 @@
+"""
+This file is part of CatPuppetBridge.
+
+CatPuppetBridge is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+CatPuppetBridge is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+CatPuppetBridge. If not, see <https://www.gnu.org/licenses/>.
+
+Copyright (C) 2025 Lisa Marie Maginnis
+
+Replay a traffic_record_file recording at its own pace, or faster
+"""
+
+import copy
+import logging
+import random
+import time
+
+import discord
+
+from benchmarks.harness import (BenchBridge, FakeMember, IRCServerProcess, IRCTalkers,
+                                ResourceMeter, histogram_delta, latency_summary, print_report,
+                                wait_for)
+from modules.registry import registry
+from modules.traffic_recorder import read_recording, shaped_text
+
+DISCORD_EVENTS = ('discord_msg', 'presence', 'member_update', 'member_remove')
+IRC_EVENTS = ('irc_msg', 'irc_action')
+
+def add_arguments(parser):
+    """ Options for replaying a recording """
+    parser.add_argument('recording', help='file written by traffic_record_file')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='replay speed, eg/ 10 replays an hour in 6 minutes')
+    parser.add_argument('--max-talkers', type=int, default=50,
+                        help='IRC connections to share the recorded IRC users between')
+    parser.add_argument('--port', type=int, default=16667, help='port for the local irc.server')
+    parser.add_argument('--cold', action='store_true',
+                        help="don't connect puppets for recorded talkers before replaying")
+    parser.add_argument('--seed', type=int, default=1, help='seed for made up message text')
+    parser.add_argument('--json', help='also write the report to this file')
+
+# pylint: disable=too-many-instance-attributes
+class Replay():
+    """ Maps recorded users and channels to fakes, and plays records into the bridge """
+
+    def __init__(self, records, args):
+        self.records = [record for record in records if 'k' in record]
+        self.random = random.Random(args.seed)
+        channels = sorted({record['channel'] for record in self.records
+                           if 'channel' in record and not record.get('dm')})
+        self.bridge = BenchBridge(args.port, max(len(channels), 1))
+        self.channels = dict(zip(channels, self.bridge.channels))
+        discord_users = sorted({record['user'] for record in self.records
+                                if record['k'] in DISCORD_EVENTS} |
+                               {record['target'] for record in self.records if 'target' in record})
+        self.members = {user: FakeMember(10000 + index, f'user{index}')
+                        for index, user in enumerate(discord_users)}
+        irc_users = sorted({record['user'] for record in self.records
+                            if record['k'] in IRC_EVENTS + ('irc_dm',)})
+        self.talkers = IRCTalkers(args.port, max(1, min(len(irc_users), args.max_talkers)),
+                                  [channel.name for channel in self.bridge.channels])
+        self.irc_users = {user: index % self.talkers.count for index, user in enumerate(irc_users)}
+        self.played = {}
+        self.skipped = {}
+        self.message_id = 0
+
+    def start(self, cold: bool = False):
+        """
+        Start the bridge, fill the guild and connect the IRC users. Unless cold,
+        puppets for Discord users who talk are connected first, so puppet startup
+        isn't measured as message latency.
+        """
+        self.bridge.start()
+        for member in self.members.values():
+            self.bridge.guild.add_member(member)
+        self.talkers.connect()
+        if cold:
+            return
+        talking = {self.members[record['user']] for record in self.records
+                   if record['k'] == 'discord_msg'}
+        for member in talking:
+            self.bridge.call(self.bridge.bot.activate_puppet(member)).result(10)
+        wait_for(lambda: self.bridge.ready_puppets() >= len(talking), 10 + len(talking) / 5)
+
+    def channel(self, record):
+        """ The bench channel standing in for a recorded channel """
+        return self.channels.get(record.get('channel'), self.bridge.channels[0])
+
+    def member(self, record):
+        """ The member standing in for a recorded Discord user, rejoining if they left """
+        member = self.members[record['user']]
+        if self.bridge.guild.get_member(member.id) is None and record['k'] != 'member_remove':
+            self.bridge.guild.add_member(member)
+        return member
+
+    def play(self, record):
+        """ Feed one record into the bridge """
+        kind = record['k']
+        handler = getattr(self, 'play_' + kind, None)
+        if handler is None or not handler(record):
+            self.skipped[kind] = self.skipped.get(kind, 0) + 1
+            return
+        self.played[kind] = self.played.get(kind, 0) + 1
+
+    def play_discord_msg(self, record):
+        """ A Discord message """
+        self.message_id += 1
+        self.bridge.send_discord_message(self.member(record), self.channel(record),
+                                         shaped_text(record['s'], self.random), self.message_id)
+        return True
+
+    def play_presence(self, record):
+        """ A presence update """
+        member = self.member(record)
+        before = copy.copy(member)
+        before.status = discord.Status(record['before'])
+        member.status = discord.Status(record['after'])
+        self.bridge.call(self.bridge.bot.on_presence_update(before, member))
+        return True
+
+    def play_member_update(self, record):
+        """ A display name or role change """
+        member = self.member(record)
+        before = copy.copy(member)
+        if record.get('name'):
+            member.display_name = member.global_name = f'{member.name} {self.message_id}'
+        if record.get('roles'):
+            member.roles = [] if before.roles else [object()]
+        self.bridge.call(self.bridge.bot.on_member_update(before, member))
+        return True
+
+    def play_member_remove(self, record):
+        """ A member leaving """
+        member = self.member(record)
+        self.bridge.guild.remove_member(member.id)
+        self.bridge.call(self.bridge.bot.on_member_remove(member))
+        return True
+
+    def play_irc_msg(self, record):
+        """ An IRC channel message """
+        connection = self.talkers.connections[self.irc_users[record['user']]]
+        connection.privmsg(self.channel(record).name, shaped_text(record['s'], self.random))
+        return True
+
+    def play_irc_action(self, record):
+        """ An IRC /me """
+        connection = self.talkers.connections[self.irc_users[record['user']]]
+        connection.action(self.channel(record).name, shaped_text(record['s'], self.random))
+        return True
+
+    def play_irc_dm(self, record):
+        """ An IRC private message to a puppet, skipped if the puppet isn't connected """
+        member = self.members.get(record['target'])
+        puppets = dict(registry.items('puppets'))
+        puppet = puppets.get(member.id) if member else None
+        if puppet is None or not puppet.ready:
+            return False
+        connection = self.talkers.connections[self.irc_users[record['user']]]
+        connection.privmsg(puppet.connection.get_nickname(),
+                           shaped_text(record['s'], self.random))
+        return True
+
+    def run(self, speed: float) -> float:
+        """ Play every record on schedule, returns the worst seconds behind schedule """
+        behind = 0.0
+        started = time.monotonic()
+        for record in self.records:
+            due = started + record['t'] / 1000 / speed
+            while time.monotonic() < due:
+                self.talkers.reactor.process_once(min(due - time.monotonic(), 0.05))
+            behind = max(behind, time.monotonic() - due)
+            self.play(record)
+        return behind
+
+def run(args):
+    """ Replay a recording and print its report """
+    records = read_recording(args.recording)
+    server = IRCServerProcess(args.port)
+    server.start()
+    try:
+        replay = Replay(records, args)
+        replay.start(args.cold)
+        meter = ResourceMeter()
+        latency_before = replay.bridge.stats.histogram_snapshot()
+        meter.start()
+        started = time.monotonic()
+        behind = replay.run(args.speed)
+        elapsed = time.monotonic() - started
+        # Let in flight messages arrive
+        time.sleep(1)
+        resources = meter.stop()
+        latency = histogram_delta(replay.bridge.stats.histogram_snapshot(), latency_before)
+
+        report = {'records': len(replay.records), 'speed': args.speed,
+                  'elapsed_s': round(elapsed, 1), 'max_behind_schedule_s': round(behind, 3),
+                  'discord_users': len(replay.members), 'irc_users': len(replay.irc_users),
+                  'channels': len(replay.channels), 'played': replay.played,
+                  'skipped': replay.skipped}
+        for direction in ('discord_to_irc', 'irc_to_discord'):
+            summary = latency_summary(latency.get(('delivery_latency', direction)))
+            summary['msgs_per_s'] = round(summary['count'] / elapsed, 1) if elapsed else 0.0
+            report[direction] = summary
+        report.update(resources)
+        print_report('replay', report, args.json)
+    finally:
+        logging.disable()
+        server.stop()
@@ -0,0 +1,262 @@
+"""
+This file is part of CatPuppetBridge.
+
+CatPuppetBridge is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+CatPuppetBridge is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+CatPuppetBridge. If not, see <https://www.gnu.org/licenses/>.
+
+Copyright (C) 2025 Lisa Marie Maginnis
+
+Large guild soak test with member, presence and role churn over a long run
+"""
+
+import copy
+import json
+import logging
+import random
+import threading
+import time
+
+import discord
+import psutil
+
+from benchmarks.harness import BenchBridge, FakeMember, IRCServerProcess, paced, print_report
+from modules.registry import registry
+from modules.thread_stats import thread_group
+
+STATUSES = (discord.Status.online, discord.Status.idle, discord.Status.dnd,
+            discord.Status.offline)
+
+class FakeRole():
+    """ A guild role, only compared by identity """
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, role_id: int):
+        self.id = role_id
+        self.name = f'role{role_id}'
+
+def add_arguments(parser):
+    """ Options for the soak test """
+    parser.add_argument('--members', type=int, default=5000, help='guild members')
+    parser.add_argument('--chunk-size', type=int, default=1000,
+                        help='members per startup chunk, as the gateway sends them')
+    parser.add_argument('--channels', type=int, default=4, help='bridged channels')
+    parser.add_argument('--duration', type=float, default=3600, help='seconds to run for')
+    parser.add_argument('--report-interval', type=float, default=60,
+                        help='seconds between samples')
+    parser.add_argument('--presence-rate', type=float, default=20,
+                        help='presence updates per second')
+    parser.add_argument('--update-rate', type=float, default=2,
+                        help='member updates (role or display name changes) per second')
+    parser.add_argument('--remove-rate', type=float, default=0.2,
+                        help='members leaving per second, each rejoins later')
+    parser.add_argument('--message-rate', type=float, default=2,
+                        help='Discord messages per second')
+    parser.add_argument('--port', type=int, default=16667, help='port for the local irc.server')
+    parser.add_argument('--seed', type=int, default=1, help='seed for the event mix')
+    parser.add_argument('--json', help='also write every sample to this file')
+
+class MentionTimer():
+    """ Time every rebuild of the mention lookup regex """
+
+    def __init__(self, filters):
+        self.filters = filters
+        self.compile = filters.compile_mention_lookup_re
+        self.durations = []
+        filters.compile_mention_lookup_re = self.timed
+
+    async def timed(self, user=None):
+        """ compile_mention_lookup_re, timed """
+        started = time.perf_counter()
+        await self.compile(user)
+        self.durations.append(time.perf_counter() - started)
+
+    def drain(self) -> list:
+        """ Rebuild times since the last drain """
+        durations, self.durations = self.durations, []
+        return durations
+
+# pylint: disable=too-many-instance-attributes
+class Churn():
+    """ Guild events at fixed rates, picked from a seeded random mix """
+
+    def __init__(self, bridge, members, args):
+        self.bridge = bridge
+        self.members = {member.id: member for member in members}
+        self.departed = []
+        self.random = random.Random(args.seed)
+        self.roles = [FakeRole(index) for index in range(20)]
+        self.mix = [(self.presence, args.presence_rate), (self.update, args.update_rate),
+                    (self.remove, args.remove_rate), (self.message, args.message_rate)]
+        self.rate = sum(rate for _, rate in self.mix)
+        self.events = {}
+        self.errors = {}
+        self.message_id = 0
+
+    def send(self, count):
+        """ Send the next event """
+        pick = self.random.uniform(0, self.rate)
+        for event, rate in self.mix:
+            pick -= rate
+            if pick <= 0:
+                break
+        kind = event.__name__
+        self.events[kind] = self.events.get(kind, 0) + 1
+        future = event(count)
+        if future is not None:
+            future.add_done_callback(lambda done: self.check(kind, done))
+
+    def check(self, kind, future):
+        """ Count events which raised, bridge bugs are what a soak test is for """
+        if future.exception() is not None:
+            if kind not in self.errors:
+                logging.warning("%s event failed: %r", kind, future.exception())
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def pick(self):
+        """ A random current member """
+        return self.members[self.random.choice(list(self.members))]
+
+    def changed(self, member, **changes):
+        """ Apply changes to a member in the guild, returns (before, after) """
+        before = copy.copy(member)
+        for name, value in changes.items():
+            setattr(member, name, value)
+        return before, member
+
+    def presence(self, _):
+        """ A member's status changes """
+        member = self.pick()
+        before, after = self.changed(member, status=self.random.choice(STATUSES))
+        return self.bridge.call(self.bridge.bot.on_presence_update(before, after))
+
+    def update(self, count):
+        """ A member's roles change, or sometimes their display name """
+        member = self.pick()
+        if self.random.random() < 0.1:
+            before, after = self.changed(member, display_name=f'{member.name} v{count}',
+                                         global_name=f'{member.name} v{count}')
+        else:
+            before, after = self.changed(member, roles=self.random.sample(self.roles, 3))
+        return self.bridge.call(self.bridge.bot.on_member_update(before, after))
+
+    def remove(self, _):
+        """ A member leaves, and an earlier leaver rejoins """
+        if self.departed and self.random.random() < 0.9:
+            member = self.departed.pop(0)
+            self.members[member.id] = member
+            self.bridge.guild.add_member(member)
+        member = self.pick()
+        del self.members[member.id]
+        self.departed.append(member)
+        self.bridge.guild.remove_member(member.id)
+        return self.bridge.call(self.bridge.bot.on_member_remove(member))
+
+    def message(self, _):
+        """ A member says something """
+        member = self.pick()
+        self.message_id += 1
+        return self.bridge.send_discord_message(
+            member, self.random.choice(self.bridge.channels),
+            f"soak message {self.message_id}", self.message_id)
+
+def chunk_members(bridge, members, chunk_size: int) -> float:
+    """ Fill the guild's member cache chunk by chunk on the Discord loop, returns seconds """
+    async def add(chunk):
+        for member in chunk:
+            bridge.guild.add_member(member)
+
+    started = time.monotonic()
+    for index in range(0, len(members), chunk_size):
+        bridge.call(add(members[index:index + chunk_size])).result()
+    return time.monotonic() - started
+
+def sample(bridge, churn, mentions, started) -> dict:
+    """ One row of soak measurements """
+    threads = {}
+    for thread in threading.enumerate():
+        group = thread_group(thread.name)
+        threads[group] = threads.get(group, 0) + 1
+    puppets = [puppet for _, puppet in registry.items('puppets')]
+    rebuilds = mentions.drain()
+    process = psutil.Process()
+    inboxes = [inbox.qsize() for inbox in list(bridge.puppet_queues.values())]
+    return {
+        'elapsed_s': round(time.monotonic() - started),
+        'rss_mb': round(process.memory_info().rss / 1024**2, 1),
+        'threads': sum(threads.values()),
+        'puppet_threads': threads.get('puppet', 0),
+        'puppets': len(puppets),
+        'puppets_ready': sum(1 for puppet in puppets if puppet.ready),
+        'irc_connections': len(process.net_connections('tcp')),
+        'mention_index': len(bridge.bot.filters.mention_lookup),
+        'mention_rebuilds': len(rebuilds),
+        'mention_rebuild_max_ms': round(max(rebuilds, default=0) * 1000, 2),
+        'mention_rebuild_mean_ms': round(sum(rebuilds) / len(rebuilds) * 1000, 2)
+                                   if rebuilds else 0,
+        'queues': {name: queue.qsize() for name, queue in bridge.queues.items()},
+        'puppet_inbox_max': max(inboxes, default=0),
+        'events': dict(churn.events),
+        'errors': dict(churn.errors),
+    }
+
+def print_sample(row):
+    """ Print a sample as one line """
+    queues = ' '.join(f"{name.split('_')[0]}={depth}" for name, depth in row['queues'].items())
+    print(f"{row['elapsed_s']:>6}s rss={row['rss_mb']}MB threads={row['threads']} "
+          f"puppets={row['puppets_ready']}/{row['puppets']} conns={row['irc_connections']} "
+          f"mentions={row['mention_index']} rebuild max={row['mention_rebuild_max_ms']}ms "
+          f"mean={row['mention_rebuild_mean_ms']}ms queues: {queues} "
+          f"inbox_max={row['puppet_inbox_max']} errors={sum(row['errors'].values())}",
+          flush=True)
+
+def run(args):
+    """ Run the soak test, printing a sample every report interval """
+    server = IRCServerProcess(args.port)
+    server.start()
+    try:
+        bridge = BenchBridge(args.port, args.channels)
+        bridge.start()
+        mentions = MentionTimer(bridge.bot.filters)
+        members = [FakeMember(10000 + index, f'member{index}') for index in range(args.members)]
+        chunk_seconds = chunk_members(bridge, members, args.chunk_size)
+        print(f"cached {len(members)} members in {chunk_seconds:.2f}s", flush=True)
+
+        churn = Churn(bridge, members, args)
+        started = time.monotonic()
+        samples = [sample(bridge, churn, mentions, started)]
+        print_sample(samples[0])
+        driver = threading.Thread(target=paced, args=[churn.rate, args.duration, churn.send],
+                                  name='bench-soak-driver', daemon=True)
+        driver.start()
+        while driver.is_alive():
+            driver.join(args.report_interval)
+            samples.append(sample(bridge, churn, mentions, started))
+            print_sample(samples[-1])
+
+        first, last = samples[0], samples[-1]
+        report = {'members': args.members, 'duration_s': args.duration,
+                  'rss_growth_mb': round(last['rss_mb'] - first['rss_mb'], 1),
+                  'thread_growth': last['threads'] - first['threads'],
+                  'puppets': last['puppets'],
+                  'mention_rebuild_max_ms': max(row['mention_rebuild_max_ms']
+                                                for row in samples),
+                  'max_queue_depths': {name: max(row['queues'][name] for row in samples)
+                                       for name in first['queues']},
+                  'puppet_inbox_max': max(row['puppet_inbox_max'] for row in samples),
+                  'events': last['events'], 'errors': last['errors']}
+        print_report('soak', report)
+        if args.json:
+            with open(args.json, 'w', encoding='utf8') as output:
+                json.dump({'summary': report, 'samples': samples}, output, indent=2)
+    finally:
+        logging.disable()
+        server.stop()
@@ -25,36 +25,59 @@ import os.path
 import threading
 import logging
 import time
-from queue import Queue
-import asyncio
+import tempfile
+import signal
 
-from modules.irc_bridge import IRCBot, IRCListener, IRCPuppet
-from modules.discord_bridge import DiscordBot
+from modules.startup import startup
 from modules.address_generator import ula_address_from_string
 from modules.stats_data import StatsData
+from modules.registry import registry
+from modules.watchdog import watchdog
+from modules.thread_stats import accounting
+from modules.flight_recorder import recorder, RecorderHandler
+from modules.traffic_recorder import traffic
+from modules.log_pipeline import log_pipeline
+from modules.metrics_server import start_metrics_server
+from modules.tracing import mark
+from modules.bridge_queue import BridgeQueue, AsyncBridgeQueue, PuppetInbox, POLICIES
+
+QUEUE_DEFAULTS = {
+    'irc_to_discord_queue': (1000, 'drop_oldest'),
+    'dm_out_queue': (1000, 'block'),
+    # Filled from the Discord loop, which must never block on it
+    'puppet_queue': (10000, 'spill'),
+    'puppet_inbox': (1000, 'drop_presence')
+}
 
 def run_discord(discord_token, queues, irc_to_discord_links, listener_config, data):
     """Start the discord thread and login to the Discord API"""
+    # Imported here, so discord.py loads while the IRC threads connect
+    from modules.discord_bridge import DiscordBot  # pylint: disable=import-outside-toplevel
+    startup.mark('discord_import')
     # Start Discord Bot
     discordbot = DiscordBot(queues, irc_to_discord_links, listener_config, data)
-    discordbot.run(discord_token)
+    # Discord logs go through the root logger's queue, not a handler of its own
+    discordbot.run(discord_token, log_handler=None)
 
 def run_ircbot(config, data):
     """Start the IRCBOT thread"""
+    from modules.irc_bridge import IRCBot  # pylint: disable=import-outside-toplevel
     # Start IRC Bot
     ircbot = IRCBot(config, data)
     ircbot.start()
 
 def run_irclistener(out_queue, config, data):
     """Start the IRC Listener thread"""
+    from modules.irc_bridge import IRCListener  # pylint: disable=import-outside-toplevel
     # Start IRC Listenr
     ircbot = IRCListener(out_queue, config, data)
     ircbot.start()
 
-def run_ircpuppet(queues, discord_to_irc_links, puppet_config, config):
+def run_ircpuppet(queues, discord_to_irc_links, puppet_config, config, data):
     """Start a IRC Puppet thread"""
+    from modules.irc_bridge import IRCPuppet  # pylint: disable=import-outside-toplevel
     # Start IRC Puppet
-    ircbot = IRCPuppet(queues, discord_to_irc_links, puppet_config, config)
+    ircbot = IRCPuppet(queues, discord_to_irc_links, puppet_config, config, data)
     ircbot.start()
 
 def init_config(config_filename='catbridge.ini'):
@@ -76,6 +99,65 @@ def init_config(config_filename='catbridge.ini'):
     config_data = {'config': config, 'config_path': config_path}
     return config_data
 
+def read_queue_config(config, config_path: str):
+    """Read queue bounds and overflow policies from the optional Queues block"""
+    queue_block = config['Queues'] if 'Queues' in config else {}
+    queue_config = {'spill_directory': queue_block.get('spill_directory',
+                                                       tempfile.gettempdir())}
+
+    for name, (size, policy) in QUEUE_DEFAULTS.items():
+        try:
+            size = int(queue_block.get(name + '_size', size))
+        except ValueError:
+            logging.error("`%s_size` in Queues block must be a number in %s", name, config_path)
+            sys.exit(1)
+        policy = queue_block.get(name + '_policy', policy)
+        if policy not in POLICIES:
+            logging.error("`%s_policy` in Queues block must be one of %s in %s",
+                          name, ', '.join(POLICIES), config_path)
+            sys.exit(1)
+        if name == 'puppet_queue' and policy == 'block':
+            logging.warning("puppet_queue_policy = block can stall the Discord connection "
+                            "while the puppet dispatcher is busy")
+        queue_config[name] = {'size': size, 'policy': policy}
+
+    return queue_config
+
+def make_queue(queue_config, name, stats_data, queue_class=BridgeQueue):
+    """Create a bounded bridge queue from the queue configuration"""
+    return queue_class(queue_config[name]['size'], name=name,
+                       policy=queue_config[name]['policy'], stats=stats_data,
+                       spill_directory=queue_config['spill_directory'])
+
+def register_queue_gauges(stats_data, discord_queues, puppet_queues):
+    """Export the depth of every bridge queue as a gauge, and register it for admin commands"""
+    for name, bridge_queue in discord_queues.items():
+        stats_data.register_gauge(('queue_depth', name), bridge_queue.qsize)
+        registry.register('queues', name, bridge_queue)
+    stats_data.register_gauge(('queue_depth', 'puppet_inbox'),
+                              lambda: sum(inbox.qsize() for inbox in list(puppet_queues.values())))
+
+def start_monitoring(global_config, stats_data):
+    """Start the lag watchdog, thread accounting, and traffic recording and metrics if configured"""
+    watchdog.start(stats_data, float(global_config.get('watchdog_interval', 1)),
+                   float(global_config.get('watchdog_threshold', 5)))
+    accounting.start(stats_data, float(global_config.get('thread_stats_interval', 10)))
+    recorder.resize(int(global_config.get('flight_recorder_size', 10000)))
+    logging.getLogger().addHandler(RecorderHandler(recorder))
+    log_pipeline.configure_sampling(float(global_config.get('log_debug_rate', 20)),
+                                    int(global_config.get('log_debug_burst', 100)))
+    stats_data.register_gauge('log_dropped', lambda: log_pipeline.dropped)
+    stats_data.register_gauge('log_suppressed', lambda: log_pipeline.suppressed)
+    stats_data.register_gauge('traffic_dropped', lambda: traffic.dropped)
+    dump_directory = global_config.get('flight_recorder_directory') or tempfile.gettempdir()
+    signal.signal(signal.SIGUSR1, lambda signum, frame: recorder.dump(dump_directory))
+    # Exit cleanly on SIGTERM, so atexit handlers flush logs and close the traffic recording
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if global_config.get('traffic_record_file'):
+        traffic.start(global_config['traffic_record_file'])
+    if global_config.get('metrics_bind'):
+        start_metrics_server(stats_data, global_config['metrics_bind'])
+
 def check_required(required: list, config: dict, block: str):
     """Ensure required fields exist"""
     for req in required:
@@ -154,7 +236,8 @@ def read_config(irc_required: list, discord_required: list, config, config_path:
             'irc_to_discord_links': irc_to_discord_links,
             'discord_to_irc_links': discord_to_irc_links,
             'channels_to_join': channels_to_join,
-            'global_config': global_config}
+            'global_config': global_config,
+            'queue_config': read_queue_config(config, config_path)}
 
 def get_log_level(log_level_str):
     """ Helper to translate log_level string to logging level type """
@@ -175,6 +258,55 @@ def set_log_level(log_level_str):
     """ Helper to set log level from given string """
     logging.getLogger().setLevel(get_log_level(log_level_str))
 
+def run_puppet_dispatcher(configs, irc_config, discord_queues, puppet_queues, stats_data):
+    """Start, stop and pass commands to IRC Puppets from the Discord puppet queue, forever"""
+    puppet_dict = {}
+    for user in iter(discord_queues['puppet_queue'].get, object()):
+        if user.command == 'active':
+            # Does the puppet already exist? Start it! Otherwise do nothing
+            if user.id not in puppet_dict:
+                logging.debug("Starting IRC Puppet: %s", user.irc_nick)
+                logging.info("starting IRC Puppet")
+                puppet_queues[user.id] = make_queue(configs['queue_config'],
+                                                    'puppet_inbox', stats_data,
+                                                    PuppetInbox)
+                puppet_nickname = user.irc_nick + configs['irc_config']['PuppetSuffix']
+                puppet_config = {
+                    'channels': user.data,
+                    'nickname': puppet_nickname,
+                    'webirc_ip': ula_address_from_string(puppet_nickname),
+                    'discord_id': user.id
+                    }
+                ircpuppet_thread = threading.Thread(
+                    target=run_ircpuppet,
+                    args=[{
+                        'in_queue': puppet_queues[user.id],
+                        'out_queue': discord_queues['dm_out_queue']
+                        }, configs['discord_to_irc_links'],
+                          puppet_config, irc_config, stats_data],
+                    name='puppet:' + puppet_nickname, daemon=True)
+                ircpuppet_thread.start()
+                stats_data.increment('total_puppets')
+
+                puppet_dict[user.id] = ircpuppet_thread
+        elif user.command == 'die':
+            logging.debug("stopping IRC Puppet: %s", user.irc_nick)
+            logging.info("stopping IRC Puppet")
+            puppet_queues[user.id].put(user)
+            puppet_dict[user.id].join()
+            del puppet_dict[user.id]
+            stats_data.decrement('total_puppets')
+        else:
+            if user.command == 'nick':
+                user = user._replace(
+                    irc_nick=user.irc_nick + configs['irc_config']['PuppetSuffix'])
+            mark(user.trace, 'dispatch')
+            try:
+                puppet_queues[user.id].put(user)
+            except KeyError as e:
+                logging.error("Failed to add irc command to queue, missing %i", user.id)
+                logging.error(e)
+
 def main():
     """Main loop for Cat Puppet Bridge"""
 
@@ -182,6 +314,8 @@ def main():
     logging.basicConfig(
         format="%(asctime)s %(levelname)s %(module)s.%(name)s.%(funcName)s %(message)s",
         level=logging.INFO)
+    log_pipeline.start()
+    startup.mark('import')
 
     config_info = init_config()
 
@@ -199,36 +333,70 @@ def main():
                           config_info['config_path'])
 
     set_log_level(configs['global_config']['log_level'])
+    startup.mark('config')
+    dry_run = configs['global_config'].get('dry_run', 'no') == 'yes'
 
     discord_config = {'puppet_suffix': configs['irc_config']['PuppetSuffix'],
                       'puppet_min_size': int(configs['irc_config']['PuppetDisplayNameMinSize']),
                       'log_level': get_log_level(configs['global_config']['log_level']),
                       'mode': configs['discord_config']['mode'],
                       'api': configs['discord_config']['api'],
-                      'gateway': configs['discord_config']['gateway']}
+                      'gateway': configs['discord_config']['gateway'],
+                      'presence_debounce': float(
+                          configs['discord_config'].get('PresenceDebounce', 30)),
+                      'membership_window': float(
+                          configs['discord_config'].get('MembershipWindow', 2)),
+                      'coalesce_window': float(
+                          configs['discord_config'].get('CoalesceWindow', 0)),
+                      'coalesce_max_delay': float(
+                          configs['discord_config'].get('CoalesceMaxDelay', 1.5)),
+                      'member_cache': configs['discord_config'].get('MemberCache', 'full'),
+                      'member_cache_size': int(
+                          configs['discord_config'].get('MemberCacheSize', 1000)),
+                      'presence_mode': configs['discord_config'].get('PresenceMode', 'presence'),
+                      'away_after': float(configs['discord_config'].get('AwayAfter', 1800)),
+                      'hibernate_after': float(
+                          configs['discord_config'].get('HibernateAfter', 86400)),
+                      'dry_run': dry_run}
     irc_config = {
         'puppet_suffix': configs['irc_config']['PuppetSuffix'],
         'tls': configs['irc_config']['TLS'],
         'channels': configs['channels_to_join'],
         'bot_channel': configs['irc_config']['BotChannel'],
+        'bot_admins': [mask.strip() for mask in
+                       configs['irc_config'].get('BotAdmins', '').split(',') if mask.strip()],
         'bot_nickname': configs['irc_config']['BridgeNickname'],
         'listener_nickname': configs['irc_config']['ListenerNickname'],
         'server': configs['irc_config']['Server'],
         'port': int(configs['irc_config']['Port']),
-        'webirc_password': configs['irc_config']['WebIRCPassword']
-    }
-
-    discord_queues = {
-        'irc_to_discord_queue': asyncio.Queue(),
-        'puppet_queue': Queue(),
-        'dm_out_queue': asyncio.Queue()
+        'webirc_password': configs['irc_config']['WebIRCPassword'],
+        'flood_burst': int(configs['irc_config'].get('PuppetFloodBurst', 10)),
+        'flood_rate': float(configs['irc_config'].get('PuppetFloodRate', 2)),
+        'relay_membership': configs['irc_config'].get('RelayMembership', 'no') == 'yes',
+        'membership_window': float(configs['irc_config'].get('RelayMembershipWindow', 5)),
+        'profile_directory': configs['global_config'].get('profile_directory'),
+        'flight_recorder_directory': configs['global_config'].get('flight_recorder_directory'),
+        'dry_run': dry_run
     }
+    if dry_run:
+        logging.warning("dry run: nothing will be sent to Discord, and puppets won't connect")
 
     threads = []
-    puppet_dict = {}
     puppet_main_queues = {}
     stats_data = StatsData()
     stats_data.update('uptime', time.time())
+    startup.start(stats_data)
+
+    discord_queues = {
+        'irc_to_discord_queue': make_queue(configs['queue_config'], 'irc_to_discord_queue',
+                                           stats_data, AsyncBridgeQueue),
+        'puppet_queue': make_queue(configs['queue_config'], 'puppet_queue', stats_data),
+        'dm_out_queue': make_queue(configs['queue_config'], 'dm_out_queue',
+                                   stats_data, AsyncBridgeQueue)
+    }
+    register_queue_gauges(stats_data, discord_queues, puppet_main_queues)
+
+    start_monitoring(configs['global_config'], stats_data)
 
     logging.info("starting discord thread")
     threads.append(threading.Thread(target=run_discord,
@@ -236,58 +404,20 @@ def main():
                                           discord_queues,
                                           configs['irc_to_discord_links'],
                                           discord_config, stats_data],
-                                    daemon=True).start())
+                                    name='discord-loop', daemon=True).start())
 
     logging.info("starting IRC bot thread")
     threads.append(threading.Thread(target=run_ircbot,
-                                    args=[irc_config, stats_data], daemon=True).start())
+                                    args=[irc_config, stats_data], name='bot',
+                                    daemon=True).start())
 
     logging.info("starting IRC listener thread")
     threads.append(threading.Thread(target=run_irclistener,
                                     args=[discord_queues['irc_to_discord_queue'],
-                                          irc_config, stats_data], daemon=True).start())
-
-    for user in iter(discord_queues['puppet_queue'].get, object()):
-        if user['command'] == 'active':
-            # Does the puppet already exist? Start it! Otherwise do nothing
-            if user['id'] not in puppet_dict:
-                logging.debug("Starting IRC Puppet: %s", user['irc_nick'])
-                logging.info("starting IRC Puppet")
-                puppet_main_queues[user['id']] = Queue()
-                puppet_nickname = user['irc_nick'] + configs['irc_config']['PuppetSuffix']
-                puppet_config = {
-                    'channels': user['data'],
-                    'nickname': puppet_nickname,
-                    'webirc_ip': ula_address_from_string(puppet_nickname),
-                    'discord_id': user['id']
-                    }
-                ircpuppet_thread = threading.Thread(
-                    target=run_ircpuppet,
-                    args=[{
-                        'in_queue': puppet_main_queues[user['id']],
-                        'out_queue': discord_queues['dm_out_queue']
-                        }, configs['discord_to_irc_links'],
-                          puppet_config, irc_config],
-                    daemon=True)
-                ircpuppet_thread.start()
-                stats_data.increment('total_puppets')
+                                          irc_config, stats_data], name='listener',
+                                    daemon=True).start())
 
-                puppet_dict[user['id']] = ircpuppet_thread
-        elif user['command'] == 'die':
-            logging.debug("stopping IRC Puppet: %s", user['irc_nick'])
-            logging.info("stopping IRC Puppet")
-            puppet_main_queues[user['id']].put(user)
-            puppet_dict[user['id']].join()
-            del puppet_dict[user['id']]
-            stats_data.decrement('total_puppets')
-        else:
-            if user['command'] == 'nick':
-                user['irc_nick'] += configs['irc_config']['PuppetSuffix']
-            try:
-                puppet_main_queues[user['id']].put(user)
-            except KeyError as e:
-                logging.error("Failed to add irc command to queue, missing %i", user['id'])
-                logging.error(e)
+    run_puppet_dispatcher(configs, irc_config, discord_queues, puppet_main_queues, stats_data)
     for t in threads:
         t.join()
 
@@ -0,0 +1,313 @@
+"""
+This file is part of CatPuppetBridge.
+
+CatPuppetBridge is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+CatPuppetBridge is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+CatPuppetBridge. If not, see <https://www.gnu.org/licenses/>.
+
+Copyright (C) 2025 Lisa Marie Maginnis
+
+Bounded queues with overflow policies for passing data between threads
+"""
+
+import abc
+import asyncio
+import pickle
+import queue
+import tempfile
+import threading
+import time
+from collections import deque
+
+from modules.thread_stats import accounting
+from modules.flight_recorder import recorder
+
+POLICIES = ('block', 'drop_oldest', 'drop_presence', 'spill')
+PRESENCE_COMMANDS = ('afk', 'unafk')
+
+def is_presence(item) -> bool:
+    """ Check if a queued item is a presence only (afk/unafk) command """
+    return getattr(item, 'command', None) in PRESENCE_COMMANDS
+
+def remove_first(items, predicate) -> bool:
+    """ Remove the first item in a deque matching predicate """
+    for index, item in enumerate(items):
+        if predicate(item):
+            del items[index]
+            return True
+    return False
+
+class SpillFile():
+    """ Anonymous on-disk overflow for a queue, read back in FIFO order """
+
+    def __init__(self, directory):
+        # pylint: disable=consider-using-with
+        self.file = tempfile.TemporaryFile(dir=directory)
+        self.read_pos = 0
+        self.pending = 0
+
+    def write(self, item):
+        """ Append an item to the end of the spill file """
+        self.file.seek(0, 2)
+        pickle.dump(item, self.file)
+        self.pending += 1
+
+    def read(self):
+        """ Read the oldest item back from the spill file """
+        self.file.seek(self.read_pos)
+        item = pickle.load(self.file)
+        self.read_pos = self.file.tell()
+        self.pending -= 1
+        if self.pending == 0:
+            self.file.seek(0)
+            self.file.truncate()
+            self.read_pos = 0
+        return item
+
+class OverflowMixin(abc.ABC):
+    """ Shared overflow handling for bounded thread and asyncio queues """
+    name = 'queue'
+    policy = 'block'
+    stats = None
+    spill = None
+    spill_directory = None
+    high_water = 0
+
+    def setup_overflow(self, name, policy, stats, spill_directory):
+        """ Configure the overflow policy and counters for this queue """
+        if policy not in POLICIES:
+            raise ValueError(f"unknown queue policy '{policy}' for {name}")
+        self.name = name
+        self.policy = policy
+        self.stats = stats
+        self.spill_directory = spill_directory
+        self.high_water = 0
+
+    @abc.abstractmethod
+    def storage(self):
+        """ Return the underlying deque holding queued items """
+
+    def spill_pending(self) -> bool:
+        """ Check if items are waiting on disk """
+        return self.spill is not None and self.spill.pending > 0
+
+    def note_depth(self, depth):
+        """ Track the high-water mark of this queue """
+        if depth > self.high_water:
+            self.high_water = depth
+            if self.stats:
+                self.stats.update_max(('queue_high_water', self.name), depth)
+
+    def count_drop(self):
+        """ Count an item dropped by the overflow policy """
+        recorder.record('queue_drop', self.name)
+        if self.stats:
+            self.stats.increment(('queue_drops', self.name))
+
+    def evict_oldest(self):
+        """ Drop the oldest queued item """
+        self.storage().popleft()
+
+    def evict_presence(self) -> bool:
+        """ Drop the oldest queued presence command, if any """
+        return remove_first(self.storage(), is_presence)
+
+    def overflow(self, item) -> bool:
+        """
+        Apply the overflow policy to an item put on a full queue. Returns True
+        if the incoming item was stored in memory.
+        """
+        if self.policy == 'spill':
+            if self.spill is None:
+                self.spill = SpillFile(self.spill_directory)
+            self.spill.write(item)
+            if self.stats:
+                self.stats.increment(('queue_spilled', self.name))
+            return False
+
+        if self.policy == 'drop_presence' and not self.evict_presence():
+            if is_presence(item):
+                self.count_drop()
+                return False
+            self.evict_oldest()
+        elif self.policy == 'drop_oldest':
+            self.evict_oldest()
+        self.count_drop()
+        self._put(item)
+        return True
+
+    def refill(self):
+        """ Move one spilled item back into memory """
+        if self.spill_pending():
+            self._put(self.spill.read())
+
+class BridgeQueue(OverflowMixin, queue.Queue):
+    """ Bounded queue.Queue for items passed between bridge threads """
+
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    def __init__(self, maxsize=0, name='queue', policy='block', stats=None,
+                 spill_directory=None):
+        super().__init__(maxsize)
+        self.setup_overflow(name, policy, stats, spill_directory)
+
+    def storage(self):
+        return self.queue
+
+    def put(self, item, block=True, timeout=None):
+        """ Put an item on the queue, applying the overflow policy when full """
+        if self.policy == 'block' or self.maxsize <= 0:
+            super().put(item, block, timeout)
+            self.note_depth(self.qsize())
+            return
+
+        with self.not_full:
+            if self.spill_pending() or self._qsize() >= self.maxsize:
+                if not self.overflow(item):
+                    return
+            else:
+                self._put(item)
+                self.unfinished_tasks += 1
+            self.note_depth(self._qsize())
+            self.not_empty.notify()
+
+    def get(self, block=True, timeout=None):
+        """ Get an item from the queue, pulling spilled items back in """
+        started = time.monotonic()
+        item = super().get(block, timeout)
+        accounting.add_wait(time.monotonic() - started)
+        if self.spill is not None:
+            with self.mutex:
+                if self.spill_pending():
+                    self.refill()
+                    self.unfinished_tasks += 1
+                    self.not_empty.notify()
+        return item
+
+class AsyncBridgeQueue(OverflowMixin, asyncio.Queue):
+    """ Bounded asyncio.Queue for items passed to the Discord loop """
+
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    def __init__(self, maxsize=0, name='queue', policy='block', stats=None,
+                 spill_directory=None):
+        super().__init__(maxsize)
+        self.setup_overflow(name, policy, stats, spill_directory)
+        # Producers are on other threads, the spill file and its checks need a lock
+        self.lock = threading.Lock()
+
+    def storage(self):
+        return self._queue
+
+    async def put(self, item):
+        """
+        Put an item on the queue. Producers run on other threads with their
+        own event loop, so blocking is done by polling instead of futures.
+        """
+        while True:
+            # Checked and put under one lock, or another producer could fill the space
+            with self.lock:
+                if self.policy != 'block' or not self.full():
+                    self.put_locked(item)
+                    break
+            await asyncio.sleep(0.01)
+        self.note_depth(self.qsize())
+
+    def put_nowait(self, item):
+        """ Put an item on the queue without blocking """
+        with self.lock:
+            self.put_locked(item)
+        self.note_depth(self.qsize())
+
+    def put_locked(self, item):
+        """ Put an item, applying the overflow policy when full, call with the lock held """
+        if self.policy != 'block' and self.maxsize > 0 and \
+           (self.spill_pending() or self.full()):
+            self.overflow(item)
+        else:
+            super().put_nowait(item)
+
+    def get_nowait(self):
+        """ Get an item from the queue, pulling spilled items back in """
+        with self.lock:
+            if self.empty():
+                # Everything left may be on disk
+                self.refill_one()
+            item = super().get_nowait()
+            self.refill_one()
+        return item
+
+    def refill_one(self):
+        """ Move one spilled item back into memory, call with the lock held """
+        if self.spill_pending():
+            self.refill()
+            self._unfinished_tasks += 1
+
+class PuppetInbox(BridgeQueue):
+    """
+    Per-puppet command queue which serves chat before membership changes, and
+    membership changes before AFK state. Lower classes keep only the latest
+    command of each kind, so presence storms can't pile up behind chat.
+    """
+    PRIORITIES = {'send': 0, 'send_dm': 0, 'join_part': 1, 'nick': 1,
+                  'afk': 2, 'unafk': 2, 'die': 3}
+    COALESCE = {'join_part': 'join_part', 'nick': 'nick', 'afk': 'away', 'unafk': 'away'}
+    classes = None
+
+    # pylint: disable=invalid-name
+    def _init(self, maxsize):
+        self.queue = None
+        self.classes = [deque() for _ in range(4)]
+
+    def _qsize(self):
+        return sum(len(items) for items in self.classes)
+
+    def _put(self, item):
+        self.classes[self.PRIORITIES.get(getattr(item, 'command', None), 0)].append(item)
+
+    def _get(self):
+        for items in self.classes:
+            if items:
+                return items.popleft()
+        raise IndexError('get from an empty PuppetInbox')
+
+    def coalesce(self, item) -> bool:
+        """ Replace a queued command of the same kind, returns True if replaced """
+        key = self.COALESCE.get(item.command)
+        if not key:
+            return False
+        items = self.classes[self.PRIORITIES[item.command]]
+        for index, queued in enumerate(items):
+            if self.COALESCE.get(queued.command) == key:
+                items[index] = item
+                if self.stats:
+                    self.stats.increment(('queue_coalesced', self.name))
+                return True
+        return False
+
+    def put(self, item, block=True, timeout=None):
+        """ Put a command in the inbox, coalescing it with a queued one if possible """
+        with self.mutex:
+            if self.coalesce(item):
+                return
+        super().put(item, block, timeout)
+
+    def evict_oldest(self):
+        """ Drop the oldest command from the lowest priority class, never `die` """
+        for items in reversed(self.classes[:3]):
+            if items:
+                items.popleft()
+                return
+
+    def evict_presence(self) -> bool:
+        """ Drop the queued AFK state command, if any """
+        if self.classes[2]:
+            self.classes[2].popleft()
+            return True
+        return False
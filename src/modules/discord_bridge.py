@@ -20,19 +20,39 @@ Main thread for the DiscordBot part of the bridge
 
 import re
 import logging
-import time
 import asyncio
-import emoji
 import discord
 
 from discord.http import Route, _set_api_version, INTERNAL_API_VERSION
 import yarl
 
 from modules.discord_filters import DiscordFilters
+from modules.emoji_table import emojize
+from modules.member_cache import MemberCache
+from modules.records import PuppetCommand
+from modules.registry import registry
+from modules.startup import startup
+from modules.dry_run import DryRunWebhook, record_send
+from modules.tracing import start_trace, mark, record_trace
+from modules.traffic_recorder import traffic
+from modules.watchdog import watchdog
 
 from discord.gateway import DiscordWebSocket
 
+# pylint: disable=too-few-public-methods
+class RateLimitCounter(logging.Filter):
+    """Count the HTTP 429 rate limits discord.py logs while retrying requests"""
 
+    def __init__(self, data):
+        super().__init__()
+        self.data = data
+
+    def filter(self, record):
+        if str(record.msg).startswith('We are being rate limited'):
+            self.data.increment('webhook_rate_limits')
+        return True
+
+# pylint: disable=too-many-public-methods,too-many-instance-attributes
 class DiscordBot(discord.Client):
     """Instance of discord.Client to run our bridge"""
     queues = None
@@ -44,6 +64,18 @@ class DiscordBot(discord.Client):
     max_puppet_username = 30
     filters = None
     sessions = {}
+    presence_pending = {}
+    presence_state = {}
+    puppet_channels = {}
+    membership_pending = set()
+    membership_task = None
+    webhooks = {}
+    max_discord_message = 2000
+    lag_task = None
+    member_cache = None
+    activity_task = None
+    last_active = {}
+    registry = registry
 
     def __init__(self, queues, irc_to_discord_links, discord_config, data):
 
@@ -57,7 +89,8 @@ class DiscordBot(discord.Client):
         intents.message_content = True
         intents.members = True
         intents.guilds = True
-        intents.presences = True
+        # Activity mode infers puppet presence from messages instead
+        intents.presences = discord_config.get('presence_mode', 'presence') != 'activity'
 
         self.data = data
         self.filters = DiscordFilters(self)
@@ -67,21 +100,39 @@ class DiscordBot(discord.Client):
         self.listener_config = discord_config
         logging.getLogger('discord.gateway').setLevel(discord_config['log_level'])
         logging.getLogger('discord.client').setLevel(discord_config['log_level'])
+        logging.getLogger('discord.http').addFilter(RateLimitCounter(data))
+
+        if discord_config.get('member_cache', 'full') == 'lean':
+            # Only cache what MemberCache keeps, instead of every member in the guild
+            self.member_cache = MemberCache(discord_config.get('member_cache_size', 1000), data)
+            super().__init__(intents=intents, chunk_guilds_at_startup=False,
+                             member_cache_flags=discord.MemberCacheFlags.none())
+        else:
+            super().__init__(intents=intents, chunk_guilds_at_startup=True)
 
-        super().__init__(intents=intents, chunk_guilds_at_startup=True)
+    async def on_connect(self):
+        """Connected to the gateway, logged in"""
+        startup.mark('discord_login')
 
     async def on_ready(self):
         """Init discord bot when ready, set the self.ready value"""
         logging.debug('We have logged in as %s', self.user)
+        # Ready once guilds have arrived, and been chunked with the full member cache
+        startup.mark('chunking')
         self.discord_channel_mapping = {}
         for channel in self.irc_to_discord_links:
             self.discord_channel_mapping[channel] = self.get_channel(
                 self.irc_to_discord_links[channel]) or \
                 await self.fetch_channel(self.irc_to_discord_links[channel])
+        startup.mark('channel_fetch')
 
         #asyncio.create_task(self.process_queue())
         self.loop.create_task(self.process_queue())
         self.loop.create_task(self.process_dm_queue())
+        if self.lag_task is None:
+            self.lag_task = self.loop.create_task(watchdog.watch_loop('discord'))
+        if self.activity_mode and self.activity_task is None:
+            self.activity_task = self.loop.create_task(self.watch_activity())
         self.ready = True
 
     def irc_safe_nickname(self, nickname: str) -> str:
@@ -124,15 +175,22 @@ class DiscordBot(discord.Client):
         if not self.ready:
             logging.debug("Discord not ready yet")
         channels =  await self.accessible_channels(user.id)
+        self.puppet_channels[user.id] = channels
         await self.send_irc_command(user, 'active', channels)
+        if self.member_cache is not None:
+            self.member_cache.pin(user)
 
         self.active_puppets.append(user.id)
+        self.registry.unregister('hibernated', user.id)
 
         await self.filters.compile_mention_lookup_re(user)
         logging.debug("%s is now active! (status: %s)", user.display_name, user.status)
 
     async def on_member_update(self, before: discord.Member, after: discord.Member):
         """Run on updates to members, check for display_name and role changes"""
+        traffic.record('member_update', user=after.id,
+                       name=before.display_name != after.display_name,
+                       roles=set(before.roles) != set(after.roles))
         # Check for displayname Change
         if before.display_name != after.display_name:
             self.active_puppets.remove(before.id)
@@ -147,14 +205,66 @@ class DiscordBot(discord.Client):
         before_roles = set(before.roles)
         after_roles = set(after.roles)
         if before_roles != after_roles:
-            channels =  await self.accessible_channels(after.id)
-            await self.send_irc_command(after, 'join_part', channels)
+            await self.queue_membership([after.id])
+
+    async def on_guild_role_update(self, before, after):
+        """Recompute channels for every member of a role when its permissions change"""
+        if before.permissions != after.permissions:
+            await self.queue_membership([member.id for member in after.members])
+
+    async def on_guild_role_delete(self, role):
+        """Recompute channels for all puppets when a role is deleted"""
+        logging.debug("role %s deleted, recomputing puppet channels", role.name)
+        await self.queue_membership(self.active_puppets)
+
+    async def on_guild_channel_update(self, before, after):
+        """Recompute channels for all puppets when a linked channel's overwrites change"""
+        linked = any(channel.id == after.id
+                     for channel in (self.discord_channel_mapping or {}).values())
+        if linked and before.overwrites != after.overwrites:
+            await self.queue_membership(self.active_puppets)
+
+    async def queue_membership(self, user_ids):
+        """
+        Queue puppets for channel recomputation. Requests are coalesced over the
+        membership window so a role storm sends at most one join_part per puppet.
+        """
+        active = set(self.active_puppets)
+        self.membership_pending.update(user_id for user_id in user_ids if user_id in active)
+
+        window = self.listener_config.get('membership_window', 0)
+        if not window:
+            await self.flush_membership()
+        elif self.membership_task is None:
+            self.membership_task = self.loop.create_task(self.flush_membership(window))
+
+    async def flush_membership(self, delay=0):
+        """Send join_part to queued puppets whose accessible channels changed"""
+        if delay:
+            await asyncio.sleep(delay)
+        pending = set(self.membership_pending)
+        self.membership_pending.clear()
+        self.membership_task = None
+
+        for user_id in pending:
+            try:
+                member = await self.find_member(user_id)
+            except discord.NotFound:
+                # Left the guild during the window
+                continue
+            channels = await self.accessible_channels(user_id, member)
+            if self.puppet_channels.get(user_id) == channels:
+                continue
+            self.puppet_channels[user_id] = channels
+            await self.send_irc_command(member, 'join_part', channels)
 
     async def on_presence_update(self, before, after):
         """Manage AFK vs UNAFK status for puppets"""
         # Make sure we are ready:
         if not self.ready:
             return
+        traffic.record('presence', user=after.id, before=str(before.status),
+                       after=str(after.status))
 
         # Check if the user went from offline or dnd to online or idle
         previously_inactive = before.status in (discord.Status.offline, discord.Status.dnd)
@@ -164,94 +274,297 @@ class DiscordBot(discord.Client):
 
         if previously_inactive and now_active:
             if after.id in self.active_puppets:
-                await self.send_irc_command(after, 'unafk')
+                await self.send_presence(after, 'unafk')
             else:
                 await self.activate_puppet(after)
         if previously_active and now_inactive:
             if after.id in self.active_puppets:
-                await self.send_irc_command(after, 'afk')
+                await self.send_presence(after, 'afk')
                 logging.debug("%s is now offline! (status: %s)", after.display_name, after.status)
 
-    async def send_irc_command(self, user, command, data=None, channel=None):
+    async def send_presence(self, user, command):
+        """
+        Send an afk/unafk command once the state has been stable for the
+        debounce window, flapping clients only send their final state
+        """
+        self.data.increment('presence_transitions')
+        debounce = self.listener_config.get('presence_debounce', 0)
+        if not debounce:
+            self.presence_state[user.id] = command
+            await self.send_irc_command(user, command)
+            return
+
+        pending = self.presence_pending.pop(user.id, None)
+        if pending:
+            pending.cancel()
+        # Flapped back to the state IRC already has
+        flapped_back = self.presence_state.get(user.id, 'unafk') == command
+        if pending or flapped_back:
+            # Once per flap, whether it cancelled a pending command or not
+            self.data.increment('presence_suppressed')
+        if flapped_back:
+            return
+
+        self.presence_pending[user.id] = self.loop.create_task(
+            self.flush_presence(user, command, debounce))
+
+    async def flush_presence(self, user, command, delay):
+        """Send a debounced presence command after it has been stable for delay seconds"""
+        await asyncio.sleep(delay)
+        del self.presence_pending[user.id]
+        self.presence_state[user.id] = command
+        await self.send_irc_command(user, command)
+
+    def clear_presence(self, user_id):
+        """Forget presence state for a user, cancelling any pending command"""
+        pending = self.presence_pending.pop(user_id, None)
+        if pending:
+            pending.cancel()
+        self.presence_state.pop(user_id, None)
+
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    async def send_irc_command(self, user, command, data=None, channel=None, trace=None):
         """Send a command to an IRC Puppet"""
         logging.debug('adding cmd to queue from discord: %s',command)
-        self.queues['puppet_queue'].put({
-            'nick': self.irc_safe_nickname(user.display_name),
-            'display_name': user.display_name,
-            'irc_nick': await self.generate_irc_nickname(user),
-            'name': user.name,
-            'id': user.id,
-            'channel': channel,
-            'command': command,
-            'data': data,
-            'timestamp': time.time()
-        })
+        mark(trace, 'puppet_queue')
+        self.queues['puppet_queue'].put(PuppetCommand(
+            command, user.id, await self.generate_irc_nickname(user), data, channel, trace))
         if command == 'send':
             self.data.increment('discord_messages')
+            self.data.increment(('discord_messages', self.irc_channel_name(channel)))
+
+    def irc_channel_name(self, channel_id):
+        """Find the IRC channel linked to a Discord channel id"""
+        for irc_channel, discord_channel in self.irc_to_discord_links.items():
+            if str(discord_channel) == str(channel_id):
+                return irc_channel
+        return str(channel_id)
 
     async def on_member_remove(self, member):
         """Run when member is removed or leaves guild"""
+        traffic.record('member_remove', user=member.id)
+        if self.member_cache is not None:
+            self.member_cache.remove(member)
+        self.registry.unregister('hibernated', member.id)
         if member.id in self.active_puppets:
-            # Update lookup table
-            self.active_puppets.remove(member.id)
-            irc_nick = await self.generate_irc_nickname(member)
-            try:
-                await self.filters.remove_from_mention_lookup(
-                    irc_nick + self.listener_config['puppet_suffix'])
-            except KeyError:
-                logging.warning("Could not remove %s from mention_lookup table",
-                                member.display_name)
-
-            await self.send_irc_command(member, 'die')
+            await self.deactivate_puppet(member)
             logging.debug("%s has left!", member.display_name)
 
+    async def deactivate_puppet(self, member, reason=None):
+        """Stop a member's IRC puppet, reason is its quit message"""
+        # Update lookup table
+        self.active_puppets.remove(member.id)
+        irc_nick = await self.generate_irc_nickname(member)
+        try:
+            await self.filters.remove_from_mention_lookup(
+                irc_nick + self.listener_config['puppet_suffix'])
+        except KeyError:
+            logging.warning("Could not remove %s from mention_lookup table",
+                            member.display_name)
+
+        self.clear_presence(member.id)
+        self.puppet_channels.pop(member.id, None)
+        self.membership_pending.discard(member.id)
+        self.last_active.pop(member.id, None)
+        await self.send_irc_command(member, 'die', reason)
+
+    @property
+    def activity_mode(self) -> bool:
+        """Whether puppet presence is inferred from messages, without presence updates"""
+        return self.listener_config.get('presence_mode') == 'activity'
+
+    async def note_activity(self, user):
+        """Record a message from a puppet's user, bringing the puppet back from away"""
+        self.last_active[user.id] = self.loop.time()
+        if self.presence_state.get(user.id) == 'afk':
+            self.data.increment('presence_transitions')
+            self.presence_state[user.id] = 'unafk'
+            await self.send_irc_command(user, 'unafk')
+
+    async def check_activity(self, now: float):
+        """Mark puppets away, or hibernate them, once their user has been quiet long enough"""
+        away_after = self.listener_config.get('away_after', 0)
+        hibernate_after = self.listener_config.get('hibernate_after', 0)
+        for user_id in list(self.active_puppets):
+            idle = now - self.last_active.setdefault(user_id, now)
+            hibernate = hibernate_after and idle >= hibernate_after
+            away = away_after and idle >= away_after and \
+                self.presence_state.get(user_id, 'unafk') != 'afk'
+            if not hibernate and not away:
+                continue
+            try:
+                member = await self.find_member(user_id)
+            except discord.NotFound:
+                # Left the guild without us seeing on_member_remove
+                self.forget_puppet(user_id)
+                continue
+            if hibernate:
+                await self.deactivate_puppet(member, 'hibernating, back when they talk')
+                # Only the time, the member may be evicted from a lean cache
+                self.registry.register('hibernated', user_id, now)
+                if self.member_cache is not None:
+                    self.member_cache.unpin(member)
+                logging.debug("%s is idle, hibernating puppet", member.display_name)
+            else:
+                self.data.increment('presence_transitions')
+                self.presence_state[user_id] = 'afk'
+                await self.send_irc_command(member, 'afk')
+
+    def forget_puppet(self, user_id: int):
+        """Stop tracking the activity of a puppet whose member can't be found"""
+        if user_id in self.active_puppets:
+            self.active_puppets.remove(user_id)
+        self.last_active.pop(user_id, None)
+        self.presence_state.pop(user_id, None)
+        logging.debug("%s is no longer in the guild, forgetting puppet", user_id)
+
+    async def watch_activity(self):
+        """Check puppet activity forever"""
+        intervals = [interval for interval in (self.listener_config.get('away_after', 0),
+                                               self.listener_config.get('hibernate_after', 0))
+                     if interval]
+        if not intervals:
+            return
+        while True:
+            await asyncio.sleep(min(intervals + [60]))
+            await self.check_activity(self.loop.time())
+
     async def process_queue(self):
         """Thread to process our incoming queue from IRC"""
+        pending = None
         while True:
         # Periodically check the queue and send messages
-            msg = None
+            msg = pending
+            pending = None
+            if msg is None:
+                try:
+                    msg = self.queues['irc_to_discord_queue'].get_nowait()
+                except asyncio.QueueEmpty:
+                    await asyncio.sleep(.01)
+                    continue
+
+            mark(msg.trace, 'queue')
+            if self.listener_config.get('coalesce_window', 0):
+                msg, pending = await self.coalesce_irc_messages(msg)
+                mark(msg.trace, 'coalesce')
+
+            await self.relay_to_discord(msg)
+            await asyncio.sleep(0.01)
+
+    async def coalesce_irc_messages(self, msg):
+        """
+        Merge lines quickly following msg from the same author to the same channel
+        into one Discord message. Returns the merged message and the next message
+        from the queue that could not be merged, if any.
+        """
+        window = self.listener_config['coalesce_window']
+        loop = asyncio.get_running_loop()
+        last = loop.time()
+        deadline = last + self.listener_config.get('coalesce_max_delay', window)
+        lines = [msg.content]
+        size = len(msg.content)
+        pending = None
+
+        while loop.time() < deadline and loop.time() - last < window:
             try:
-                msg = self.queues['irc_to_discord_queue'].get_nowait()
+                next_msg = self.queues['irc_to_discord_queue'].get_nowait()
             except asyncio.QueueEmpty:
-                await asyncio.sleep(.01)
+                await asyncio.sleep(0.01)
                 continue
 
-            channel = None
-
-            if msg['channel'] in self.discord_channel_mapping:
-                channel = self.discord_channel_mapping[msg['channel']]
-
-            if channel:
-                webhooks = await channel.webhooks()
-                webhook_name = 'CatPuppetBridge'
-                webhook = None
-                logging.debug("Searching for webhook")
-                for hook in webhooks:
-                    if hook.name == webhook_name:
-                        logging.debug("Reusing old webhook")
-                        webhook = hook
-                        break
-                if webhook is None:
-                    logging.debug("Creating new webhook")
-                    webhook = await channel.create_webhook(name='CatPuppetBridge')
+            if next_msg.author != msg.author or next_msg.channel != msg.channel \
+               or next_msg.error != msg.error \
+               or size + 1 + len(next_msg.content) > self.max_discord_message:
+                pending = next_msg
+                break
+            lines.append(next_msg.content)
+            size += 1 + len(next_msg.content)
+            last = loop.time()
+
+        if len(lines) > 1:
+            self.data.increment('coalesced_messages')
+        return msg._replace(content='\n'.join(lines)), pending
+
+    def split_discord_message(self, content):
+        """Split content into chunks that fit in a Discord message, preferring line breaks"""
+        chunks = []
+        while len(content) > self.max_discord_message:
+            cut = content.rfind('\n', 0, self.max_discord_message + 1)
+            if cut <= 0:
+                cut = self.max_discord_message
+            chunks.append(content[:cut])
+            content = content[cut:].lstrip('\n')
+        chunks.append(content)
+        return chunks
+
+    async def find_webhook(self, channel):
+        """Find or create the bridge webhook for a channel, cached after the first lookup"""
+        webhook_name = 'CatPuppetBridge'
+        if channel.id in self.webhooks:
+            return self.webhooks[channel.id]
+        if self.listener_config.get('dry_run'):
+            self.webhooks[channel.id] = DryRunWebhook(channel, self.data)
+            return self.webhooks[channel.id]
+
+        webhook = None
+        logging.debug("Searching for webhook")
+        for hook in await channel.webhooks():
+            if hook.name == webhook_name:
+                logging.debug("Reusing old webhook")
+                webhook = hook
+                break
+        if webhook is None:
+            logging.debug("Creating new webhook")
+            webhook = await channel.create_webhook(name=webhook_name)
+        self.webhooks[channel.id] = webhook
+        return webhook
+
+    async def relay_to_discord(self, msg):
+        """Send a message from IRC to its linked Discord channel through a webhook"""
+        channel = None
+
+        if msg.channel in self.discord_channel_mapping:
+            channel = self.discord_channel_mapping[msg.channel]
+
+        if not channel:
+            return
 
-                # detect mentions
-                processed_message = msg['content']
-                if self.filters.mention_lookup_re:
-                    processed_message = self.filters.lookup_mention(msg['content'])
-                # Detect Avatar
-                avatar = await self.find_avatar(msg['author'])
-                if avatar is None:
-                    avatar = 'https://robohash.org/' + msg['author'] + '?set=set4'
-                # Detect emojis
-                processed_message = await self.replace_emojis(processed_message)
+        webhook = await self.find_webhook(channel)
+
+        # detect mentions
+        processed_message = msg.content
+        if self.filters.mention_lookup_re:
+            processed_message = self.filters.lookup_mention(msg.content)
+        # Detect Avatar
+        avatar = await self.find_avatar(msg.author)
+        if avatar is None:
+            avatar = 'https://robohash.org/' + msg.author + '?set=set4'
+        # Detect emojis
+        processed_message = await self.replace_emojis(processed_message)
+        mark(msg.trace, 'filters')
+        for chunk in self.split_discord_message(processed_message):
+            try:
                 try:
-                    await webhook.send(processed_message, username=msg['author'],
-                                       avatar_url=avatar)
-                except discord.errors.HTTPException:
-                    logging.warning("HTTP Error sending webhook. Author: '%s' Message: '%s'",
-                                    msg['author'], processed_message)
-            await asyncio.sleep(0.01)
+                    await webhook.send(chunk, username=msg.author, avatar_url=avatar)
+                except discord.errors.NotFound:
+                    logging.warning("Webhook for channel '%s' is gone, recreating it", channel)
+                    self.webhooks.pop(channel.id, None)
+                    # Retry once, a webhook gone again is given up on below
+                    webhook = await self.find_webhook(channel)
+                    await webhook.send(chunk, username=msg.author, avatar_url=avatar)
+            except discord.errors.NotFound:
+                logging.warning("Recreated webhook for channel '%s' is gone too, dropping "
+                                "message from '%s'", channel, msg.author)
+                self.webhooks.pop(channel.id, None)
+                return
+            except discord.errors.HTTPException as e:
+                if e.status == 429:
+                    self.data.increment('webhook_rate_limits')
+                logging.warning("HTTP Error sending webhook. Author: '%s' Message: '%s'",
+                                msg.author, chunk)
+                return
+        mark(msg.trace, 'discord_send')
+        record_trace(self.data, 'irc_to_discord', msg.trace)
 
     async def process_dm_queue(self):
         """Thread to process our incoming dm_queue from IRC private messages"""
@@ -265,20 +578,20 @@ class DiscordBot(discord.Client):
                 await asyncio.sleep(0.01)
                 continue
 
-            if 'channel' in msg:
-                user = await self.fetch_user(msg['channel'])
+            if msg.channel is not None:
+                user = await self.fetch_user(msg.channel)
             if user:
                 # detect mentions
-                processed_message = msg['content']
+                processed_message = msg.content
                 if self.filters.mention_lookup_re:
                     processed_message = self.filters.mention_lookup_re.sub(
                         lambda match: self.filters.mention_lookup[match.group(0)].mention,
-                        msg['content'])
-                    if not msg['error']:
-                        processed_message = 'Message from ' + msg['author'] + ': ' +\
+                        msg.content)
+                    if not msg.error:
+                        processed_message = 'Message from ' + msg.author + ': ' +\
                             processed_message
                 try:
-                    await user.send(processed_message)
+                    await self.send_dm(user, processed_message)
                 except discord.errors.HTTPException as e:
                     logging.debug(user)
                     logging.debug(processed_message)
@@ -287,6 +600,13 @@ class DiscordBot(discord.Client):
 
             await asyncio.sleep(0.01)
 
+    async def send_dm(self, user, content):
+        """Send a direct message to a Discord user, or record it in a dry run"""
+        if self.listener_config.get('dry_run'):
+            record_send(self.data, 'discord', user.id, content)
+            return
+        await user.send(content)
+
     async def replace_emojis(self, processed_message):
         """ Replace strings like :heart: with their unicode emoji, or discord custom emoji """
         def replace(match):
@@ -294,8 +614,8 @@ class DiscordBot(discord.Client):
             for discord_emoji in self.emojis:
                 if discord_emoji.name == found_emoji:
                     return str(discord_emoji)
-            unicode_emoji = emoji.emojize(f":{found_emoji}:", language='alias')
-            if unicode_emoji != f":{found_emoji}:":
+            unicode_emoji = emojize(found_emoji)
+            if unicode_emoji:
                 return unicode_emoji
 
             # Fallback if not found
@@ -303,10 +623,33 @@ class DiscordBot(discord.Client):
 
         return re.sub(r":([a-zA-Z0-9_]+):", replace, processed_message)
 
+    async def find_member(self, user_id: int, member=None):
+        """
+        Find a guild member in the cache, else use member if given (eg/ a
+        message author) or fetch them. The lean member cache keeps them.
+        """
+        guild = self.guilds[0]
+        if self.member_cache is None:
+            return guild.get_member(user_id) or member or await guild.fetch_member(user_id)
+
+        cached = self.member_cache.get(guild, user_id)
+        if cached is not None:
+            self.member_cache.count('hit')
+            return cached
+        if member is None:
+            self.member_cache.count('fetch')
+            member = await guild.fetch_member(user_id)
+        self.member_cache.add(member)
+        return member
+
     async def find_avatar(self, user):
         """Find an avatar if user exists on irc and discord"""
         logging.debug("Attemping to find avatar")
-        members = self.guilds[0].members
+        if self.member_cache is not None:
+            # Only cached members, recent talkers first
+            members = self.member_cache.members(self.guilds[0])
+        else:
+            members = self.guilds[0].members
         for member in members:
             if user == member.display_name:
                 if member.avatar:
@@ -315,9 +658,10 @@ class DiscordBot(discord.Client):
         logging.debug("No avatar found for %s", user)
         return None
 
-    async def accessible_channels(self, user_id: int):
-        """Find out what channels a puppet can see"""
-        member = self.guilds[0].get_member(user_id) or await self.guilds[0].fetch_member(user_id)
+    async def accessible_channels(self, user_id: int, member=None):
+        """Find out what channels a puppet can see, member saves looking them up"""
+        if member is None:
+            member = await self.find_member(user_id)
 
         if not member:
             return []
@@ -432,7 +776,8 @@ class DiscordBot(discord.Client):
         reply = ''
         split_msg = message.content.split()
         command = split_msg[0] if len(split_msg) >= 1 else None
-        logging.debug(message)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(message)
 
         if message.author.id in self.sessions and command != 'sessionend':
             await self.send_irc_command(dm_user, 'send_dm', message.content,
@@ -453,14 +798,15 @@ class DiscordBot(discord.Client):
             reply = 'Command not found, try using the command `help` for more information.'
         try:
             if reply:
-                await dm_user.send(reply)
+                await self.send_dm(dm_user, reply)
         except discord.errors.HTTPException as e:
             logging.error(e)
 
     async def on_message(self, message):
         """Run when messages are read from discord"""
 
-        logging.debug(message)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(message)
         # Make sure we are ready first
         if not self.ready:
             return
@@ -468,13 +814,21 @@ class DiscordBot(discord.Client):
         if message.author.bot and message.webhook_id is not None or \
            message.author.id == self.user.id:
             return
+        trace = start_trace('discord', message.channel.id, message.author.id, message.id)
+        if traffic.enabled:
+            traffic.record('discord_msg', user=message.author.id,
+                           channel=self.irc_channel_name(message.channel.id),
+                           text=message.content, attachments=len(message.attachments),
+                           dm=isinstance(message.channel, discord.DMChannel))
 
-        user = self.guilds[0].get_member(message.author.id)
-        if not user:
-            user = await self.guilds[0].fetch_member(message.author.id)
+        # Guild messages carry their author's member, saving a fetch when not cached
+        author = message.author if isinstance(message.author, discord.Member) else None
+        user = await self.find_member(message.author.id, author)
 
         if user.id not in self.active_puppets:
             await self.activate_puppet(user)
+        if self.activity_mode:
+            await self.note_activity(user)
 
         if isinstance(message.channel, discord.DMChannel):
             logging.debug("Discord bot received a DM, processing")
@@ -482,8 +836,11 @@ class DiscordBot(discord.Client):
             return
 
         content, attach = await self.parse_message_content(message)
+        mark(trace, 'filters')
 
         if attach:
-            await self.send_irc_command(message.author, 'send', attach, message.channel.id)
+            await self.send_irc_command(message.author, 'send', attach, message.channel.id,
+                                        list(trace))
         if content and content != attach:
-            await self.send_irc_command(message.author, 'send', content, message.channel.id)
+            await self.send_irc_command(message.author, 'send', content, message.channel.id,
+                                        trace)
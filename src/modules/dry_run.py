@@ -0,0 +1,63 @@
+"""
+This file is part of CatPuppetBridge.
+
+CatPuppetBridge is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+CatPuppetBridge is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+CatPuppetBridge. If not, see <https://www.gnu.org/licenses/>.
+
+Copyright (C) 2025 Lisa Marie Maginnis
+
+Stand-ins for the network writes of a dry run bridge
+"""
+
+import logging
+
+from modules.flight_recorder import recorder
+from modules.registry import CountingConnection
+
+def record_send(data, platform: str, target, content: str):
+    """ Record a message a dry run would have sent """
+    recorder.record('dry_run', platform, target, content)
+    if data:
+        data.increment(('dry_run_sends', platform))
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("dry run, not sending to %s %s: %s", platform, target, content)
+
+class DryRunConnection(CountingConnection):
+    """
+    Puppet connection which never connects. Lines are built, validated and
+    counted as usual, then recorded instead of written to a socket.
+    """
+
+    def __init__(self, reactor, nickname: str, data=None):
+        super().__init__(reactor)
+        self.real_nickname = nickname
+        self.data = data
+
+    def send_raw(self, string):
+        self._prep_message(string)
+        if string.startswith('NICK '):
+            self.real_nickname = string[5:]
+        record_send(self.data, 'irc', self.real_nickname, string)
+
+class DryRunWebhook():
+    """ Discord webhook recording what it would have posted """
+    # pylint: disable=too-few-public-methods
+    name = 'CatPuppetBridge'
+
+    def __init__(self, channel, data=None):
+        self.channel = channel
+        self.data = data
+
+    async def send(self, content, username=None, avatar_url=None):
+        """ Record a message instead of posting it """
+        # pylint: disable=unused-argument
+        record_send(self.data, 'discord', f"{self.channel}/{username}", content)
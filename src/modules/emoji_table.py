@@ -0,0 +1,41 @@
+"""
+This file is part of CatPuppetBridge.
+
+CatPuppetBridge is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+CatPuppetBridge is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+CatPuppetBridge. If not, see <https://www.gnu.org/licenses/>.
+
+Copyright (C) 2025 Lisa Marie Maginnis
+
+Emoji shortcode table, precomputed from the emoji package
+
+The table holds what emoji.emojize(language='alias') gives for every
+shortcode replace_emojis can match. Rebuild it after upgrading emoji with
+`make emoji-table`, which runs tools/emoji_table.py.
+"""
+
+import functools
+import os
+import re
+
+SHORTCODES_FILE = os.path.join(os.path.dirname(__file__), 'emoji_shortcodes.txt')
+# Shortcodes replace_emojis looks up, without the colons
+SHORTCODE_RE = re.compile(r'[a-zA-Z0-9_]+')
+
+@functools.lru_cache(maxsize=None)
+def shortcodes() -> dict:
+    """ Shortcode to emoji, read from the table on first use """
+    with open(SHORTCODES_FILE, encoding='utf8') as table:
+        return dict(line.rstrip('\n').split(' ', 1) for line in table)
+
+def emojize(shortcode: str):
+    """ The emoji for a shortcode, without colons, or None """
+    return shortcodes().get(shortcode)
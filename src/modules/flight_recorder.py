@@ -0,0 +1,74 @@
+"""
+This file is part of CatPuppetBridge.
+
+CatPuppetBridge is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+CatPuppetBridge is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+CatPuppetBridge. If not, see <https://www.gnu.org/licenses/>.
+
+Copyright (C) 2025 Lisa Marie Maginnis
+
+In-memory ring buffer of recent bridge events, dumped for post-mortems
+"""
+
+import logging
+import os
+import time
+from collections import deque
+from datetime import datetime
+
+class FlightRecorder():
+    """
+    Fixed size ring of (time, kind, fields) tuples. Recording is a single
+    deque append, which is thread safe and drops the oldest event when full.
+    Formatting only happens when the ring is dumped.
+    """
+
+    def __init__(self, size: int = 10000):
+        self.events = deque(maxlen=size)
+
+    def resize(self, size: int):
+        """ Change how many events are kept, keeping the newest """
+        self.events = deque(self.events, maxlen=size)
+
+    def record(self, kind: str, *fields):
+        """ Record an event """
+        self.events.append((time.time(), kind, fields))
+
+    def lines(self) -> list:
+        """ Format the recorded events, oldest first """
+        lines = []
+        for timestamp, kind, fields in list(self.events):
+            when = datetime.fromtimestamp(timestamp).isoformat(timespec='milliseconds')
+            lines.append(' '.join([when, kind] + [str(field) for field in fields]))
+        return lines
+
+    def dump(self, directory) -> str:
+        """ Write the recorded events to a new file in directory, returns its path """
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory,
+                            time.strftime('catpuppetbridge-%Y%m%d-%H%M%S.events'))
+        lines = self.lines()
+        with open(path, 'w', encoding='utf8') as output:
+            output.write('\n'.join(lines) + '\n')
+        logging.info("dumped %i bridge events to %s", len(lines), path)
+        return path
+
+class RecorderHandler(logging.Handler):
+    """ Copy warnings and errors from the log into the flight recorder """
+
+    def __init__(self, flight_recorder, level=logging.WARNING):
+        super().__init__(level)
+        self.flight_recorder = flight_recorder
+
+    def emit(self, record):
+        self.flight_recorder.record(record.levelname.lower(), record.name, record.getMessage())
+
+recorder = FlightRecorder()
@@ -26,20 +26,136 @@ import time
 import re
 import os
 import ssl
+import tempfile
+import fnmatch
 from datetime import timedelta
 import asyncio
 
-import psutil
 import irc.bot
 import irc.client
 import irc.strings
 from irc.connection import Factory
 
+from modules.tracing import STAGES, start_trace, mark, record_trace
+from modules.stats_data import histogram_percentile
+from modules.profiler import SamplingProfiler
+from modules.registry import CountingReactor, registry
+from modules.watchdog import watchdog
+from modules.thread_stats import accounting
+from modules.dry_run import DryRunConnection
+from modules.flight_recorder import recorder
+from modules.records import RelayMessage
+from modules.traffic_recorder import traffic
+from modules.startup import startup
+
+def chunk_channels(command: str, channels: list, max_bytes: int = 512) -> list:
+    """ Join channels into comma separated lists which fit in a single IRC line """
+    # command + space + CRLF
+    limit = max_bytes - len(command.encode('utf8')) - 3
+    chunks = []
+    current = []
+    size = 0
+    for channel in channels:
+        length = len(channel.encode('utf8'))
+        if current and size + 1 + length > limit:
+            chunks.append(','.join(current))
+            current = []
+            size = 0
+        size += length + (1 if current else 0)
+        current.append(channel)
+    if current:
+        chunks.append(','.join(current))
+    return chunks
+
+# pylint: disable=too-few-public-methods
+class FloodControl():
+    """ Token bucket limiting how fast a puppet writes lines to IRC """
+
+    def __init__(self, burst: int, rate: float):
+        self.burst = burst
+        self.rate = rate
+        self.tokens = burst
+        self.last = time.monotonic()
+        # Lines currently held back, and total seconds spent holding lines back
+        self.waiting = 0
+        self.delayed = 0.0
+
+    def wait(self):
+        """ Block until a line can be sent without flooding """
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens < 1:
+            delay = (1 - self.tokens) / self.rate
+            self.waiting += 1
+            time.sleep(delay)
+            self.waiting -= 1
+            self.delayed += delay
+            self.last = time.monotonic()
+            self.tokens = 1
+        self.tokens -= 1
+
+class MembershipAggregator():
+    """
+    Collect join/part/quit/nick events per channel and turn them into one line
+    per channel, summarising bursts such as netsplits instead of listing them
+    """
+    netsplit_re = re.compile(r'^\S+\.\S+ \S+\.\S+$')
+    verbs = {'join': 'joined', 'part': 'left', 'quit': 'quit', 'nick': 'changed nick'}
+
+    def __init__(self, threshold: int = 3):
+        self.threshold = threshold
+        self.events = {}
+
+    def add(self, channel: str, kind: str, nick: str, detail: str = ''):
+        """ Record a membership event for a channel """
+        self.events.setdefault(channel, []).append((kind, nick, detail))
+
+    def describe(self, kind: str, nick: str, detail: str) -> str:
+        """ Describe a single membership event """
+        match kind:
+            case 'join':
+                return f"{nick} has joined"
+            case 'nick':
+                return f"{nick} is now known as {detail}"
+        reason = f" ({detail})" if detail else ''
+        return f"{nick} has {self.verbs[kind]}{reason}"
+
+    def summarise(self, kind: str, events: list) -> str:
+        """ Summarise a burst of the same kind of event """
+        line = f"{len(events)} users {self.verbs[kind]}"
+        if kind == 'quit' and all(self.netsplit_re.match(detail) for _, _, detail in events):
+            line += " (netsplit)"
+        return line
+
+    def flush(self) -> list:
+        """ Return (channel, line) pairs for all collected events and reset """
+        lines = []
+        for channel, events in self.events.items():
+            parts = []
+            for kind in self.verbs:
+                same_kind = [event for event in events if event[0] == kind]
+                if len(same_kind) >= self.threshold:
+                    parts.append(self.summarise(kind, same_kind))
+                else:
+                    parts.extend(self.describe(*event) for event in same_kind)
+            lines.append((channel, '; '.join(parts)))
+        self.events = {}
+        return lines
+
+# pylint: disable=too-many-instance-attributes
 class BotTemplate(irc.bot.SingleServerIRCBot):
     """ Shared IRC Bot functionality """
     log = None
     reconnect_data = None
     ready = False
+    data = None
+    reconnects = 0
+    reactor_class = CountingReactor
+    registry = registry
+    watchdog = watchdog
 
     # pylint: disable=super-init-not-called
     def __init__(self):
@@ -49,17 +165,12 @@ class BotTemplate(irc.bot.SingleServerIRCBot):
 
         self.dcc_connections = []
         self.log = logging.getLogger(self.__class__.__name__)
+        self.reactor.add_global_handler("error", self.on_error)
 
     # pylint: disable=too-many-arguments,too-many-positional-arguments
     async def send_to_discord(self, author, channel, content, queue, error=False):
         """ Add events to the discord out queue """
-        data = {
-            'author': author,
-            'channel': channel,
-            'content': content,
-            'error': error
-        }
-
+        data = RelayMessage(author, channel, content, error, start_trace('irc', channel, author))
         await queue.put(data)
 
     def connect_and_retry(self, server: str, port: int, nickname: str, tls: bool = False):
@@ -117,11 +228,24 @@ class BotTemplate(irc.bot.SingleServerIRCBot):
                     retry_count = retry_count + 1
                     time.sleep(delay)
 
+        recorder.record('connected', self.__class__.__name__, nickname)
         self.connection.add_global_handler("disconnect", self.on_disconnect)
 
+    def on_error(self, c, e):
+        """ Count ERROR lines from the server which close us for flooding """
+        self.log.debug("conext %s", c)
+        message = ' '.join(str(argument) for argument in e.arguments)
+        self.log.warning("server error: %s", message)
+        if self.data and 'flood' in message.lower():
+            self.data.increment(('irc_flood_disconnects', self.__class__.__name__))
+
     def on_disconnect(self, c, e):
         """ When disconnected, try to reconnect """
         self.log.debug("event %s context %s", e, c)
+        recorder.record('disconnect', self.__class__.__name__, self.connection.get_nickname())
+        self.reconnects += 1
+        if self.data:
+            self.data.increment(('irc_reconnects', self.__class__.__name__))
         self.connect_and_retry(self.reconnect_data['server'], self.reconnect_data['port'],
                                self.reconnect_data['nickname'], self.reconnect_data['tls'])
 
@@ -135,10 +259,16 @@ class IRCPuppet(BotTemplate):
     end_thread = False
     queue_thread = None
     discord_id = None
+    flood = None
+    away = False
+    last_activity = 0
+    watchdog_name = None
 
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
     def __init__(self, queues, discord_to_irc_links, puppet_config,
-                 config):
+                 config, data=None):
         super().__init__()
+        self.data = data
 
         # TODO: ircname
         self.discord_id = puppet_config['discord_id']
@@ -150,23 +280,35 @@ class IRCPuppet(BotTemplate):
         self.config.update(puppet_config)
         self.config['webirc_hostname'] = 'discord.bridge'
         self.end_thread = False
+        self.flood = FloodControl(self.config.get('flood_burst', 10),
+                                  self.config.get('flood_rate', 0))
+        self.last_activity = time.time()
+        self.registry.register('puppets', self.discord_id, self)
+        self.watchdog_name = 'puppet:' + self.config['nickname']
+
+        if self.config.get('dry_run'):
+            # Do everything up to the socket write, as if the server welcomed us
+            self.connection = DryRunConnection(self.reactor, self.config['nickname'], data)
+            self.on_welcome(self.connection, None)
+        else:
+            self.connect_and_retry(self.config['server'], self.config['port'],
+                                   self.config['nickname'], self.config['tls'])
 
-        self.connect_and_retry(self.config['server'], self.config['port'], self.config['nickname'],
-                               self.config['tls'])
-
-        self.connection.send_raw(
-                f"WEBIRC {self.config['webirc_password']} {self.config['webirc_hostname']}"
-                f" {self.config['webirc_hostname']} {self.config['webirc_ip']}"
-            )
+            self.connection.send_raw(
+                    f"WEBIRC {self.config['webirc_password']} {self.config['webirc_hostname']}"
+                    f" {self.config['webirc_hostname']} {self.config['webirc_ip']}"
+                )
 
-        self.connection.add_global_handler("welcome", self.on_welcome)
-        self.connection.add_global_handler("privmsg", self.on_privmsg)
-        self.connection.add_global_handler("all_raw_messages", self.on_raw)
+            self.connection.add_global_handler("welcome", self.on_welcome)
+            self.connection.add_global_handler("privmsg", self.on_privmsg)
+            self.connection.add_global_handler("all_raw_messages", self.on_raw)
+        self.watchdog.watch_reactor(self.watchdog_name, self.reactor)
 
     def on_raw(self, c, event):
         """ Process special messages such has 401/NOSUCHNICK """
-        self.log.debug(event)
-        self.log.debug(c)
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug(event)
+            self.log.debug(c)
         data = event.arguments[0]
         split_data = data.split()
         if len(split_data) >= 4:
@@ -189,19 +331,30 @@ class IRCPuppet(BotTemplate):
 
         channel = self.discord_id
         content = event.arguments[0]
+        traffic.record('irc_dm', user=nickname, target=channel, text=content)
 
         asyncio.run(self.send_to_discord(nickname, channel, content, self.queues['out_queue']))
 
     def do_send(self, msg):
         """ Handle sending messages from discord """
-        if msg['data'] is None:
+        if msg.data is None:
             return
         self.log.debug("Found send, sending from puppet %s", self.config['nickname'])
+        if str(msg.channel) not in self.discord_to_irc_links:
+            return
         messages = self.split_irc_message(msg)
         for message in messages:
-            if str(msg['channel']) in self.discord_to_irc_links.keys():
-                self.connection.privmsg(
-                    self.discord_to_irc_links[str(msg['channel'])], message)
+            self.throttle()
+            self.connection.privmsg(
+                self.discord_to_irc_links[str(msg.channel)], message)
+        trace = msg.trace
+        mark(trace, 'irc_send')
+        record_trace(self.data, 'discord_to_irc', trace)
+
+    def throttle(self):
+        """ Wait for flood control before writing a line to IRC """
+        if self.flood:
+            self.flood.wait()
 
     def process_discord_queue(self):
         """Main worker thread for handling commands form discord"""
@@ -209,56 +362,80 @@ class IRCPuppet(BotTemplate):
         for msg in iter(self.queues['in_queue'].get, sentinel):
             while not self.ready:
                 time.sleep(1)
+            mark(msg.trace, 'inbox')
+            self.last_activity = time.time()
 
             self.log.debug("Processing command %s", msg)
-            match msg['command']:
+            match msg.command:
                 case 'send':
                     self.do_send(msg)
                 case 'afk':
+                    self.throttle()
                     self.afk()
                 case 'unafk':
+                    self.throttle()
                     self.unafk()
                 case 'nick':
-                    self.config['nickname'] = msg['irc_nick']
-                    self.connection.nick(msg['irc_nick'])
+                    self.throttle()
+                    self.config['nickname'] = msg.irc_nick
+                    self.connection.nick(msg.irc_nick)
                 case 'join_part':
-                    self.join_part(msg['data'])
+                    self.join_part(msg.data)
                 case 'send_dm':
                     messages = self.split_irc_message(msg)
                     for message in messages:
-                        self.connection.privmsg(msg['channel'], message)
+                        self.throttle()
+                        self.connection.privmsg(msg.channel, message)
                 case 'die':
                     self.end_thread = True
-                    self.end('has left discord')
+                    self.end(msg.data or 'has left discord')
                 case _:
-                    self.log.error("ERROR: Queue command '%s' not found!", msg['command'])
+                    self.log.error("ERROR: Queue command '%s' not found!", msg.command)
+
+    @property
+    def state(self) -> str:
+        """ Current state of the puppet, for admin commands """
+        if not self.ready:
+            return 'connecting'
+        return 'away' if self.away else 'ready'
 
     def join_part(self, channels):
-        """Manage part and join commands from discord"""
-        for channel in channels:
-            if channel not in self.channels:
-                self.log.debug("Puppet Joining %s", self.discord_to_irc_links[str(channel)])
-                self.connection.join(self.discord_to_irc_links[str(channel)])
-        for channel in self.channels:
-            if channel not in channels:
-                self.log.debug("Puppet Parting %s", self.discord_to_irc_links[str(channel)])
-                self.connection.part(self.discord_to_irc_links[str(channel)])
+        """Manage part and join commands from discord, batching channels per line"""
+        current = set(self.channels)
+        wanted = set(channels)
+        joins = [self.discord_to_irc_links[str(channel)]
+                 for channel in channels if channel not in current]
+        parts = [self.discord_to_irc_links[str(channel)]
+                 for channel in self.channels if channel not in wanted]
+
+        for chunk in chunk_channels('JOIN', joins):
+            self.log.debug("Puppet Joining %s", chunk)
+            self.throttle()
+            self.connection.join(chunk)
+        for chunk in chunk_channels('PART', parts):
+            self.log.debug("Puppet Parting %s", chunk)
+            self.throttle()
+            self.connection.part(chunk)
         self.channels = channels
 
     def on_welcome(self, c, e):
         """On IRCd welcome, join channels and start worker thread"""
         self.log.debug("event %s", e)
 
-        for channel in self.channels:
-            self.log.debug("Puppet Joining %s", self.discord_to_irc_links[str(channel)])
-            c.join(self.discord_to_irc_links[str(channel)])
+        joins = [self.discord_to_irc_links[str(channel)] for channel in self.channels]
+        for chunk in chunk_channels('JOIN', joins):
+            self.log.debug("Puppet Joining %s", chunk)
+            c.join(chunk)
         #self.reactor.scheduler.execute_every(1, self.process_discord_queue)
         if not self.queue_thread:
             self.log.debug("starting process_discord_queue thread from puppet")
-            self.queue_thread = threading.Thread(target=self.process_discord_queue, daemon=True)
+            self.queue_thread = threading.Thread(target=self.process_discord_queue,
+                                                 name='puppet-inbox:' + self.config['nickname'],
+                                                 daemon=True)
             self.queue_thread.start()
         c.mode(c.get_nickname(), "+R")
         self.ready = True
+        startup.mark('first_puppet_ready')
 
     def msg_reserved_bytes(self, target):
         """Calculate the amount of bytes reserved for IRC protocol"""
@@ -271,10 +448,10 @@ class IRCPuppet(BotTemplate):
         """
         Splits a message into IRC-safe chunks.
         """
-        max_bytes = 512 - self.msg_reserved_bytes(msg['channel'])
+        max_bytes = 512 - self.msg_reserved_bytes(msg.channel)
         lines = []
         count = 0
-        message = msg['data']
+        message = msg.data
         #TODO: split into multiple messages maybe?
         message = re.sub(r'[\r\n]+', '', message)
         while len(message[:max_bytes]) != 0:
@@ -307,12 +484,14 @@ class IRCPuppet(BotTemplate):
 
     def afk(self):
         """Mark nickname as afk"""
+        self.away = True
         self.connection.send_raw(
             "AWAY User is away on discord"
         )
 
     def unafk(self):
         """Remove AFK marking"""
+        self.away = False
         self.connection.send_raw(
             "AWAY"
         )
@@ -320,6 +499,8 @@ class IRCPuppet(BotTemplate):
     def end(self, msg):
         """Kill ourself"""
         self.log.debug('IRC Puppet dying, %s', self.config['nickname'])
+        self.registry.unregister('puppets', self.discord_id, self)
+        self.watchdog.forget(self.watchdog_name)
         self.connection.disconnect(msg)
         sys.exit(0)
 
@@ -328,6 +509,9 @@ class IRCListener(BotTemplate):
     out_queue = None
     config = None
     channels = None
+    members = None
+    membership = None
+    membership_scheduled = False
 
     def __init__(self, out_queue, config, data):
         super().__init__()
@@ -339,11 +523,22 @@ class IRCListener(BotTemplate):
                                self.config['tls'])
 
         self.out_queue = out_queue
+        self.registry.register('connections', 'listener', self)
+        self.watchdog.watch_reactor('listener', self.reactor)
         self.connection.add_global_handler("welcome", self.on_welcome)
         self.connection.add_global_handler("pubmsg", self.on_pubmsg)
         self.connection.add_global_handler("action", self.on_action)
 
         self.channels = config['channels']
+        self.members = {}
+        if config.get('relay_membership'):
+            self.membership = MembershipAggregator()
+            self.connection.add_global_handler("namreply", self.on_namreply)
+            self.connection.add_global_handler("join", self.on_join)
+            self.connection.add_global_handler("part", self.on_part)
+            self.connection.add_global_handler("kick", self.on_kick)
+            self.connection.add_global_handler("quit", self.on_quit)
+            self.connection.add_global_handler("nick", self.on_nick)
 
     def on_welcome(self, c, e):
         """On IRCd welcome, join channels"""
@@ -363,8 +558,11 @@ class IRCListener(BotTemplate):
 
         if not nickname.endswith(self.config['puppet_suffix']):
             self.log.debug("Irc message found, adding to queue")
+            traffic.record('irc_action', user=nickname, channel=event.target,
+                           text=event.arguments[0])
             asyncio.run(self.send_to_discord(nickname, event.target, content, self.out_queue))
             self.data.increment('irc_messages')
+            self.data.increment(('irc_messages', event.target))
 
     def on_pubmsg(self, c, event):
         """On public messages, relay to discord"""
@@ -372,10 +570,86 @@ class IRCListener(BotTemplate):
         nickname = event.source.split('!', 1)[0]
         if not nickname.endswith(self.config['puppet_suffix']):
             self.log.debug("Irc message found, adding to queue")
+            traffic.record('irc_msg', user=nickname, channel=event.target,
+                           text=event.arguments[0])
 
             asyncio.run(self.send_to_discord(nickname, event.target,
                                              event.arguments[0], self.out_queue))
             self.data.increment('irc_messages')
+            self.data.increment(('irc_messages', event.target))
+
+    def relayed_nick(self, nickname: str) -> bool:
+        """ Check if membership changes of a nickname should be relayed """
+        return not nickname.endswith(self.config['puppet_suffix']) and \
+            nickname != self.config['listener_nickname']
+
+    def on_namreply(self, c, event):
+        """Track who is in a channel when joining it"""
+        self.log.debug("conext %s", c)
+        channel = event.arguments[1]
+        names = {name.lstrip('~&@%+') for name in event.arguments[2].split()}
+        self.members.setdefault(channel, set()).update(names)
+
+    def on_join(self, c, event):
+        """Queue a relayed join"""
+        self.log.debug("conext %s", c)
+        nickname = event.source.split('!', 1)[0]
+        self.members.setdefault(event.target, set()).add(nickname)
+        self.queue_membership(event.target, 'join', nickname)
+
+    def on_part(self, c, event):
+        """Queue a relayed part"""
+        self.log.debug("conext %s", c)
+        nickname = event.source.split('!', 1)[0]
+        self.members.get(event.target, set()).discard(nickname)
+        reason = event.arguments[0] if event.arguments else ''
+        self.queue_membership(event.target, 'part', nickname, reason)
+
+    def on_kick(self, c, event):
+        """Queue a relayed kick as a part"""
+        self.log.debug("conext %s", c)
+        nickname = event.arguments[0]
+        self.members.get(event.target, set()).discard(nickname)
+        self.queue_membership(event.target, 'part', nickname, 'kicked')
+
+    def on_quit(self, c, event):
+        """Queue a relayed quit for every channel the user was in"""
+        self.log.debug("conext %s", c)
+        nickname = event.source.split('!', 1)[0]
+        reason = event.arguments[0] if event.arguments else ''
+        for channel, members in self.members.items():
+            if nickname in members:
+                members.discard(nickname)
+                self.queue_membership(channel, 'quit', nickname, reason)
+
+    def on_nick(self, c, event):
+        """Queue a relayed nick change for every channel the user is in"""
+        self.log.debug("conext %s", c)
+        nickname = event.source.split('!', 1)[0]
+        new_nickname = event.target
+        for channel, members in self.members.items():
+            if nickname in members:
+                members.discard(nickname)
+                members.add(new_nickname)
+                self.queue_membership(channel, 'nick', nickname, new_nickname)
+
+    def queue_membership(self, channel, kind, nickname, detail=''):
+        """Add a membership event to the aggregation window"""
+        if not self.relayed_nick(nickname):
+            return
+        self.membership.add(channel, kind, nickname, detail)
+        self.data.increment('irc_membership_events')
+        if not self.membership_scheduled:
+            self.membership_scheduled = True
+            self.reactor.scheduler.execute_after(self.config.get('membership_window', 5),
+                                                 self.flush_membership)
+
+    def flush_membership(self):
+        """Relay one aggregated line per channel to discord"""
+        self.membership_scheduled = False
+        for channel, line in self.membership.flush():
+            asyncio.run(self.send_to_discord('IRC', channel, '*' + line + '*', self.out_queue))
+            self.data.increment('irc_membership_relayed')
 
     def start(self):
         """Start the irc loop, forever"""
@@ -387,13 +661,35 @@ class IRCBot(BotTemplate):
 
     channels = None
     stats_data = None
+    profiler = None
+    profile_run = 0
+    profile_directory = None
+    dump_directory = None
+    # Longest timed profile, and the number of functions to reply with
+    max_profile_seconds = 600
+    profile_top = 10
+    # Most puppets or connections listed individually by admin commands
+    report_limit = 10
+    # Commands which write files or load the bridge, for the bot channel and admins only
+    admin_commands = ('dump', 'profile')
+    admins = ()
+    # Seconds between flight recorder dumps
+    dump_interval = 60
+    last_dump = None
 
     def __init__(self, config, data):
         super().__init__()
         self.connect_and_retry(config['server'], config['port'], config['bot_nickname'],
                                config['tls'])
         self.channel = config['bot_channel']
+        self.admins = config.get('bot_admins', ())
         self.stats_data = data
+        self.data = data
+        self.profiler = SamplingProfiler()
+        self.profile_directory = config.get('profile_directory') or tempfile.gettempdir()
+        self.dump_directory = config.get('flight_recorder_directory') or tempfile.gettempdir()
+        self.registry.register('connections', 'bot', self)
+        self.watchdog.watch_reactor('bot', self.reactor)
         self.connection.add_global_handler("welcome", self.on_welcome)
         self.connection.add_global_handler("pubmsg", self.on_pubmsg)
         self.connection.add_global_handler("privmsg", self.on_privmsg)
@@ -428,12 +724,179 @@ class IRCBot(BotTemplate):
         elapsed = time.time() - start_time
         return str(timedelta(seconds=int(elapsed)))
 
+    def rate_report(self) -> list:
+        """ Build 1m/5m/15m message rate lines for each relay direction """
+        rates = self.stats_data.rates()
+        lines = []
+        for key, label in (('discord_messages', 'Discord'), ('irc_messages', 'IRC')):
+            meter = [rate * 60 for rate in rates.get(key, (0, 0, 0))]
+            lines.append(f"Messages per minute from {label} (1m/5m/15m): "
+                         f"{meter[0]:.1f}/{meter[1]:.1f}/{meter[2]:.1f}")
+        return lines
+
+    def latency_report(self) -> list:
+        """ Build p50/p95/p99 lines for each relay direction and stage """
+        histograms = self.stats_data.histogram_snapshot()
+        lines = []
+        for direction, stages in STAGES.items():
+            rows = [(stage, histograms.get(('stage_latency', direction, stage)))
+                    for stage in stages]
+            rows.append(('total', histograms.get(('delivery_latency', direction))))
+            lines.append(direction.replace('_', ' ') + ":")
+            for stage, histogram in rows:
+                if not histogram:
+                    continue
+                percentiles = ' '.join(
+                    f"p{int(q * 100)}={histogram_percentile(histogram, q) * 1000:.1f}ms"
+                    for q in (0.5, 0.95, 0.99))
+                lines.append(f"  {stage}: {percentiles} (n={sum(histogram[:-1])})")
+        return lines
+
+    def threads_report(self) -> list:
+        """ List the threads using the most CPU over the last sample """
+        lines = [f"Threads: {threading.active_count()}, busiest over the last "
+                 f"{accounting.interval:.0f}s:"]
+        for name, percent, cpu_time, wait in accounting.top(self.report_limit):
+            lines.append(f"  {name}: {percent:.1f}% cpu, {cpu_time:.1f}s cpu total, "
+                         f"{wait:.1f}s waiting on queues")
+        return lines
+
+    def dump_report(self) -> list:
+        """ Write the flight recorder to a file, at most once per dump_interval """
+        now = time.monotonic()
+        if self.last_dump is not None and now - self.last_dump < self.dump_interval:
+            return [f"Events were dumped {now - self.last_dump:.0f}s ago, "
+                    f"try again in {self.dump_interval - (now - self.last_dump):.0f}s"]
+        self.last_dump = now
+        try:
+            path = recorder.dump(self.dump_directory)
+        except OSError as e:
+            return [f"Unable to dump events: {e}"]
+        return [f"Dumped {len(recorder.events)} events to {path}"]
+
+    def startup_report(self) -> list:
+        """ Time taken by each stage of starting the bridge """
+        return startup.report()
+
+    def puppets_report(self) -> list:
+        """ Count puppets by state, then list the most backed up ones """
+        puppets = [puppet for _, puppet in self.registry.items('puppets')]
+        states = {}
+        for puppet in puppets:
+            states[puppet.state] = states.get(puppet.state, 0) + 1
+        # Hibernated puppets have no connection, so are counted separately
+        hibernated = len(self.registry.items('hibernated'))
+        lines = [f"Puppets: {len(puppets)} (" + ', '.join(
+            f"{state}: {states.get(state, 0)}" for state in ('connecting', 'ready', 'away')) +
+            f"), hibernated: {hibernated}"]
+        now = time.time()
+        puppets.sort(key=lambda puppet: (-puppet.queues['in_queue'].qsize(),
+                                         puppet.last_activity))
+        for puppet in puppets[:self.report_limit]:
+            lines.append(f"  {puppet.config['nickname']}: {puppet.state}, "
+                         f"inbox {puppet.queues['in_queue'].qsize()}, "
+                         f"last active {now - puppet.last_activity:.0f}s ago")
+        if len(puppets) > self.report_limit:
+            lines.append(f"  ... and {len(puppets) - self.report_limit} more")
+        return lines
+
+    def queues_report(self) -> list:
+        """ Depth and high-water mark of every bridge queue """
+        lines = []
+        for name, bridge_queue in sorted(self.registry.items('queues')):
+            lines.append(f"{name}: {bridge_queue.qsize()} queued, "
+                         f"high water {bridge_queue.high_water}, {bridge_queue.policy}")
+        inboxes = [(puppet.config['nickname'], puppet.queues['in_queue'])
+                   for _, puppet in self.registry.items('puppets')]
+        if inboxes:
+            deepest, inbox = max(inboxes, key=lambda item: item[1].qsize())
+            high_water = max(getattr(inbox, 'high_water', 0) for _, inbox in inboxes)
+            lines.append(f"puppet inboxes: {sum(inbox.qsize() for _, inbox in inboxes)} "
+                         f"queued over {len(inboxes)}, deepest {deepest} ({inbox.qsize()}), "
+                         f"high water {high_water}")
+        return lines
+
+    def conn_report(self) -> list:
+        """ Reconnects, bytes in/out and flood control backlog per IRC connection """
+        bots = self.registry.items('connections')
+        puppets = self.registry.items('puppets')
+        puppets.sort(key=lambda item: -(item[1].flood.waiting + item[1].flood.delayed))
+        lines = []
+        for name, bot in bots + [(puppet.config['nickname'], puppet)
+                                 for _, puppet in puppets[:self.report_limit]]:
+            line = (f"{name}: {bot.reconnects} reconnects, "
+                    f"{getattr(bot.connection, 'bytes_in', 0)}B in, "
+                    f"{getattr(bot.connection, 'bytes_out', 0)}B out")
+            flood = getattr(bot, 'flood', None)
+            if flood:
+                line += f", flood backlog {flood.waiting} (held {flood.delayed:.1f}s total)"
+            lines.append(line)
+        if len(puppets) > self.report_limit:
+            lines.append(f"... and {len(puppets) - self.report_limit} more puppets")
+        return lines
+
+    def profile_command(self, nick, args):
+        """ Start, stop or time the sampling profiler """
+        c = self.connection
+        if args == ['stop']:
+            if self.profiler.running:
+                self.finish_profile(nick, self.profile_run)
+            else:
+                c.privmsg(nick, "Profiler is not running")
+        elif len(args) == 1 and (args[0] == 'start' or args[0].isdigit()):
+            if self.profiler.running:
+                c.privmsg(nick, "Profiler is already running, stop it with: profile stop")
+                return
+            self.profile_run += 1
+            self.profiler.start()
+            if args[0] == 'start':
+                c.privmsg(nick, "Profiler started, stop it with: profile stop")
+                return
+            seconds = min(int(args[0]), self.max_profile_seconds)
+            run = self.profile_run
+            self.reactor.scheduler.execute_after(
+                seconds, lambda: self.finish_profile(nick, run))
+            c.privmsg(nick, f"Profiling for {seconds}s")
+        else:
+            c.privmsg(nick, "Usage: profile start|stop|<seconds>")
+
+    def finish_profile(self, nick, run):
+        """ Stop the profiler, write the collapsed stacks and reply with the top functions """
+        if run != self.profile_run or not self.profiler.running:
+            return
+        c = self.connection
+        self.profiler.stop()
+        samples = max(self.profiler.samples, 1)
+        try:
+            path = self.profiler.write_collapsed(self.profile_directory)
+        except OSError as e:
+            self.log.error("Unable to write profile to %s: %s", self.profile_directory, e)
+            path = "(not written, see log)"
+        c.privmsg(nick, f"Profiled {self.profiler.elapsed:.1f}s, "
+                  f"{self.profiler.samples} samples, stacks in {path}")
+        for label, own, total in self.profiler.top_functions(self.profile_top):
+            c.privmsg(nick, f"  {own * 100 / samples:5.1f}% {label} "
+                      f"(with callees {total * 100 / samples:.1f}%)")
+
+    def authorised(self, e) -> bool:
+        """ Check a command was sent in the bot channel, or by a configured admin """
+        if e.type == 'pubmsg' and irc.strings.lower(e.target) == irc.strings.lower(self.channel):
+            return True
+        source = irc.strings.lower(str(e.source))
+        return any(fnmatch.fnmatchcase(source, irc.strings.lower(mask)) for mask in self.admins)
+
     def do_command(self, e, cmd):
         """Process commands"""
         nick = e.source.nick
         c = self.connection
 
-        if cmd == "stats":
+        if cmd.split()[:1] and cmd.split()[0] in self.admin_commands and not self.authorised(e):
+            self.log.warning("refused %s from %s", cmd, e.source)
+            c.privmsg(nick, f"{cmd.split()[0]} is only allowed in {self.channel} or for admins")
+        elif cmd == "stats":
+            # Only the stats command needs psutil, don't load it at startup
+            import psutil  # pylint: disable=import-outside-toplevel
+
             data = self.stats_data.snapshot()
             total_puppets = 0
             if 'total_puppets' in data:
@@ -452,9 +915,22 @@ class IRCBot(BotTemplate):
             c.privmsg(nick, "Puppets total: " + str(total_puppets))
             c.privmsg(nick, "Relayed messages from Discord: " + str(discord_messages))
             c.privmsg(nick, "Relayed messages from IRC: " + str(irc_messages))
+            for line in self.rate_report():
+                c.privmsg(nick, line)
+            c.privmsg(nick, "Presence changes suppressed: "
+                      f"{data.get('presence_suppressed', 0)} of "
+                      f"{data.get('presence_transitions', 0)}")
             c.privmsg(nick, f"Memory usage (rss): {rss:.2f}mb".format(rss))
             c.privmsg(nick, "Threads: " + str(num_threads))
             c.privmsg(nick, "Uptime: " + uptime)
+        elif cmd == "stats latency":
+            for line in self.latency_report():
+                c.privmsg(nick, line)
+        elif cmd in ("puppets", "queues", "conn", "threads", "dump", "startup"):
+            for line in getattr(self, cmd + '_report')():
+                c.privmsg(nick, line)
+        elif cmd.split()[:1] == ["profile"]:
+            self.profile_command(nick, cmd.split()[1:])
         else:
             c.privmsg(nick, "Not understood: " + cmd)
 
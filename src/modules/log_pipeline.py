@@ -0,0 +1,119 @@
+"""
+This file is part of CatPuppetBridge.
+
+CatPuppetBridge is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+CatPuppetBridge is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+CatPuppetBridge. If not, see <https://www.gnu.org/licenses/>.
+
+Copyright (C) 2025 Lisa Marie Maginnis
+
+Queue backed logging, so relay threads never wait on log output
+"""
+
+import atexit
+import logging
+import logging.handlers
+import queue
+
+# pylint: disable=too-few-public-methods
+class SamplingFilter(logging.Filter):
+    """
+    Rate limit debug records per call site with a token bucket, so a hot
+    debug line (eg/ every raw IRC line) can't flood the log. Info and above
+    always pass.
+    """
+
+    def __init__(self, rate: float = 20, burst: int = 100):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.sites = {}
+        self.suppressed = 0
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.rate <= 0:
+            return True
+        # Unlocked, a race only miscounts a token which is fine for sampling
+        site = (record.pathname, record.lineno)
+        now = record.created
+        tokens, last = self.sites.get(site, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens < 1:
+            self.sites[site] = (tokens, now)
+            self.suppressed += 1
+            return False
+        self.sites[site] = (tokens - 1, now)
+        return True
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler which leaves formatting to the writer thread, and drops
+    records instead of blocking when the queue is full. Records never leave
+    the process, so they don't need to be made picklable first.
+    """
+    dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class LogPipeline():
+    """ Moves the root logger's handlers behind a queue and a writer thread """
+
+    def __init__(self):
+        self.handler = None
+        self.listener = None
+        self.sampler = SamplingFilter()
+
+    def start(self, max_queue: int = 10000):
+        """ Replace the root handlers with a queue, writing to them from a thread """
+        root = logging.getLogger()
+        handlers = list(root.handlers)
+        log_queue = queue.Queue(max_queue)
+        self.handler = DeferredQueueHandler(log_queue)
+        self.handler.addFilter(self.sampler)
+        for handler in handlers:
+            root.removeHandler(handler)
+        root.addHandler(self.handler)
+        self.listener = logging.handlers.QueueListener(log_queue, *handlers,
+                                                       respect_handler_level=True)
+        self.listener.start()
+        self.listener._thread.name = 'log-writer'  # pylint: disable=protected-access
+        atexit.register(self.stop)
+
+    def stop(self):
+        """ Flush queued records and stop the writer thread """
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def configure_sampling(self, rate: float, burst: int):
+        """ Set how many debug records per second each call site may log """
+        self.sampler.rate = rate
+        self.sampler.burst = burst
+        self.sampler.sites = {}
+
+    @property
+    def dropped(self) -> int:
+        """ Records dropped because the writer fell behind """
+        return self.handler.dropped if self.handler else 0
+
+    @property
+    def suppressed(self) -> int:
+        """ Debug records suppressed by sampling """
+        return self.sampler.suppressed
+
+log_pipeline = LogPipeline()
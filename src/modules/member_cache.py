@@ -0,0 +1,86 @@
+"""
+This file is part of CatPuppetBridge.
+
+CatPuppetBridge is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+CatPuppetBridge is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+CatPuppetBridge. If not, see <https://www.gnu.org/licenses/>.
+
+Copyright (C) 2025 Lisa Marie Maginnis
+
+Bounded guild member cache for the lean MemberCache policy
+"""
+
+from collections import OrderedDict
+
+# pylint: disable=protected-access
+class MemberCache():
+    """
+    Decides which members stay in the guild's member cache. Members with an
+    active puppet are pinned, the rest are kept least recently used first and
+    evicted past max_size. discord.py only dispatches member and presence
+    events for cached members, so pinned puppets keep working as usual.
+    """
+
+    def __init__(self, max_size: int = 1000, data=None):
+        self.max_size = max_size
+        self.data = data
+        self.recent = OrderedDict()
+        self.pinned = set()
+
+    def __len__(self):
+        return len(self.recent) + len(self.pinned)
+
+    def count(self, result: str):
+        """ Count a cache hit, fetch or eviction """
+        if self.data:
+            self.data.increment(('member_cache', result))
+
+    def get(self, guild, user_id: int):
+        """ A cached member, or None """
+        member = guild.get_member(user_id)
+        if member is not None and user_id in self.recent:
+            self.recent.move_to_end(user_id)
+        return member
+
+    def add(self, member):
+        """ Cache a member as the most recently used """
+        member.guild._add_member(member)
+        if member.id in self.pinned:
+            return
+        self.recent[member.id] = member
+        self.recent.move_to_end(member.id)
+        while len(self.recent) > self.max_size:
+            _, evicted = self.recent.popitem(last=False)
+            evicted.guild._remove_member(evicted)
+            self.count('evict')
+
+    def pin(self, member):
+        """ Keep a member cached until unpinned, eg/ while their puppet is active """
+        self.recent.pop(member.id, None)
+        self.pinned.add(member.id)
+        member.guild._add_member(member)
+
+    def unpin(self, member):
+        """ Let a pinned member be evicted again """
+        if member.id in self.pinned:
+            self.pinned.discard(member.id)
+            self.add(member)
+
+    def remove(self, member):
+        """ Forget a member who left the guild """
+        self.pinned.discard(member.id)
+        self.recent.pop(member.id, None)
+
+    def members(self, guild):
+        """ Cached members, most recently used first """
+        pinned = [guild.get_member(user_id) for user_id in self.pinned]
+        return [member for member in pinned if member is not None] + \
+            list(reversed(self.recent.values()))
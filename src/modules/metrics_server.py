@@ -0,0 +1,215 @@
+"""
+This file is part of CatPuppetBridge.
+
+CatPuppetBridge is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+CatPuppetBridge is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+CatPuppetBridge. If not, see <https://www.gnu.org/licenses/>.
+
+Copyright (C) 2025 Lisa Marie Maginnis
+
+Prometheus/OpenMetrics text endpoint for bridge stats
+"""
+
+import logging
+import re
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from modules.stats_data import LATENCY_BUCKETS
+
+PREFIX = 'catpuppetbridge_'
+RATE_WINDOW_NAMES = ('1m', '5m', '15m')
+
+# StatsData key: (type, help, label names for (key, label values...) tuples)
+METRICS = {
+    'discord_messages': ('counter', 'Messages relayed from Discord to IRC', ('channel',)),
+    'irc_messages': ('counter', 'Messages relayed from IRC to Discord', ('channel',)),
+    'total_puppets': ('gauge', 'IRC puppets currently running', ()),
+    'uptime': ('gauge', 'Unix time the bridge was started', ()),
+    'irc_reconnects': ('counter', 'Reconnects to the IRC server', ('bot',)),
+    'irc_flood_disconnects': ('counter', 'Disconnects from IRC for flooding', ('bot',)),
+    'webhook_rate_limits': ('counter', 'HTTP 429 rate limits from Discord', ()),
+    'queue_depth': ('gauge', 'Items waiting in a bridge queue', ('queue',)),
+    'queue_drops': ('counter', 'Items dropped by a full bridge queue', ('queue',)),
+    'queue_spilled': ('counter', 'Items spilled to disk by a full bridge queue', ('queue',)),
+    'queue_coalesced': ('counter', 'Commands coalesced in a bridge queue', ('queue',)),
+    'queue_high_water': ('gauge', 'Highest depth seen on a bridge queue', ('queue',)),
+    'presence_transitions': ('counter', 'Discord presence changes for puppets', ()),
+    'presence_suppressed': ('counter', 'Presence changes suppressed by debouncing', ()),
+    'coalesced_messages': ('counter', 'Discord messages merged from several IRC lines', ()),
+    'irc_membership_events': ('counter', 'IRC joins, parts, quits and nick changes', ()),
+    'irc_membership_relayed': ('counter', 'Aggregated membership lines relayed', ()),
+    'delivery_latency': ('histogram', 'Seconds from a message arriving to delivery',
+                         ('direction',)),
+    'loop_lag': ('gauge', 'Seconds an event loop or IRC reactor is running late',
+                 ('loop',)),
+    'watchdog_stalls': ('counter', 'Times a loop fell behind the watchdog threshold',
+                        ('loop',)),
+    'stalled_loops': ('gauge', 'Loops behind the watchdog threshold, eg/ stalled puppets',
+                      ('loop',)),
+    'thread_cpu': ('counter', 'CPU seconds used by a group of bridge threads', ('threads',)),
+    'queue_wait': ('counter', 'Seconds a group of bridge threads spent waiting on queues',
+                   ('threads',)),
+    'log_dropped': ('counter', 'Log records dropped because the log writer fell behind', ()),
+    'traffic_dropped': ('counter', 'Records dropped because the traffic recorder fell behind',
+                        ()),
+    'log_suppressed': ('counter', 'Debug log records suppressed by sampling', ()),
+    'startup_seconds': ('gauge', 'Seconds from starting to each startup stage finishing',
+                        ('stage',)),
+    'member_cache': ('counter', 'Lean member cache hits, fetches and evictions', ('result',)),
+    'dry_run_sends': ('counter', 'Messages and IRC lines a dry run did not send',
+                      ('platform',)),
+    'stage_latency': ('histogram', 'Seconds a message spent in each bridge stage',
+                      ('direction', 'stage')),
+}
+
+def metric_name(key: str) -> str:
+    """ Build a Prometheus safe metric name for a stats key """
+    return PREFIX + re.sub(r'[^a-zA-Z0-9_]', '_', key)
+
+def escape_label(value) -> str:
+    """ Escape a label value for the text exposition format """
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+def split_key(key):
+    """ Split a stats key into its metric name and label values """
+    if isinstance(key, tuple):
+        return key[0], key[1:]
+    return key, ()
+
+def format_labels(names: tuple, values: tuple) -> str:
+    """ Format label pairs, without braces """
+    if len(names) != len(values):
+        names = tuple(f'label{index}' for index in range(len(values)))
+    return ','.join(f'{name}="{escape_label(value)}"' for name, value in zip(names, values))
+
+def render_scalars(snapshot: dict) -> list:
+    """ Render counters and gauges from a StatsData snapshot """
+    families = {}
+    for key, value in snapshot.items():
+        name, label = split_key(key)
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            families.setdefault(name, []).append((label, value))
+
+    lines = []
+    for name in sorted(families):
+        kind, help_text, label_names = METRICS.get(name, ('untyped', name, ()))
+        full_name = metric_name(name) + ('_total' if kind == 'counter' else '')
+        samples = families[name]
+        if any(labels for labels, _ in samples):
+            # Unlabelled totals are kept for the stats command, labels sum to them
+            samples = [sample for sample in samples if sample[0]]
+        lines.append(f"# HELP {full_name} {help_text}")
+        lines.append(f"# TYPE {full_name} {kind}")
+        for labels, value in sorted(samples, key=lambda item: str(item[0])):
+            label_text = format_labels(label_names, labels)
+            label_text = f'{{{label_text}}}' if label_text else ''
+            lines.append(f"{full_name}{label_text} {value}")
+    return lines
+
+def render_histogram(full_name: str, label_text: str, histogram: list) -> list:
+    """ Render the cumulative buckets, sum and count of one histogram """
+    bucket_prefix = label_text + ',' if label_text else ''
+    lines = []
+    cumulative = 0
+    for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), histogram[:-1]):
+        cumulative += count
+        lines.append(f'{full_name}_bucket{{{bucket_prefix}le="{bound}"}} {cumulative}')
+    label_text = f'{{{label_text}}}' if label_text else ''
+    lines.append(f"{full_name}_sum{label_text} {histogram[-1]}")
+    lines.append(f"{full_name}_count{label_text} {cumulative}")
+    return lines
+
+def render_histograms(snapshot: dict) -> list:
+    """ Render fixed bucket histograms from a StatsData histogram snapshot """
+    families = {}
+    for key, histogram in snapshot.items():
+        name, label = split_key(key)
+        families.setdefault(name, []).append((label, histogram))
+
+    lines = []
+    for name in sorted(families):
+        _, help_text, label_names = METRICS.get(name, ('histogram', name, ()))
+        full_name = metric_name(name) + '_seconds'
+        lines.append(f"# HELP {full_name} {help_text}")
+        lines.append(f"# TYPE {full_name} histogram")
+        for labels, histogram in sorted(families[name], key=lambda item: str(item[0])):
+            lines += render_histogram(full_name, format_labels(label_names, labels), histogram)
+    return lines
+
+def render_rates(rates: dict) -> list:
+    """ Render 1m/5m/15m rate meters for counters as gauges with a window label """
+    families = {}
+    for key, meter in rates.items():
+        name, labels = split_key(key)
+        if METRICS.get(name, ('untyped',))[0] == 'counter':
+            families.setdefault(name, []).append((labels, meter))
+
+    lines = []
+    for name in sorted(families):
+        _, help_text, label_names = METRICS[name]
+        full_name = metric_name(name) + '_rate'
+        lines.append(f"# HELP {full_name} Per second rate of: {help_text}")
+        lines.append(f"# TYPE {full_name} gauge")
+        for labels, meter in sorted(families[name], key=lambda item: str(item[0])):
+            label_text = format_labels(label_names, labels)
+            label_text = label_text + ',' if label_text else ''
+            for window, value in zip(RATE_WINDOW_NAMES, meter):
+                lines.append(f'{full_name}{{{label_text}window="{window}"}} {value:.6f}')
+    return lines
+
+def render_metrics(stats) -> str:
+    """ Render StatsData in the Prometheus text exposition format """
+    lines = render_scalars(stats.snapshot()) + render_histograms(stats.histogram_snapshot())
+    lines += render_rates(stats.rates())
+    return '\n'.join(lines) + '\n'
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """ Serve rendered metrics on /metrics """
+    stats = None
+
+    # pylint: disable=invalid-name
+    def do_GET(self):
+        """ Handle a scrape """
+        if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render_metrics(self.stats).encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # pylint: disable=redefined-builtin
+    def log_message(self, format, *args):
+        """ Keep scrapes out of the bridge log unless debugging """
+        logging.getLogger(self.__class__.__name__).debug(format, *args)
+
+def parse_bind(bind: str):
+    """ Split a `host:port` bind address, IPv6 hosts may be written as [::1]:port """
+    host, _, port = bind.rpartition(':')
+    return host.strip('[]') or '127.0.0.1', int(port)
+
+def start_metrics_server(stats, bind: str):
+    """ Start the metrics HTTP server on a daemon thread """
+    host, port = parse_bind(bind)
+    handler = type('BoundMetricsHandler', (MetricsHandler,), {'stats': stats})
+    server_class = ThreadingHTTPServer
+    if ':' in host:
+        server_class = type('MetricsServer6', (ThreadingHTTPServer,),
+                            {'address_family': socket.AF_INET6})
+    server = server_class((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logging.info("serving metrics on http://%s:%i/metrics", host, port)
+    return server
@@ -0,0 +1,133 @@
+"""
+This file is part of CatPuppetBridge.
+
+CatPuppetBridge is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+CatPuppetBridge is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+CatPuppetBridge. If not, see <https://www.gnu.org/licenses/>.
+
+Copyright (C) 2025 Lisa Marie Maginnis
+
+Sampling profiler covering every bridge thread, including the Discord loop
+"""
+
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+# Leaf frames of threads which are waiting rather than working, by file and
+# plain function name, as co_qualname is only there from Python 3.11
+IDLE_FUNCTIONS = {
+    ('selectors.py', 'select'), ('threading.py', 'wait'),
+    ('threading.py', '_wait_for_tstate_lock'), ('queue.py', 'get'),
+    ('client.py', 'process_once'), ('socketserver.py', 'serve_forever'),
+}
+
+def frame_label(frame) -> tuple:
+    """ Get a (file name, function name) label for a frame """
+    code = frame.f_code
+    return os.path.basename(code.co_filename), getattr(code, 'co_qualname', code.co_name)
+
+def is_idle(label: tuple) -> bool:
+    """ Check if a leaf frame's label is a thread waiting, whether or not it has a qualname """
+    filename, function = label
+    return (filename, function.rsplit('.', 1)[-1]) in IDLE_FUNCTIONS
+
+class SamplingProfiler():
+    """
+    Periodically sample the stack of every thread with sys._current_frames,
+    counting identical stacks. Cheap enough to run on a live bridge.
+    """
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.started = None
+        self.elapsed = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    @property
+    def running(self) -> bool:
+        """ Check if the profiler is sampling """
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        """ Start sampling on a daemon thread """
+        self.stacks.clear()
+        self.samples = 0
+        self.stop_event.clear()
+        self.started = time.monotonic()
+        self.thread = threading.Thread(target=self.run, name='profiler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """ Stop sampling and wait for the sampler to exit """
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.elapsed = time.monotonic() - self.started
+
+    def run(self):
+        """ Sample until stopped """
+        while not self.stop_event.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        """ Record the current stack of every thread except the sampler """
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        own = threading.get_ident()
+        # pylint: disable=protected-access
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_label(frame))
+                frame = frame.f_back
+            stack.reverse()
+            self.stacks[(names.get(ident, str(ident)), tuple(stack))] += 1
+        self.samples += 1
+
+    def collapsed(self) -> list:
+        """ Render samples as collapsed stacks, as read by flamegraph tools """
+        lines = []
+        for (thread_name, stack), count in self.stacks.most_common():
+            frames = ';'.join(f'{filename}:{function}' for filename, function in stack)
+            lines.append(f"{thread_name};{frames} {count}")
+        return lines
+
+    def write_collapsed(self, directory) -> str:
+        """ Write collapsed stacks to a new file in directory, returns its path """
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory,
+                            time.strftime('catpuppetbridge-%Y%m%d-%H%M%S.collapsed'))
+        with open(path, 'w', encoding='utf8') as output:
+            output.write('\n'.join(self.collapsed()) + '\n')
+        return path
+
+    def top_functions(self, count=10) -> list:
+        """
+        Get the busiest functions as (label, self samples, total samples),
+        ignoring threads which were idle when sampled
+        """
+        own = Counter()
+        total = Counter()
+        for (_, stack), samples in self.stacks.items():
+            if not stack or is_idle(stack[-1]):
+                continue
+            own[stack[-1]] += samples
+            for label in set(stack):
+                total[label] += samples
+        return [(f'{filename}:{function}', samples, total[(filename, function)])
+                for (filename, function), samples in own.most_common(count)]
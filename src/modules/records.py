@@ -0,0 +1,41 @@
+"""
+This file is part of CatPuppetBridge.
+
+CatPuppetBridge is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+CatPuppetBridge is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+CatPuppetBridge. If not, see <https://www.gnu.org/licenses/>.
+
+Copyright (C) 2025 Lisa Marie Maginnis
+
+Immutable records passed through the bridge queues
+"""
+
+from typing import Any, NamedTuple, Optional
+
+# NamedTuples rather than dicts: no per-item __dict__, cheap to build, and
+# they pickle as-is for queues spilling to disk. Use _replace() to change one.
+
+class PuppetCommand(NamedTuple):
+    """ A command from Discord for an IRC puppet """
+    command: str
+    id: int
+    irc_nick: str = ''
+    data: Any = None
+    channel: Any = None
+    trace: Optional[list] = None
+
+class RelayMessage(NamedTuple):
+    """ A message from IRC for a Discord channel, or a user's DMs """
+    author: str
+    channel: Any
+    content: str
+    error: bool = False
+    trace: Optional[list] = None
@@ -0,0 +1,76 @@
+"""
+This file is part of CatPuppetBridge.
+
+CatPuppetBridge is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+CatPuppetBridge is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+CatPuppetBridge. If not, see <https://www.gnu.org/licenses/>.
+
+Copyright (C) 2025 Lisa Marie Maginnis
+
+Registry of live puppets, queues and IRC connections for admin commands
+"""
+
+import threading
+
+import irc.client
+
+class CountingConnection(irc.client.ServerConnection):
+    """ ServerConnection which counts the lines and bytes it sends and receives """
+    bytes_in = 0
+    bytes_out = 0
+
+    def _prep_message(self, string):
+        data = super()._prep_message(string)
+        self.bytes_out += len(data)
+        return data
+
+    def _process_line(self, line):
+        # Lines arrive decoded without CRLF
+        self.bytes_in += len(line.encode('utf8', 'replace')) + 2
+        super()._process_line(line)
+
+# pylint: disable=too-few-public-methods
+class CountingReactor(irc.client.Reactor):
+    """ Reactor creating byte counting connections """
+    connection_class = CountingConnection
+
+class Registry():
+    """
+    Live bridge objects by name. Entries are the objects themselves, read when
+    an admin command asks for them, so registering costs nothing per message.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.puppets = {}
+        self.queues = {}
+        self.connections = {}
+        # Discord user id: when their puppet hibernated
+        self.hibernated = {}
+
+    def register(self, kind: str, name, item):
+        """ Add an object to the puppets, queues, connections or hibernated registry """
+        with self.lock:
+            getattr(self, kind)[name] = item
+
+    def unregister(self, kind: str, name, item=None):
+        """ Remove an object, only if it is still the registered one when item is given """
+        with self.lock:
+            entries = getattr(self, kind)
+            if item is None or entries.get(name) is item:
+                entries.pop(name, None)
+
+    def items(self, kind: str) -> list:
+        """ Get a list of (name, object) pairs """
+        with self.lock:
+            return list(getattr(self, kind).items())
+
+registry = Registry()
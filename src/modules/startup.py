@@ -0,0 +1,76 @@
+"""
+This file is part of CatPuppetBridge.
+
+CatPuppetBridge is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+CatPuppetBridge is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+CatPuppetBridge. If not, see <https://www.gnu.org/licenses/>.
+
+Copyright (C) 2025 Lisa Marie Maginnis
+
+Time taken by each stage of starting the bridge
+"""
+
+import logging
+import threading
+import time
+
+# In the order they usually finish
+STAGES = ('import', 'config', 'discord_import', 'discord_login', 'chunking', 'channel_fetch',
+          'first_puppet_ready')
+
+class StartupTimer():
+    """
+    Seconds from the bridge starting to each startup stage finishing. Only
+    the first time a stage finishes is kept, so reconnects don't count.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.stats = None
+
+    def start(self, stats):
+        """ Export stage times to stats, including those already finished """
+        with self.lock:
+            self.stats = stats
+            stages = dict(self.stages)
+        for stage, seconds in stages.items():
+            stats.update(('startup_seconds', stage), round(seconds, 3))
+
+    def mark(self, stage: str):
+        """ Record a stage as finished now, if it hasn't finished before """
+        with self.lock:
+            if stage in self.stages:
+                return
+            seconds = time.monotonic() - self.started
+            self.stages[stage] = seconds
+            stats = self.stats
+        logging.info("startup: %s done after %.2fs", stage, seconds)
+        if stats:
+            stats.update(('startup_seconds', stage), round(seconds, 3))
+
+    def report(self) -> list:
+        """ A line for each finished stage, with the time since the previous one """
+        with self.lock:
+            stages = sorted(self.stages.items(), key=lambda item: item[1])
+        lines = []
+        previous = 0.0
+        for stage, seconds in stages:
+            lines.append(f"{stage}: {seconds:.2f}s (+{seconds - previous:.2f}s)")
+            previous = seconds
+        waiting = [stage for stage in STAGES if stage not in dict(stages)]
+        if waiting:
+            lines.append("Waiting for: " + ', '.join(waiting))
+        return lines
+
+# Imported first by main.py, so this is close to when the bridge started
+startup = StartupTimer()
@@ -1,34 +1,180 @@
-""" Locking stats object for use between threads """
+""" Sharded stats object for use between threads """
 
+import bisect
+import math
 import threading
+import time
 from dataclasses import dataclass, field
 
+# Upper bounds in seconds for latency histograms
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Seconds between rate meter ticks, and the meter windows in seconds
+RATE_TICK = 5
+RATE_WINDOWS = (60, 300, 900)
+
+def histogram_percentile(histogram: list, percentile: float):
+    """
+    Estimate a percentile (0-1) from a fixed bucket histogram by interpolating
+    within the bucket it falls in. Returns None for an empty histogram.
+    """
+    counts = histogram[:-1]
+    total = sum(counts)
+    if not total:
+        return None
+    target = percentile * total
+    cumulative = 0
+    for index, count in enumerate(counts):
+        if count and cumulative + count >= target:
+            lower = LATENCY_BUCKETS[index - 1] if index > 0 else 0.0
+            upper = LATENCY_BUCKETS[min(index, len(LATENCY_BUCKETS) - 1)]
+            return lower + (upper - lower) * (target - cumulative) / count
+        cumulative += count
+    return LATENCY_BUCKETS[-1]
+
+def new_histogram() -> list:
+    """ One count per bucket, one for +Inf, then the sum """
+    return [0] * (len(LATENCY_BUCKETS) + 2)
+
+@dataclass
+class StatsShard:
+    """ Counters and histograms only ever written by the thread that owns them """
+    thread: threading.Thread
+    counters: dict = field(default_factory=dict)
+    histograms: dict = field(default_factory=dict)
+
+# pylint: disable=too-many-instance-attributes
 @dataclass
 class StatsData:
-    """ Stats dataclass for passing metrics between threads """
+    """
+    Stats dataclass for passing metrics between threads. Keys are either a
+    metric name, or a (metric name, label values...) tuple for labelled metrics.
+
+    Counters and histograms are written to a shard owned by the calling thread,
+    so the hot path never takes a lock, and are summed when a snapshot is
+    read. Values which are set rather than counted live behind the lock. A key
+    should either be set or counted, not both.
+    """
     data: dict = field(default_factory=dict)
     lock: threading.Lock = field(default_factory=threading.Lock)
+    histograms: dict = field(default_factory=dict)
+    gauges: dict = field(default_factory=dict)
+    shards: list = field(default_factory=list)
+    folded: dict = field(default_factory=dict)
+    local: threading.local = field(default_factory=threading.local)
+    meters: dict = field(default_factory=dict)
+    meter_totals: dict = field(default_factory=dict)
+    meter_tick: float = field(default_factory=time.time)
+
+    def shard(self) -> StatsShard:
+        """ Get the shard for the calling thread, creating it on first use """
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = StatsShard(threading.current_thread())
+            with self.lock:
+                self.shards.append(shard)
+            self.local.shard = shard
+            return shard
 
     def update(self, key, data):
         """ Update a value with a given key """
         with self.lock:
             self.data[key] = data
 
+    def update_max(self, key, data):
+        """ Update a value with a given key, only if it is larger """
+        with self.lock:
+            if key not in self.data or self.data[key] < data:
+                self.data[key] = data
+
     def increment(self, key):
         """ Increment a value by one """
-        with self.lock:
-            if key not in self.data:
-                self.data[key] = 0
-            self.data[key] = self.data[key] + 1
+        counters = self.shard().counters
+        counters[key] = counters.get(key, 0) + 1
 
     def decrement(self, key):
         """ Decrement a value by one """
+        counters = self.shard().counters
+        counters[key] = counters.get(key, 0) - 1
+
+    def observe(self, key, value):
+        """ Add a value to a fixed bucket histogram """
+        histograms = self.shard().histograms
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = new_histogram()
+        histogram[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        histogram[-1] += value
+
+    def register_gauge(self, key, callback):
+        """ Register a callable which is read for the value of key on every snapshot """
+        with self.lock:
+            self.gauges[key] = callback
+
+    def fold_dead_shards(self):
+        """ Merge shards of exited threads into the shared totals, lock must be held """
+        for shard in [shard for shard in self.shards if not shard.thread.is_alive()]:
+            self.shards.remove(shard)
+            for key, value in shard.counters.items():
+                self.folded[key] = self.folded.get(key, 0) + value
+            for key, histogram in shard.histograms.items():
+                merged = self.histograms.setdefault(key, new_histogram())
+                for index, value in enumerate(histogram):
+                    merged[index] += value
+
+    def counters(self) -> dict:
+        """ Sum counters across every shard """
         with self.lock:
-            if key not in self.data:
-                self.data[key] = 0
-            self.data[key] = self.data[key] - 1
+            self.fold_dead_shards()
+            totals = dict(self.folded)
+            shards = list(self.shards)
+        for shard in shards:
+            for key, value in dict(shard.counters).items():
+                totals[key] = totals.get(key, 0) + value
+        return totals
 
     def snapshot(self):
         """ Get a snapshot of our data """
+        totals = self.counters()
+        with self.lock:
+            data = dict(self.data)
+            gauges = dict(self.gauges)
+        for key, value in totals.items():
+            data[key] = data.get(key, 0) + value
+        for key, callback in gauges.items():
+            data[key] = callback()
+        return data
+
+    def histogram_snapshot(self):
+        """ Get a snapshot of our histograms """
+        with self.lock:
+            self.fold_dead_shards()
+            merged = {key: list(histogram) for key, histogram in self.histograms.items()}
+            shards = list(self.shards)
+        for shard in shards:
+            for key, histogram in dict(shard.histograms).items():
+                total = merged.setdefault(key, new_histogram())
+                for index, value in enumerate(list(histogram)):
+                    total[index] += value
+        return merged
+
+    def rates(self, now=None) -> dict:
+        """
+        Get 1m/5m/15m exponentially weighted rates, per second, for every
+        counter. Meters are ticked lazily here rather than on every increment.
+        """
+        now = time.time() if now is None else now
+        totals = self.counters()
         with self.lock:
-            return dict(self.data)
+            ticks = int((now - self.meter_tick) // RATE_TICK)
+            if ticks > 0:
+                self.meter_tick += ticks * RATE_TICK
+                for key, value in totals.items():
+                    instant = (value - self.meter_totals.get(key, 0)) / (ticks * RATE_TICK)
+                    self.meter_totals[key] = value
+                    meter = self.meters.setdefault(key, [0.0] * len(RATE_WINDOWS))
+                    for index, window in enumerate(RATE_WINDOWS):
+                        decay = math.exp(-RATE_TICK * ticks / window)
+                        meter[index] = instant + (meter[index] - instant) * decay
+            return {key: tuple(meter) for key, meter in self.meters.items()}
@@ -0,0 +1,142 @@
+"""
+This file is part of CatPuppetBridge.
+
+CatPuppetBridge is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+CatPuppetBridge is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+CatPuppetBridge. If not, see <https://www.gnu.org/licenses/>.
+
+Copyright (C) 2025 Lisa Marie Maginnis
+
+Per-thread CPU time and queue wait time accounting
+"""
+
+import threading
+import time
+
+def thread_group(name: str) -> str:
+    """ Group threads for metrics, eg/ every `puppet:<nick>` is `puppet` """
+    return name.split(':', 1)[0]
+
+# pylint: disable=too-many-instance-attributes
+class ThreadAccounting():
+    """
+    Periodically read the CPU time of every thread from the OS, and collect
+    the time threads spend blocked waiting on bridge queues. Totals only grow,
+    threads which exit keep their share in their group.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = None
+        # Thread: [queue wait seconds], a slot each thread only writes itself
+        self.waits = {}
+        self.local = threading.local()
+        # Queue wait seconds of threads which have exited, by group
+        self.exited_waits = {}
+        # Native thread id: (name, cpu seconds at the last sample)
+        self.cpu = {}
+        self.recent = {}
+        self.group_cpu = {}
+        self.last_sample = None
+        self.interval = 0.0
+        self.thread = None
+
+    def add_wait(self, seconds: float):
+        """ Count time the calling thread spent waiting on a queue """
+        slot = getattr(self.local, 'wait', None)
+        if slot is None:
+            # Only a thread's first wait takes the lock, to register its slot
+            slot = self.local.wait = [0.0]
+            with self.lock:
+                self.waits[threading.current_thread()] = slot
+        slot[0] += seconds
+
+    def sample(self):
+        """ Read CPU time for every thread, and export group totals to stats """
+        # Not needed until the first sample, so kept out of startup
+        import psutil  # pylint: disable=import-outside-toplevel
+
+        names = {thread.native_id: thread.name for thread in threading.enumerate()}
+        now = time.monotonic()
+        with self.lock:
+            recent = {}
+            seen = {}
+            for thread in psutil.Process().threads():
+                name = names.get(thread.id, f'native:{thread.id}')
+                cpu_time = thread.user_time + thread.system_time
+                _, previous = self.cpu.get(thread.id, (name, 0.0))
+                delta = max(cpu_time - previous, 0.0)
+                group = thread_group(name)
+                self.group_cpu[group] = self.group_cpu.get(group, 0.0) + delta
+                recent[name] = (delta, cpu_time)
+                seen[thread.id] = (name, cpu_time)
+            self.cpu = seen
+            self.recent = recent
+            self.interval = now - self.last_sample if self.last_sample else 0.0
+            self.last_sample = now
+            group_cpu = dict(self.group_cpu)
+            group_waits = self.fold_waits()
+        if self.stats:
+            for group, seconds in group_cpu.items():
+                self.stats.update(('thread_cpu', group), round(seconds, 3))
+            for group, seconds in group_waits.items():
+                self.stats.update(('queue_wait', group), round(seconds, 3))
+
+    def fold_waits(self) -> dict:
+        """
+        Move the waits of threads which have exited into their group, so waits
+        doesn't grow with every puppet. Returns total wait seconds by group,
+        call with the lock held
+        """
+        for thread in [thread for thread in self.waits if not thread.is_alive()]:
+            group = thread_group(thread.name)
+            self.exited_waits[group] = self.exited_waits.get(group, 0.0) + \
+                self.waits.pop(thread)[0]
+        group_waits = dict(self.exited_waits)
+        for thread, slot in self.waits.items():
+            group = thread_group(thread.name)
+            group_waits[group] = group_waits.get(group, 0.0) + slot[0]
+        return group_waits
+
+    def wait_seconds(self, name: str) -> float:
+        """ Total queue wait of threads called name which haven't been folded yet """
+        with self.lock:
+            return sum(slot[0] for thread, slot in self.waits.items() if thread.name == name)
+
+    def top(self, count: int = 10) -> list:
+        """
+        Get the busiest threads over the last sample as (name, cpu percent,
+        total cpu seconds, total queue wait seconds)
+        """
+        with self.lock:
+            recent = dict(self.recent)
+            interval = self.interval
+        rows = []
+        for name, (delta, cpu_time) in recent.items():
+            percent = delta * 100 / interval if interval else 0.0
+            rows.append((name, percent, cpu_time, self.wait_seconds(name)))
+        rows.sort(key=lambda row: (-row[1], -row[2]))
+        return rows[:count]
+
+    def run(self, interval: float):
+        """ Sample forever """
+        while True:
+            self.sample()
+            time.sleep(interval)
+
+    def start(self, stats, interval: float = 10.0):
+        """ Start sampling on a daemon thread """
+        self.stats = stats
+        self.thread = threading.Thread(target=self.run, args=[interval],
+                                       name='thread-stats', daemon=True)
+        self.thread.start()
+
+accounting = ThreadAccounting()
@@ -0,0 +1,60 @@
+"""
+This file is part of CatPuppetBridge.
+
+CatPuppetBridge is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+CatPuppetBridge is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+CatPuppetBridge. If not, see <https://www.gnu.org/licenses/>.
+
+Copyright (C) 2025 Lisa Marie Maginnis
+
+Per-stage latency tracing for bridged messages
+"""
+
+import itertools
+import time
+
+from modules.flight_recorder import recorder
+
+# Stages in the order a message passes through them, for display
+STAGES = {
+    'discord_to_irc': ('filters', 'puppet_queue', 'dispatch', 'inbox', 'irc_send'),
+    'irc_to_discord': ('queue', 'coalesce', 'filters', 'discord_send'),
+}
+
+trace_ids = itertools.count(1)
+
+def start_trace(*details) -> list:
+    """
+    Start a trace for a message entering the bridge. The ingress entry carries
+    an id, so the flight recorder can follow the message through each stage.
+    """
+    trace_id = next(trace_ids)
+    recorder.record('ingress', trace_id, *details)
+    return [('ingress', time.time(), trace_id)]
+
+def mark(trace: list, stage: str):
+    """ Record the time a message finished a stage, traces may be None """
+    if trace is not None:
+        trace.append((stage, time.time()))
+        recorder.record(stage, trace[0][-1])
+
+def record_trace(data, direction: str, trace: list):
+    """
+    Add the time spent in each stage of a delivered message, and the total
+    delivery latency, to the stats histograms
+    """
+    if not data or not trace:
+        return
+    for started, (stage, finished) in zip(trace, trace[1:]):
+        data.observe(('stage_latency', direction, stage), finished - started[1])
+    latency = trace[-1][1] - trace[0][1]
+    data.observe(('delivery_latency', direction), latency)
+    recorder.record('delivered', trace[0][-1], direction, latency)
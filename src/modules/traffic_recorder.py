@@ -0,0 +1,164 @@
+"""
+This file is part of CatPuppetBridge.
+
+CatPuppetBridge is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+CatPuppetBridge is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+CatPuppetBridge. If not, see <https://www.gnu.org/licenses/>.
+
+Copyright (C) 2025 Lisa Marie Maginnis
+
+Anonymised recording of traffic entering the bridge, for offline replay
+"""
+
+import atexit
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+
+EMOJI_RE = re.compile(r':[a-zA-Z0-9_]+:|[\U0001F300-\U0001FAFF☀-➿]')
+MENTION_RE = re.compile(r'<@!?\d+>')
+# Fields holding a user or channel, written as salted hashes
+ANONYMISED = ('user', 'channel', 'target')
+# Records waiting for the writer, beyond this they are dropped and counted
+MAX_QUEUED = 10000
+
+def message_shape(text: str) -> list:
+    """ Length, non-ASCII characters, emoji, mentions and lines of a message """
+    return [len(text), sum(1 for char in text if ord(char) > 127),
+            len(EMOJI_RE.findall(text)), len(MENTION_RE.findall(text)), text.count('\n') + 1]
+
+def shaped_text(shape: list, rng: random.Random = random) -> str:
+    """ Made up text with a recorded message_shape """
+    length, non_ascii, emoji, mentions, lines = (list(shape) + [0, 0, 0, 0, 1])[:5]
+    parts = [':cat:'] * emoji + ['<@1>'] * mentions
+    parts += ['猫' * min(8, non_ascii - index) for index in range(0, non_ascii, 8)]
+    # Length of the parts joined with spaces
+    size = sum(len(part) + 1 for part in parts) - 1
+    while size < length:
+        word = ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz')
+                       for _ in range(max(min(rng.randint(2, 9), length - size - 1), 1)))
+        parts.append(word)
+        size += len(word) + 1
+    rng.shuffle(parts)
+    text = ' '.join(parts)[:max(length, 1)]
+    if lines > 1:
+        step = max(len(text) // lines, 1)
+        text = '\n'.join(text[index:index + step] for index in range(0, len(text), step))
+    return text
+
+def open_recording(path: str, mode: str = 'rt'):
+    """ Open a recording, gzipped if its name ends in .gz """
+    if path.endswith('.gz'):
+        return gzip.open(path, mode, encoding='utf8')
+    return open(path, mode, encoding='utf8')
+
+def read_recording(path: str) -> list:
+    """
+    Read every record of a recording, oldest first. A recording cut short,
+    eg/ by a crash, is read up to the last complete record.
+    """
+    records = []
+    with open_recording(path) as recording:
+        try:
+            for line in recording:
+                if line.strip():
+                    records.append(json.loads(line))
+        except (EOFError, json.JSONDecodeError):
+            logging.warning("%s is truncated, read %d records", path, len(records))
+    return records
+
+class TrafficRecorder():
+    """
+    Opt-in recorder of events entering the bridge. Users and channels are
+    replaced with salted hashes and text with its shape, so a recording holds
+    no names or content. Recording is a queue put, a writer thread does the rest.
+    """
+
+    def __init__(self):
+        self.queue = None
+        self.salt = b''
+        self.started = 0.0
+        self.thread = None
+        self.written = 0
+        self.dropped = 0
+        self.max_queued = MAX_QUEUED
+
+    def start(self, path: str):
+        """ Start recording to path, a new salt is used for every recording """
+        self.salt = os.urandom(16)
+        self.started = time.monotonic()
+        self.queue = queue.Queue(self.max_queued)
+        recording = open_recording(path, 'wt')  # pylint: disable=consider-using-with
+        recording.write(json.dumps({'v': 1, 'started': round(time.time())}) + '\n')
+        self.thread = threading.Thread(target=self.run, args=[recording],
+                                       name='traffic-recorder', daemon=True)
+        self.thread.start()
+        # Write the gzip trailer on exit, or the recording can't be read to its end
+        atexit.register(self.stop)
+        logging.info("recording anonymised traffic to %s", path)
+
+    @property
+    def enabled(self) -> bool:
+        """ Whether traffic is being recorded """
+        return self.queue is not None
+
+    def record(self, kind: str, **fields):
+        """ Record an event, text is recorded as its shape """
+        recording = self.queue
+        if recording is not None:
+            try:
+                recording.put_nowait((time.monotonic(), kind, fields))
+            except queue.Full:
+                self.dropped += 1
+
+    def anonymise(self, value) -> str:
+        """ Salted hash of a user or channel """
+        return hmac.new(self.salt, str(value).encode('utf8'), hashlib.sha256).hexdigest()[:12]
+
+    def encode(self, timestamp: float, kind: str, fields: dict) -> str:
+        """ Format one record as a JSON line """
+        record = {'t': round((timestamp - self.started) * 1000), 'k': kind}
+        for name, value in fields.items():
+            if name in ANONYMISED:
+                value = self.anonymise(value)
+            elif name == 'text':
+                name, value = 's', message_shape(value)
+            record[name] = value
+        return json.dumps(record, separators=(',', ':')) + '\n'
+
+    def run(self, recording):
+        """ Write records until stopped, flushing whenever the queue is empty """
+        with recording:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    return
+                recording.write(self.encode(*item))
+                self.written += 1
+                if self.queue.empty():
+                    recording.flush()
+
+    def stop(self):
+        """ Stop recording, writing out what is queued """
+        if self.queue is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.queue = None
+
+traffic = TrafficRecorder()
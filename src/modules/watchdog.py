@@ -0,0 +1,178 @@
+"""
+This file is part of CatPuppetBridge.
+
+CatPuppetBridge is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+CatPuppetBridge is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+CatPuppetBridge. If not, see <https://www.gnu.org/licenses/>.
+
+Copyright (C) 2025 Lisa Marie Maginnis
+
+Lag watchdog for the Discord event loop and the IRC reactors
+"""
+
+import asyncio
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+
+# Loops the bridge can't work without. Only these gate the systemd watchdog,
+# a stalled puppet is reported but restarting the bridge won't help it
+CORE_LOOPS = ('discord', 'listener', 'bot')
+
+def sd_notify(state: str) -> bool:
+    """ Send a state line to systemd if we were started with NOTIFY_SOCKET """
+    address = os.environ.get('NOTIFY_SOCKET')
+    if not address:
+        return False
+    if address.startswith('@'):
+        address = '\0' + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as notify:
+            notify.connect(address)
+            notify.sendall(state.encode('utf8'))
+    except OSError as e:
+        logging.warning("unable to notify systemd: %s", e)
+        return False
+    return True
+
+class Heartbeat():
+    """
+    Last beat of a loop which is expected to beat every interval seconds, and
+    the worst lag seen since the last check
+    """
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.last = time.monotonic()
+        self.lag = 0.0
+        self.thread = threading.get_ident()
+        self.stalled = False
+
+class Watchdog():
+    """
+    Loops beat on a timer of their own, a blocked loop stops beating. A checker
+    thread exports how late each loop is, and dumps the stack of a loop's thread
+    the first time it runs more than `threshold` seconds late.
+    """
+    interval = 1.0
+    threshold = 5.0
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.heartbeats = {}
+        self.stats = None
+        self.thread = None
+        self.notify_interval = None
+
+    def beat(self, name: str, interval: float = None, lag: float = None):
+        """ Record a beat from the calling thread """
+        now = time.monotonic()
+        with self.lock:
+            heartbeat = self.heartbeats.get(name)
+            if heartbeat is None:
+                heartbeat = self.heartbeats[name] = Heartbeat(interval or self.interval)
+            elif lag is None:
+                lag = now - heartbeat.last - heartbeat.interval
+            heartbeat.lag = max(heartbeat.lag, lag or 0.0)
+            heartbeat.last = now
+            heartbeat.thread = threading.get_ident()
+
+    def forget(self, name: str):
+        """ Stop watching a loop which has exited """
+        with self.lock:
+            self.heartbeats.pop(name, None)
+
+    def watch_reactor(self, name: str, reactor):
+        """ Beat from an IRC reactor's scheduler """
+        self.beat(name)
+        reactor.scheduler.execute_every(self.interval, lambda: self.beat(name))
+
+    async def watch_loop(self, name: str):
+        """ Beat from an asyncio loop, measuring how late each wakeup is """
+        self.beat(name)
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.beat(name, lag=time.monotonic() - started - self.interval)
+
+    def check(self) -> dict:
+        """ Export loop lag, dumping the stack of newly stalled loops. Returns lag by group """
+        now = time.monotonic()
+        groups = {}
+        stalled_counts = {}
+        stalled = []
+        with self.lock:
+            for name, heartbeat in self.heartbeats.items():
+                lag = max(heartbeat.lag, now - heartbeat.last - heartbeat.interval)
+                # Puppets are exported as one group, the worst of them
+                group = name.split(':', 1)[0]
+                groups[group] = max(groups.get(group, 0.0), lag)
+                if lag > self.threshold and not heartbeat.stalled:
+                    stalled.append((name, heartbeat.thread, lag))
+                heartbeat.stalled = lag > self.threshold
+                stalled_counts[group] = stalled_counts.get(group, 0) + heartbeat.stalled
+                heartbeat.lag = 0.0
+
+        for name, ident, lag in stalled:
+            frame = sys._current_frames().get(ident)  # pylint: disable=protected-access
+            stack = ''.join(traceback.format_stack(frame)) if frame else '(thread exited)\n'
+            logging.warning("%s is %.1fs behind, stack of its thread:\n%s", name, lag, stack)
+            if self.stats:
+                self.stats.increment(('watchdog_stalls', name.split(':', 1)[0]))
+        if self.stats:
+            for group, lag in groups.items():
+                self.stats.update(('loop_lag', group), lag)
+                self.stats.update(('stalled_loops', group), stalled_counts[group])
+        return groups
+
+    def healthy(self) -> bool:
+        """ Check no core loop is stalled, puppets don't count """
+        with self.lock:
+            return not any(heartbeat.stalled for name, heartbeat in self.heartbeats.items()
+                           if name in CORE_LOOPS)
+
+    def stalled(self) -> list:
+        """ Names of the loops which are stalled, including puppets """
+        with self.lock:
+            return sorted(name for name, heartbeat in self.heartbeats.items()
+                          if heartbeat.stalled)
+
+    def run(self):
+        """ Check loops forever, petting the systemd watchdog while the core loops are healthy """
+        last_notify = 0.0
+        while True:
+            time.sleep(self.interval)
+            self.check()
+            if self.notify_interval and self.healthy() and \
+               time.monotonic() - last_notify >= self.notify_interval:
+                sd_notify('WATCHDOG=1')
+                last_notify = time.monotonic()
+
+    def start(self, stats, interval: float = 1.0, threshold: float = 5.0):
+        """ Start the checker thread, and the systemd watchdog if WatchdogSec is set """
+        self.stats = stats
+        self.interval = interval
+        self.threshold = threshold
+        watchdog_usec = os.environ.get('WATCHDOG_USEC')
+        if watchdog_usec and sd_notify('READY=1'):
+            # systemd recommends petting at half the timeout
+            self.notify_interval = int(watchdog_usec) / 2e6
+            logging.info("systemd watchdog enabled, notifying every %.1fs",
+                         self.notify_interval)
+        self.thread = threading.Thread(target=self.run, name='watchdog', daemon=True)
+        self.thread.start()
+
+watchdog = Watchdog()
@@ -0,0 +1,206 @@
+"""
+This file is part of CatPuppetBridge.
+
+CatPuppetBridge is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+CatPuppetBridge is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+CatPuppetBridge. If not, see <https://www.gnu.org/licenses/>.
+
+Copyright (C) 2025 Lisa Marie Maginnis
+"""
+
+import asyncio
+import threading
+import time
+
+import pytest
+from queue import Full
+import configparser
+
+import main
+from modules.bridge_queue import BridgeQueue, AsyncBridgeQueue, PuppetInbox
+from modules.records import PuppetCommand
+from modules.stats_data import StatsData
+
+def test_queue_block_full():
+    """Test a full queue with the block policy refuses new items"""
+    q = BridgeQueue(2, name='test', policy='block')
+    q.put(1)
+    q.put(2)
+    with pytest.raises(Full):
+        q.put(3, block=False)
+    assert q.qsize() == 2
+
+def test_queue_drop_oldest():
+    """Test a full queue with the drop_oldest policy drops the oldest item"""
+    data = StatsData()
+    q = BridgeQueue(2, name='test', policy='drop_oldest', stats=data)
+    for i in range(5):
+        q.put(i)
+
+    assert [q.get(), q.get()] == [3, 4]
+    assert data.snapshot()[('queue_drops', 'test')] == 3
+    assert data.snapshot()[('queue_high_water', 'test')] == 2
+
+def test_queue_drop_presence():
+    """Test a full queue with drop_presence drops AFK commands before anything else"""
+    data = StatsData()
+    q = BridgeQueue(2, name='test', policy='drop_presence', stats=data)
+    q.put(PuppetCommand('send', 1, data='a'))
+    q.put(PuppetCommand('afk', 1))
+    q.put(PuppetCommand('send', 1, data='b'))
+    # Incoming presence commands are dropped when nothing else can go
+    q.put(PuppetCommand('unafk', 1))
+
+    assert q.get().data == 'a'
+    assert q.get().data == 'b'
+    assert q.qsize() == 0
+    assert data.snapshot()[('queue_drops', 'test')] == 2
+
+def test_queue_spill(tmp_path):
+    """Test a full queue with the spill policy keeps every item in order"""
+    data = StatsData()
+    q = BridgeQueue(2, name='test', policy='spill', stats=data,
+                    spill_directory=str(tmp_path))
+    for i in range(6):
+        q.put(PuppetCommand('send', 1, data=i))
+
+    assert q.qsize() == 2
+    assert [q.get().data for _ in range(6)] == [0, 1, 2, 3, 4, 5]
+    assert data.snapshot()[('queue_spilled', 'test')] == 4
+    assert ('queue_drops', 'test') not in data.snapshot()
+
+@pytest.mark.asyncio
+async def test_async_queue_spill_across_threads(tmp_path):
+    """Test a spilling asyncio queue fed from another thread delivers every item in order"""
+    q = AsyncBridgeQueue(10, name='test', policy='spill', spill_directory=str(tmp_path))
+
+    def produce():
+        for i in range(2000):
+            q.put_nowait(i)
+    producer = threading.Thread(target=produce)
+    producer.start()
+
+    received = []
+    while len(received) < 2000:
+        produced = not producer.is_alive()
+        try:
+            received.append(q.get_nowait())
+        except asyncio.QueueEmpty:
+            assert not produced, f'stalled with {2000 - len(received)} items left'
+            await asyncio.sleep(0)
+    producer.join()
+
+    assert received == list(range(2000))
+    assert q.qsize() == 0 and not q.spill_pending()
+
+class SlowCheckQueue(AsyncBridgeQueue):
+    """AsyncBridgeQueue which pauses after checking for space, as a preempted thread would"""
+    def full(self):
+        full = super().full()
+        time.sleep(0.001)
+        return full
+
+@pytest.mark.asyncio
+async def test_async_queue_block_many_producers():
+    """Test producer threads racing for space on a blocking asyncio queue never lose an item"""
+    q = SlowCheckQueue(1, name='test', policy='block')
+    errors = []
+
+    def produce(start):
+        async def put_all():
+            for i in range(start, start + 20):
+                await q.put(i)
+        try:
+            asyncio.run(put_all())
+        except asyncio.QueueFull as e:
+            errors.append(e)
+    producers = [threading.Thread(target=produce, args=[n * 100]) for n in range(8)]
+    for producer in producers:
+        producer.start()
+
+    received = []
+    while any(producer.is_alive() for producer in producers) or not q.empty():
+        try:
+            received.append(q.get_nowait())
+        except asyncio.QueueEmpty:
+            await asyncio.sleep(0.001)
+    for producer in producers:
+        producer.join()
+
+    assert not errors
+    assert sorted(received) == [n * 100 + i for n in range(8) for i in range(20)]
+
+@pytest.mark.asyncio
+async def test_async_queue_drop_oldest():
+    """Test the asyncio queue applies the same overflow policies"""
+    data = StatsData()
+    q = AsyncBridgeQueue(2, name='test', policy='drop_oldest', stats=data)
+    for i in range(3):
+        await q.put(i)
+
+    assert [q.get_nowait(), q.get_nowait()] == [1, 2]
+    assert data.snapshot()[('queue_drops', 'test')] == 1
+
+def test_read_queue_config_defaults():
+    """Test queue config defaults and overrides from the Queues block"""
+    config = configparser.ConfigParser()
+    config.read_string("[Queues]\npuppet_inbox_size = 5\npuppet_inbox_policy = spill\n")
+    queue_config = main.read_queue_config(config, 'catbridge.ini')
+
+    assert queue_config['puppet_inbox'] == {'size': 5, 'policy': 'spill'}
+    assert queue_config['irc_to_discord_queue'] == {'size': 1000, 'policy': 'drop_oldest'}
+    # Never blocks the Discord loop by default
+    assert queue_config['puppet_queue'] == {'size': 10000, 'policy': 'spill'}
+
+def test_read_queue_config_bad_policy():
+    """Test an unknown queue policy is rejected"""
+    config = configparser.ConfigParser()
+    config.read_string("[Queues]\npuppet_queue_policy = explode\n")
+    with pytest.raises(SystemExit):
+        main.read_queue_config(config, 'catbridge.ini')
+
+def test_puppet_inbox_priority():
+    """Test chat is served before membership changes and AFK state"""
+    q = PuppetInbox(name='inbox')
+    q.put(PuppetCommand('afk', 1))
+    q.put(PuppetCommand('join_part', 1, data=['1']))
+    q.put(PuppetCommand('die', 1))
+    q.put(PuppetCommand('send', 1, data='hi'))
+    q.put(PuppetCommand('send_dm', 1, data='psst'))
+
+    commands = [q.get().command for _ in range(q.qsize())]
+    assert commands == ['send', 'send_dm', 'join_part', 'afk', 'die']
+
+def test_puppet_inbox_coalesce():
+    """Test AFK state and membership commands only keep the latest of each kind"""
+    data = StatsData()
+    q = PuppetInbox(name='inbox', stats=data)
+    for i in range(50):
+        q.put(PuppetCommand('afk' if i % 2 else 'unafk', 1))
+        q.put(PuppetCommand('join_part', 1, data=[str(i)]))
+    q.put(PuppetCommand('send', 1, data='hi'))
+    q.put(PuppetCommand('send', 1, data='there'))
+
+    assert q.qsize() == 4
+    assert [q.get().data for _ in range(2)] == ['hi', 'there']
+    assert q.get().data == ['49']
+    assert q.get().command == 'afk'
+    assert data.snapshot()[('queue_coalesced', 'inbox')] == 98
+
+def test_puppet_inbox_drop_presence_keeps_die():
+    """Test a full inbox drops AFK state before chat, and never drops die"""
+    q = PuppetInbox(2, name='inbox', policy='drop_presence')
+    q.put(PuppetCommand('afk', 1))
+    q.put(PuppetCommand('die', 1))
+    q.put(PuppetCommand('send', 1, data='hi'))
+    q.put(PuppetCommand('send', 1, data='there'))
+
+    assert [q.get().command for _ in range(q.qsize())] == ['send', 'die']
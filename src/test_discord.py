@@ -27,6 +27,9 @@ import discord
 
 from modules.discord_bridge import DiscordBot
 from modules.discord_filters import DiscordFilters
+from modules.member_cache import MemberCache
+from modules.records import RelayMessage
+from modules.registry import Registry
 from modules.stats_data import StatsData
 
 
@@ -128,6 +131,8 @@ def bot():
     real.get_user = get_user
     real.fetch_user = fetch_user
     real.data = StatsData()
+    # Don't start the lag watchdog task in on_ready
+    real.lag_task = MagicMock()
 
     real.listener_config = {}
     real.listener_config['puppet_suffix'] = '_d2'
@@ -189,9 +194,8 @@ async def test_on_member_update(bot):
 
 
     data = bot.queues['puppet_queue'].get(False)
-    assert data['display_name'] == 'name_b'
-    assert data['irc_nick'] == 'name_b[TestUser]'
-    assert data['name'] == 'TestUser'
+    assert data.command == 'nick'
+    assert data.irc_nick == 'name_b[TestUser]'
 
 
 @pytest.mark.filterwarnings("ignore:coroutine 'AsyncMockMixin._execute_mock_call' was never awaited:RuntimeWarning")
@@ -215,7 +219,7 @@ async def test_on_presence_update_online_to_offline(bot):
     assert bot.queues['puppet_queue'].qsize() == 1
 
     data = bot.queues['puppet_queue'].get(False)
-    assert data['command'] == 'afk'
+    assert data.command == 'afk'
 
 @pytest.mark.filterwarnings("ignore:coroutine 'AsyncMockMixin._execute_mock_call' was never awaited:RuntimeWarning")
 @pytest.mark.filterwarnings("ignore:coroutine 'DiscordBot.process_dm_queue' was never awaited:RuntimeWarning")
@@ -238,7 +242,7 @@ async def test_on_presence_update_online_to_dnd(bot):
     assert bot.queues['puppet_queue'].qsize() == 1
 
     data = bot.queues['puppet_queue'].get(False)
-    assert data['command'] == 'afk'
+    assert data.command == 'afk'
 
 @pytest.mark.filterwarnings("ignore:coroutine 'AsyncMockMixin._execute_mock_call' was never awaited:RuntimeWarning")
 @pytest.mark.filterwarnings("ignore:coroutine 'DiscordBot.process_dm_queue' was never awaited:RuntimeWarning")
@@ -261,7 +265,7 @@ async def test_on_presence_update_offline_to_idle(bot):
     assert bot.queues['puppet_queue'].qsize() == 1
 
     data = bot.queues['puppet_queue'].get(False)
-    assert data['command'] == 'unafk'
+    assert data.command == 'unafk'
 
 @pytest.mark.filterwarnings("ignore:coroutine 'AsyncMockMixin._execute_mock_call' was never awaited:RuntimeWarning")
 @pytest.mark.filterwarnings("ignore:coroutine 'DiscordBot.process_dm_queue' was never awaited:RuntimeWarning")
@@ -284,7 +288,7 @@ async def test_on_presence_update_offline_to_online(bot):
     assert bot.queues['puppet_queue'].qsize() == 1
 
     data = bot.queues['puppet_queue'].get(False)
-    assert data['command'] == 'unafk'
+    assert data.command == 'unafk'
 
 @pytest.mark.filterwarnings("ignore:coroutine 'AsyncMockMixin._execute_mock_call' was never awaited:RuntimeWarning")
 @pytest.mark.filterwarnings("ignore:coroutine 'DiscordBot.process_dm_queue' was never awaited:RuntimeWarning")
@@ -307,7 +311,7 @@ async def test_on_presence_update_dnd_to_online(bot):
     assert bot.queues['puppet_queue'].qsize() == 1
 
     data = bot.queues['puppet_queue'].get(False)
-    assert data['command'] == 'unafk'
+    assert data.command == 'unafk'
 
 @pytest.mark.filterwarnings("ignore:coroutine 'AsyncMockMixin._execute_mock_call' was never awaited:RuntimeWarning")
 @pytest.mark.filterwarnings("ignore:coroutine 'DiscordBot.process_dm_queue' was never awaited:RuntimeWarning")
@@ -369,7 +373,7 @@ async def test_on_member_remove(bot):
     assert bot.queues['puppet_queue'].qsize() == 1
 
     data = bot.queues['puppet_queue'].get(False)
-    assert data['command'] == 'die'
+    assert data.command == 'die'
 
 @pytest.mark.filterwarnings("ignore:coroutine 'AsyncMockMixin._execute_mock_call' was never awaited:RuntimeWarning")
 @pytest.mark.filterwarnings("ignore:coroutine 'DiscordBot.process_dm_queue' was never awaited:RuntimeWarning")
@@ -434,12 +438,12 @@ async def test_on_message(bot):
 
     assert bot.queues['puppet_queue'].qsize() == 2
     data = bot.queues['puppet_queue'].get(False)
-    assert data['command'] == 'active'
+    assert data.command == 'active'
 
     assert bot.queues['puppet_queue'].qsize() == 1
     data = bot.queues['puppet_queue'].get(False)
-    assert data['command'] == 'send'
-    assert data['data'] == message.content
+    assert data.command == 'send'
+    assert data.data == message.content
 
 @pytest.mark.asyncio
 async def test_on_message_with_time(bot):
@@ -451,12 +455,12 @@ async def test_on_message_with_time(bot):
 
     assert bot.queues['puppet_queue'].qsize() == 2
     data = bot.queues['puppet_queue'].get(False)
-    assert data['command'] == 'active'
+    assert data.command == 'active'
 
     assert bot.queues['puppet_queue'].qsize() == 1
     data = bot.queues['puppet_queue'].get(False)
-    assert data['command'] == 'send'
-    assert data['data'] == 'Hey lets meet at 09:39'
+    assert data.command == 'send'
+    assert data.data == 'Hey lets meet at 09:39'
 
 @pytest.mark.asyncio
 async def test_custom_emote(bot):
@@ -514,3 +518,336 @@ async def test_mention_remove(bot):
 
     assert len(bot.filters.mention_lookup) == lookup_size - 1
     assert content == msg
+
+@pytest.mark.filterwarnings("ignore:coroutine 'AsyncMockMixin._execute_mock_call' was never awaited:RuntimeWarning")
+@pytest.mark.filterwarnings("ignore:coroutine 'DiscordBot.process_dm_queue' was never awaited:RuntimeWarning")
+@pytest.mark.asyncio
+async def test_on_presence_update_debounce_flapping(bot):
+    user_online = create_fake_user(id=4242)
+    user_offline = create_fake_user(id=4242, status=discord.Status.offline)
+
+    with patch.object(bot.loop, "create_task", lambda coro: None):
+        with patch.object(bot, "process_queue", AsyncMock()):
+            await bot.on_ready()
+    await bot.activate_puppet(user_online)
+    data = bot.queues['puppet_queue'].get(False)
+
+    bot.loop = asyncio.get_running_loop()
+    bot.listener_config['presence_debounce'] = 0.05
+    for _ in range(5):
+        await bot.on_presence_update(user_online, user_offline)
+        await bot.on_presence_update(user_offline, user_online)
+    await asyncio.sleep(0.1)
+
+    # Flapping back to online never reaches IRC, and each flap is suppressed once
+    assert bot.queues['puppet_queue'].qsize() == 0
+    assert bot.data.snapshot()['presence_transitions'] == 10
+    assert bot.data.snapshot()['presence_suppressed'] == 5
+
+@pytest.mark.filterwarnings("ignore:coroutine 'AsyncMockMixin._execute_mock_call' was never awaited:RuntimeWarning")
+@pytest.mark.filterwarnings("ignore:coroutine 'DiscordBot.process_dm_queue' was never awaited:RuntimeWarning")
+@pytest.mark.asyncio
+async def test_on_presence_update_debounce_final_state(bot):
+    user_online = create_fake_user(id=4243)
+    user_offline = create_fake_user(id=4243, status=discord.Status.offline)
+
+    with patch.object(bot.loop, "create_task", lambda coro: None):
+        with patch.object(bot, "process_queue", AsyncMock()):
+            await bot.on_ready()
+    await bot.activate_puppet(user_online)
+    data = bot.queues['puppet_queue'].get(False)
+
+    bot.loop = asyncio.get_running_loop()
+    bot.listener_config['presence_debounce'] = 0.05
+    await bot.on_presence_update(user_online, user_offline)
+    await bot.on_presence_update(user_offline, user_online)
+    await bot.on_presence_update(user_online, user_offline)
+    assert bot.queues['puppet_queue'].qsize() == 0
+    await asyncio.sleep(0.1)
+
+    # Only the final state is sent once stable
+    assert bot.queues['puppet_queue'].qsize() == 1
+    data = bot.queues['puppet_queue'].get(False)
+    assert data.command == 'afk'
+    assert bot.data.snapshot()['presence_suppressed'] == 1
+
+@pytest.mark.filterwarnings("ignore:coroutine 'AsyncMockMixin._execute_mock_call' was never awaited:RuntimeWarning")
+@pytest.mark.filterwarnings("ignore:coroutine 'DiscordBot.process_dm_queue' was never awaited:RuntimeWarning")
+@pytest.mark.asyncio
+async def test_role_storm_coalesced(bot):
+    members = [create_fake_user(id=5000 + i, name=f'storm{i}') for i in range(3)]
+    with patch.object(bot.loop, "create_task", lambda coro: None):
+        with patch.object(bot, "process_queue", AsyncMock()):
+            await bot.on_ready()
+    for member in members:
+        await bot.activate_puppet(member)
+    while bot.queues['puppet_queue'].qsize():
+        bot.queues['puppet_queue'].get(False)
+
+    bot.loop = asyncio.get_running_loop()
+    bot.listener_config['membership_window'] = 0.05
+    bot.accessible_channels = AsyncMock(return_value=['1', '2'])
+
+    # Several role edits hit every member before the window closes
+    role_before = MagicMock(permissions=1)
+    role_after = MagicMock(permissions=2, members=members)
+    for _ in range(3):
+        await bot.on_guild_role_update(role_before, role_after)
+        member_before = MagicMock(roles=[1], display_name=members[0].display_name)
+        member_after = MagicMock(roles=[2], id=members[0].id,
+                                 display_name=members[0].display_name)
+        await bot.on_member_update(member_before, member_after)
+    assert bot.queues['puppet_queue'].qsize() == 0
+    await asyncio.sleep(0.1)
+
+    assert bot.queues['puppet_queue'].qsize() == 3
+    commands = [bot.queues['puppet_queue'].get(False) for _ in range(3)]
+    assert sorted(c.id for c in commands) == [5000, 5001, 5002]
+    assert all(c.command == 'join_part' for c in commands)
+
+@pytest.mark.asyncio
+async def test_membership_flush_survives_missing_member(bot):
+    """Test a queued member who can't be found doesn't stop the others being flushed"""
+    bot.active_puppets = [5200, 5201, 5202]
+    bot.membership_pending = set()
+    bot.puppet_channels = {}
+    bot.listener_config['membership_window'] = 0
+    members = {5200: create_fake_user(id=5200), 5202: create_fake_user(id=5202)}
+
+    async def find_member(user_id, member=None):
+        if user_id not in members:
+            raise discord.NotFound(MagicMock(status=404), 'Unknown Member')
+        return members[user_id]
+    bot.find_member = find_member
+    bot.accessible_channels = AsyncMock(return_value=['1'])
+
+    await bot.queue_membership([5200, 5201, 5202])
+
+    commands = [bot.queues['puppet_queue'].get(False) for _ in range(2)]
+    assert sorted(c.id for c in commands) == [5200, 5202]
+    assert bot.queues['puppet_queue'].empty()
+    # The resolved member is passed on, instead of being looked up again
+    bot.accessible_channels.assert_any_await(5200, members[5200])
+
+@pytest.mark.asyncio
+async def test_deactivate_clears_pending_membership(bot):
+    """Test a deactivated puppet is no longer queued for a membership flush"""
+    member = create_fake_user(id=5300)
+    bot.active_puppets = [member.id]
+    bot.membership_pending = {member.id}
+
+    await bot.deactivate_puppet(member)
+
+    assert member.id not in bot.membership_pending
+
+@pytest.mark.filterwarnings("ignore:coroutine 'AsyncMockMixin._execute_mock_call' was never awaited:RuntimeWarning")
+@pytest.mark.filterwarnings("ignore:coroutine 'DiscordBot.process_dm_queue' was never awaited:RuntimeWarning")
+@pytest.mark.asyncio
+async def test_role_change_without_channel_change(bot):
+    member = create_fake_user(id=5100)
+    with patch.object(bot.loop, "create_task", lambda coro: None):
+        with patch.object(bot, "process_queue", AsyncMock()):
+            await bot.on_ready()
+    await bot.activate_puppet(member)
+    bot.queues['puppet_queue'].get(False)
+
+    role_before = MagicMock(permissions=1)
+    role_after = MagicMock(permissions=2, members=[member, create_fake_user(id=5101)])
+    await bot.on_guild_role_update(role_before, role_after)
+
+    # Channels did not change and 5101 has no puppet
+    assert bot.queues['puppet_queue'].qsize() == 0
+
+def irc_line(content, author='ircuser', channel='#test1'):
+    return RelayMessage(author, channel, content)
+
+@pytest.mark.asyncio
+async def test_coalesce_irc_messages(bot):
+    bot.listener_config['coalesce_window'] = 0.05
+    bot.listener_config['coalesce_max_delay'] = 0.5
+    bot.queues['irc_to_discord_queue'] = asyncio.Queue()
+    for line in ['two', 'three']:
+        bot.queues['irc_to_discord_queue'].put_nowait(irc_line(line))
+    bot.queues['irc_to_discord_queue'].put_nowait(irc_line('other', author='someoneelse'))
+
+    msg, pending = await bot.coalesce_irc_messages(irc_line('one'))
+
+    assert msg.content == 'one\ntwo\nthree'
+    assert pending.author == 'someoneelse'
+    assert bot.data.counters()['coalesced_messages'] == 1
+
+@pytest.mark.asyncio
+async def test_coalesce_irc_messages_size_limit(bot):
+    bot.listener_config['coalesce_window'] = 0.05
+    bot.queues['irc_to_discord_queue'] = asyncio.Queue()
+    for _ in range(5):
+        bot.queues['irc_to_discord_queue'].put_nowait(irc_line('x' * 450))
+
+    msg, pending = await bot.coalesce_irc_messages(irc_line('x' * 450))
+
+    assert len(msg.content) <= 2000
+    assert msg.content.count('\n') == 3
+    assert pending.content == 'x' * 450
+
+@pytest.mark.asyncio
+async def test_relay_recreates_missing_webhook(bot):
+    """Test a deleted webhook is recreated and the message sent through the new one"""
+    gone = AsyncMock()
+    gone.send.side_effect = discord.NotFound(MagicMock(status=404), 'Unknown Webhook')
+    recreated = AsyncMock()
+    channel = AsyncMock()
+    channel.id = 1
+    channel.webhooks.return_value = []
+    channel.create_webhook.return_value = recreated
+    bot.webhooks = {channel.id: gone}
+    bot.discord_channel_mapping = {'#test1': channel}
+    bot.find_avatar = AsyncMock(return_value='https://example.net/cat.png')
+
+    await bot.relay_to_discord(irc_line('still here'))
+
+    recreated.send.assert_awaited_once_with('still here', username='ircuser',
+                                            avatar_url='https://example.net/cat.png')
+    assert bot.webhooks[channel.id] is recreated
+
+def test_split_discord_message(bot):
+    content = '\n'.join(['y' * 500] * 6)
+    chunks = bot.split_discord_message(content)
+
+    assert len(chunks) == 2
+    assert all(len(chunk) <= 2000 for chunk in chunks)
+    assert '\n'.join(chunks) == content
+
+@pytest.mark.asyncio
+async def test_dry_run_records_instead_of_sending(bot):
+    bot.listener_config['dry_run'] = True
+    bot.webhooks = {}
+    channel = AsyncMock()
+    channel.id = 1
+    user = create_fake_user()
+    user.send.reset_mock()
+
+    webhook = await bot.find_webhook(channel)
+    await webhook.send('hello', username='cat')
+    await bot.send_dm(user, 'psst')
+
+    channel.webhooks.assert_not_awaited()
+    channel.create_webhook.assert_not_awaited()
+    user.send.assert_not_awaited()
+    assert bot.data.counters()[('dry_run_sends', 'discord')] == 2
+    bot.listener_config.pop('dry_run')
+
+class MemberGuild():
+    """Guild with a member cache like discord.Guild, fetching from everyone"""
+    def __init__(self, members):
+        self.everyone = {member.id: member for member in members}
+        self._members = {}
+        for member in members:
+            member.guild = self
+
+    def get_member(self, user_id):
+        return self._members.get(user_id)
+
+    async def fetch_member(self, user_id):
+        return self.everyone[user_id]
+
+    def _add_member(self, member):
+        self._members[member.id] = member
+
+    def _remove_member(self, member):
+        self._members.pop(member.id, None)
+
+@pytest.mark.asyncio
+async def test_lean_member_cache(bot):
+    """Test the lean member cache keeps puppets and the most recently seen members"""
+    members = [create_fake_user(id=i, name=f'user{i}') for i in range(4)]
+    guild = MemberGuild(members)
+    bot._connection.guilds = [guild]
+    bot.member_cache = MemberCache(2, bot.data)
+    bot.discord_channel_mapping = {}
+
+    await bot.activate_puppet(members[0])
+    for member in members[1:]:
+        await bot.find_member(member.id)
+    assert await bot.find_member(3) is members[3]
+
+    # user1 was least recently used, the puppet is pinned
+    assert set(guild._members) == {0, 2, 3}
+    assert await bot.find_avatar('user0') == members[0].avatar.url
+    assert await bot.find_avatar('user1') is None
+    counters = bot.data.counters()
+    assert counters[('member_cache', 'fetch')] == 4
+    assert counters[('member_cache', 'hit')] == 1
+    assert counters[('member_cache', 'evict')] == 1
+
+    await bot.on_member_remove(members[0])
+    assert 0 not in bot.member_cache.pinned
+
+@pytest.mark.asyncio
+async def test_activity_mode(bot):
+    """Test activity mode marks puppets away, then hibernates them, when their user is quiet"""
+    bot.ready = True
+    bot.loop = MagicMock()
+    bot.loop.time.return_value = 100.0
+    bot.listener_config.update({'presence_mode': 'activity', 'away_after': 60,
+                                'hibernate_after': 600})
+    bot.discord_channel_mapping = {}
+    bot.active_puppets = []
+    bot.last_active = {}
+    bot.presence_state = {}
+    bot.registry = Registry()
+    user = create_fake_user(id=7000, name='quiet')
+    message = create_fake_message(user=user)
+    message.content = ''
+
+    await bot.on_message(message)
+    assert bot.queues['puppet_queue'].get(False).command == 'active'
+
+    await bot.check_activity(159.0)
+    assert bot.queues['puppet_queue'].empty()
+    await bot.check_activity(160.0)
+    assert bot.queues['puppet_queue'].get(False).command == 'afk'
+    await bot.check_activity(170.0)
+    assert bot.queues['puppet_queue'].empty()
+
+    bot.loop.time.return_value = 200.0
+    await bot.on_message(message)
+    assert bot.queues['puppet_queue'].get(False).command == 'unafk'
+
+    await bot.check_activity(800.0)
+    data = bot.queues['puppet_queue'].get(False)
+    assert data.command == 'die'
+    assert data.data.startswith('hibernating')
+    assert user.id not in bot.active_puppets
+    assert bot.registry.items('hibernated') == [(user.id, 800.0)]
+
+    # Talking again brings the puppet back
+    await bot.on_message(message)
+    assert bot.queues['puppet_queue'].get(False).command == 'active'
+    assert bot.queues['puppet_queue'].empty()
+    assert bot.registry.items('hibernated') == []
+
+@pytest.mark.asyncio
+async def test_activity_mode_member_left(bot):
+    """Test a quiet user who left the guild doesn't stop the others hibernating"""
+    bot.listener_config.update({'presence_mode': 'activity', 'away_after': 0,
+                                'hibernate_after': 600})
+    bot.registry = Registry()
+    stayed = create_fake_user(id=7100, name='stayed')
+    bot.active_puppets = [7101, stayed.id]
+    bot.last_active = {7101: 0.0, stayed.id: 0.0}
+    bot.presence_state = {7101: 'unafk'}
+
+    async def find_member(user_id, member=None):
+        if user_id != stayed.id:
+            raise discord.NotFound(MagicMock(status=404), 'Unknown Member')
+        return stayed
+    bot.find_member = find_member
+
+    await bot.check_activity(800.0)
+
+    data = bot.queues['puppet_queue'].get(False)
+    assert (data.command, data.id) == ('die', stayed.id)
+    assert bot.registry.items('hibernated') == [(stayed.id, 800.0)]
+    assert bot.active_puppets == []
+    assert bot.last_active == {}
+    assert bot.presence_state == {}
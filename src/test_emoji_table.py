@@ -0,0 +1,34 @@
+"""
+This file is part of CatPuppetBridge.
+
+CatPuppetBridge is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+CatPuppetBridge is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+CatPuppetBridge. If not, see <https://www.gnu.org/licenses/>.
+
+Copyright (C) 2025 Lisa Marie Maginnis
+"""
+
+import pytest
+
+from modules.emoji_table import emojize, shortcodes
+
+def test_emojize():
+    """Test shortcodes and aliases are found, and unknown names are not"""
+    assert emojize('thumbsup') == '👍'
+    assert emojize('thumbs_up') == '👍'
+    assert emojize('red_heart') == '❤️'
+    assert emojize('not_an_emoji') is None
+
+def test_table_is_up_to_date():
+    """Test the shipped table matches the installed emoji package"""
+    pytest.importorskip('emoji')
+    from tools.emoji_table import build_shortcodes
+    assert shortcodes() == build_shortcodes()
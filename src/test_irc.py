@@ -23,17 +23,22 @@ from queue import Queue
 from unittest.mock import MagicMock, patch
 import logging
 from irc import server
+import irc.client
 import asyncio
 
-from modules.irc_bridge import IRCBot, IRCListener, IRCPuppet
+from modules.irc_bridge import IRCBot, IRCListener, IRCPuppet, chunk_channels, FloodControl
+from modules.irc_bridge import MembershipAggregator
+from modules.stats_data import StatsData
+from modules.tracing import record_trace
+from modules.registry import Registry
+from modules.bridge_queue import BridgeQueue, PuppetInbox
+from modules.dry_run import DryRunConnection
+from modules.records import PuppetCommand
 
 irc_server = server
 
-message = {
-    'channel': '#test-channel',
-    'nickname': 'test_user',
-    'data': 'The quick brown fox jumped over the lazy dog'
-}
+message = PuppetCommand('send', 1, 'test_user', 'The quick brown fox jumped over the lazy dog',
+                        '#test-channel')
 
 def reset_puppet(puppet):
     puppet.config['nickname'] = 'testPuppet[puppet]_d2'
@@ -76,36 +81,32 @@ def test_puppet_split_irc_message_short_message(puppet):
 
 def test_puppet_split_irc_message_long_message(puppet):
     """Verify split_irc_message() split a long message, should be split into 2 smaller messages"""
-    msg = message
-    msg['data'] = 'The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog.'
-    result = puppet.split_irc_message(message)
+    msg = message._replace(data='The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog.')
+    result = puppet.split_irc_message(msg)
     assert len(result) == 2
 
 def test_puppet_split_irc_message_very_long_message(puppet):
     """Verify split_irc_message() split very long message, should be split into 6 smaller messages"""
-    msg = message
-    msg['data'] = 'The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. '
-    result = puppet.split_irc_message(message)
+    msg = message._replace(data='The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. ')
+    result = puppet.split_irc_message(msg)
     assert len(result) == 6
 
 def test_puppet_split_irc_message_hostname(puppet):
     """Verify split_irc_message() split a long message due to a long hostname, should be split into 2 smaller messages"""
-    msg = message
-    msg['data'] = 'The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog.'
+    msg = message._replace(data='The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog.')
 
     # Set the long hostname
     puppet.config['webirc_hostname'] = 'localhostlocalhostlocalhostlocalhost'
-    result = puppet.split_irc_message(message)
+    result = puppet.split_irc_message(msg)
     assert len(result) == 2
 
 def test_puppet_split_irc_message_username(puppet):
     """Verify split_irc_message() split a long message due to a long username, should be split into 2 smaller messages"""
-    msg = message
-    msg['data'] = 'The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog.'
+    msg = message._replace(data='The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog. The quick brown fox jumped over the lazy dog.')
 
     # Set the long hostname
     puppet.config['nickname'] = 'testUsertestUsertestUsertestUser[TestUser]_d2'
-    result = puppet.split_irc_message(message)
+    result = puppet.split_irc_message(msg)
     assert len(result) == 2
 
 def test_puppet_join_part_part_channel(puppet):
@@ -160,19 +161,17 @@ async def test_puppet_on_privmsg(puppet):
 
     # Assert data is correct
     data = await puppet.queues['out_queue'].get()
-    assert data['author'] == 'TestUser'
-    assert data['channel'] == '123456'
-    assert data['content'] == event.arguments[0]
+    assert data.author == 'TestUser'
+    assert data.channel == '123456'
+    assert data.content == event.arguments[0]
 
 def test_puppet_process_discord_queue_afk(puppet): 
     """Test if inbound queue receives "AFK" and processes it"""
-    msg = {}
-    msg['command'] = 'afk'
+    msg = PuppetCommand('afk', 1)
     puppet.queues['in_queue'].put(msg)
 
     # needed to break the loop
-    msg2 = {}
-    msg2['command'] = 'die'
+    msg2 = PuppetCommand('die', 1)
     puppet.queues['in_queue'].put(msg2)
 
     with pytest.raises(SystemExit):
@@ -182,13 +181,11 @@ def test_puppet_process_discord_queue_afk(puppet):
 
 def test_puppet_process_discord_queue_unafk(puppet): 
     """Test if inbound queue receives "UNAFK" and processes it"""
-    msg = {}
-    msg['command'] = 'unafk'
+    msg = PuppetCommand('unafk', 1)
     puppet.queues['in_queue'].put(msg)
 
     # needed to break the loop
-    msg2 = {}
-    msg2['command'] = 'die'
+    msg2 = PuppetCommand('die', 1)
     puppet.queues['in_queue'].put(msg2)
 
     with pytest.raises(SystemExit):
@@ -198,34 +195,28 @@ def test_puppet_process_discord_queue_unafk(puppet):
 
 def test_puppet_process_discord_queue_nick(puppet): 
     """Test if inbound queue receives "nick" and processes it"""
-    msg = {}
-    msg['command'] = 'nick'
-    msg['irc_nick'] = 'newNick[newUsername]_d2'
+    msg = PuppetCommand('nick', 1, 'newNick[newUsername]_d2')
     puppet.queues['in_queue'].put(msg)
 
     # needed to break the loop
-    msg2 = {}
-    msg2['command'] = 'die'
+    msg2 = PuppetCommand('die', 1)
     puppet.queues['in_queue'].put(msg2)
 
     with pytest.raises(SystemExit):
         puppet.process_discord_queue()
 
-    puppet.connection.nick.assert_called_once_with(msg['irc_nick'])
+    puppet.connection.nick.assert_called_once_with(msg.irc_nick)
 
 def test_puppet_process_discord_queue_join(puppet): 
     """Test if inbound queue receives "join_part" and processes it to join a channel"""
-    msg = {}
-    msg['command'] = 'join_part'
     new_channel = '4'
     channels = puppet.channels.copy()
     channels.append(new_channel)
-    msg['data'] = channels
+    msg = PuppetCommand('join_part', 1, data=channels)
     puppet.queues['in_queue'].put(msg)
 
     # needed to break the loop
-    msg2 = {}
-    msg2['command'] = 'die'
+    msg2 = PuppetCommand('die', 1)
     puppet.queues['in_queue'].put(msg2)
 
     with pytest.raises(SystemExit):
@@ -238,16 +229,13 @@ def test_puppet_process_discord_queue_join(puppet):
     
 def test_puppet_process_discord_queue_part(puppet): 
     """Test if inbound queue receives "join_part" and processes it to part a channel"""
-    msg = {}
-    msg['command'] = 'join_part'
     channels = puppet.channels.copy()
     channels.remove('2')
-    msg['data'] = channels
+    msg = PuppetCommand('join_part', 1, data=channels)
     puppet.queues['in_queue'].put(msg)
 
     # needed to break the loop
-    msg2 = {}
-    msg2['command'] = 'die'
+    msg2 = PuppetCommand('die', 1)
     puppet.queues['in_queue'].put(msg2)
 
     with pytest.raises(SystemExit):
@@ -259,19 +247,191 @@ def test_puppet_process_discord_queue_part(puppet):
 
 def test_puppet_process_discord_queue_send(puppet): 
     """Test if inbound queue receives "nick" and processes it"""
-    msg = {}
-    msg['command'] = 'send'
-    msg['channel'] = '3'
-    msg['data'] = 'The quick brown fox jumped over the lazy dog.'
+    msg = PuppetCommand('send', 1, data='The quick brown fox jumped over the lazy dog.', channel='3')
 
     puppet.queues['in_queue'].put(msg)
 
     # needed to break the loop
-    msg2 = {}
-    msg2['command'] = 'die'
+    msg2 = PuppetCommand('die', 1)
     puppet.queues['in_queue'].put(msg2)
 
     with pytest.raises(SystemExit):
         puppet.process_discord_queue()
 
-    puppet.connection.privmsg.assert_called_once_with(puppet.discord_to_irc_links[msg['channel']], msg['data'])
+    puppet.connection.privmsg.assert_called_once_with(puppet.discord_to_irc_links[msg.channel], msg.data)
+
+def test_puppet_join_part_batched(puppet):
+    """Test join_part() joins and parts several channels with one line each"""
+    puppet.discord_to_irc_links.update({'5': '#five', '6': '#six'})
+    channels = ['3', '4', '5', '6']
+
+    puppet.join_part(channels)
+
+    puppet.connection.join.assert_called_once_with('#new_channel,#five,#six')
+    puppet.connection.part.assert_called_once_with('#test1,#test2')
+    assert puppet.channels == channels
+
+def test_chunk_channels_line_limit():
+    """Test chunk_channels() never builds a line longer than 512 bytes"""
+    channels = ['#channel' + str(i) for i in range(200)]
+    chunks = chunk_channels('JOIN', channels)
+
+    assert len(chunks) > 1
+    for chunk in chunks:
+        assert len(('JOIN ' + chunk + '\r\n').encode('utf8')) <= 512
+    assert ','.join(chunks).split(',') == channels
+
+def test_flood_control_burst():
+    """Test FloodControl allows a burst then waits for the rate"""
+    import time
+    flood = FloodControl(3, 50)
+    start = time.monotonic()
+    for _ in range(5):
+        flood.wait()
+    elapsed = time.monotonic() - start
+
+    assert 0.03 <= elapsed < 0.5
+
+@pytest.fixture
+def listener():
+    real = IRCListener.__new__(IRCListener)
+    real.log = logging.getLogger('unittest')
+    real.config = {'puppet_suffix': '_d2', 'listener_nickname': 'listener_d2',
+                   'membership_window': 5}
+    real.out_queue = asyncio.Queue()
+    real.members = {}
+    real.membership = MembershipAggregator()
+    real.reactor = MagicMock()
+    real.data = MagicMock()
+    yield real
+
+def membership_event(source, target, arguments=None):
+    event = MagicMock()
+    event.source = source + '!ident@host'
+    event.target = target
+    event.arguments = arguments or []
+    return event
+
+def test_listener_membership_single_events(listener):
+    """Test a handful of membership events are relayed as one line per channel"""
+    listener.on_join(None, membership_event('alice', '#test1'))
+    listener.on_join(None, membership_event('bob_d2', '#test1'))
+    listener.on_nick(None, membership_event('alice', 'alice_away'))
+    listener.flush_membership()
+
+    listener.reactor.scheduler.execute_after.assert_called_once()
+    assert listener.out_queue.qsize() == 1
+    data = listener.out_queue.get_nowait()
+    assert data.channel == '#test1'
+    assert data.content == '*alice has joined; alice is now known as alice_away*'
+
+def test_listener_membership_netsplit(listener):
+    """Test a netsplit is summarised instead of relaying every quit"""
+    names = ' '.join(f'user{i}' for i in range(12))
+    listener.on_namreply(None, membership_event('server', 'listener_d2',
+                                                ['=', '#test1', '@op ' + names]))
+    listener.on_namreply(None, membership_event('server', 'listener_d2',
+                                                ['=', '#test2', 'user0 user1']))
+    for i in range(12):
+        listener.on_quit(None, membership_event(f'user{i}', '',
+                                                ['hub.example.net leaf.example.net']))
+    listener.flush_membership()
+
+    lines = {}
+    while listener.out_queue.qsize():
+        data = listener.out_queue.get_nowait()
+        lines[data.channel] = data.content
+    assert lines['#test1'] == '*12 users quit (netsplit)*'
+    assert lines['#test2'] == ('*user0 has quit (hub.example.net leaf.example.net); '
+                               'user1 has quit (hub.example.net leaf.example.net)*')
+
+def test_bot_stats_latency():
+    """Test the latency command reports percentiles per stage"""
+    bot = IRCBot.__new__(IRCBot)
+    bot.connection = MagicMock()
+    bot.stats_data = StatsData()
+    record_trace(bot.stats_data, 'irc_to_discord',
+                 [('ingress', 10.0), ('queue', 10.002), ('discord_send', 10.3)])
+    event = MagicMock()
+    event.source.nick = 'admin'
+    bot.do_command(event, 'stats latency')
+
+    lines = [call.args[1] for call in bot.connection.privmsg.call_args_list]
+    assert 'irc to discord:' in lines
+    assert any(line.startswith('  queue: p50=') for line in lines)
+    assert any(line.startswith('  total: p50=') for line in lines)
+    assert not any(line.startswith('  coalesce') for line in lines)
+
+def test_bot_admin_reports(puppet):
+    """Test the puppets, queues and conn commands read from the registry"""
+    bot = IRCBot.__new__(IRCBot)
+    bot.connection = MagicMock()
+    bot.registry = Registry()
+    bot.registry.register('connections', 'bot', bot)
+    inbox = PuppetInbox(name='puppet_inbox')
+    inbox.put(PuppetCommand('send', 1, data='hi'))
+    puppet.queues['in_queue'] = inbox
+    puppet.flood = FloodControl(10, 2)
+    puppet.last_activity = 0
+    bot.registry.register('puppets', puppet.discord_id, puppet)
+    bot.registry.register('queues', 'puppet_queue', BridgeQueue(name='puppet_queue'))
+    bot.registry.register('hibernated', 7000, 100.0)
+    event = MagicMock()
+    event.source.nick = 'admin'
+
+    for command in ('puppets', 'queues', 'conn'):
+        bot.do_command(event, command)
+    lines = [call.args[1] for call in bot.connection.privmsg.call_args_list]
+
+    assert lines[0] == 'Puppets: 1 (connecting: 0, ready: 1, away: 0), hibernated: 1'
+    assert lines[1].startswith('  testPuppet[puppet]_d2: ready, inbox 1,')
+    assert lines[2] == 'puppet_queue: 0 queued, high water 0, block'
+    assert lines[3].startswith('puppet inboxes: 1 queued over 1')
+    assert lines[4].startswith('bot: 0 reconnects')
+    assert 'flood backlog 0' in lines[5]
+
+def test_bot_admin_commands_authorised(tmp_path):
+    """Test dump and profile are refused outside the bot channel unless from an admin"""
+    bot = IRCBot.__new__(IRCBot)
+    bot.connection = MagicMock()
+    bot.log = logging.getLogger('unittest')
+    bot.channel = '#bots'
+    bot.admins = ['Admin!*@trusted.example.net']
+    bot.dump_directory = str(tmp_path)
+    stranger = MagicMock(type='privmsg', target='DiscordBridge',
+                         source=irc.client.NickMask('someone!user@elsewhere.example.net'))
+    admin = MagicMock(type='privmsg', target='DiscordBridge',
+                      source=irc.client.NickMask('admin!user@trusted.example.net'))
+    in_channel = MagicMock(type='pubmsg', target='#Bots',
+                           source=irc.client.NickMask('someone!user@elsewhere.example.net'))
+
+    bot.do_command(stranger, 'dump')
+    bot.do_command(stranger, 'profile start')
+    assert not list(tmp_path.iterdir())
+    bot.do_command(admin, 'dump')
+    bot.do_command(in_channel, 'dump')
+
+    lines = [call.args[1] for call in bot.connection.privmsg.call_args_list]
+    assert lines[0] == 'dump is only allowed in #bots or for admins'
+    assert lines[1] == 'profile is only allowed in #bots or for admins'
+    assert lines[2].startswith('Dumped ')
+    # Dumps are rate limited, wherever they come from
+    assert lines[3].startswith('Events were dumped 0s ago')
+    assert len(list(tmp_path.iterdir())) == 1
+
+def test_puppet_dry_run_send(puppet):
+    """Test a dry run puppet builds and counts its lines without a socket"""
+    puppet.data = StatsData()
+    puppet.flood = None
+    mock_connection = puppet.connection
+    puppet.connection = DryRunConnection(irc.client.Reactor(), 'testPuppet[puppet]_d2',
+                                         puppet.data)
+
+    puppet.do_send(PuppetCommand('send', 1, data='hello there', channel='1'))
+    puppet.connection.nick('renamed_d2')
+
+    assert puppet.data.counters()[('dry_run_sends', 'irc')] == 2
+    assert puppet.connection.get_nickname() == 'renamed_d2'
+    assert puppet.connection.bytes_out == len(b'PRIVMSG #test1 :hello there\r\n') + \
+        len(b'NICK renamed_d2\r\n')
+    puppet.connection = mock_connection
@@ -0,0 +1,73 @@
+"""
+This file is part of CatPuppetBridge.
+
+CatPuppetBridge is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+CatPuppetBridge is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+CatPuppetBridge. If not, see <https://www.gnu.org/licenses/>.
+
+Copyright (C) 2025 Lisa Marie Maginnis
+"""
+
+import logging
+import queue
+
+from modules.log_pipeline import DeferredQueueHandler, LogPipeline, SamplingFilter
+
+def make_record(level=logging.DEBUG, lineno=10, created=100.0):
+    """Build a log record from a fixed call site"""
+    record = logging.LogRecord('unittest', level, 'test.py', lineno, 'line %s', ('x',), None)
+    record.created = created
+    return record
+
+def test_sampling_filter_limits_debug_sites():
+    """Test a hot debug site is rate limited while other records pass"""
+    sampler = SamplingFilter(rate=10, burst=5)
+    passed = [sampler.filter(make_record()) for _ in range(20)]
+
+    assert passed.count(True) == 5
+    assert sampler.suppressed == 15
+    assert sampler.filter(make_record(lineno=11))
+    assert sampler.filter(make_record(level=logging.INFO))
+    # Tokens refill with time
+    assert sampler.filter(make_record(created=101.0))
+
+def test_queue_handler_drops_when_full():
+    """Test a full log queue drops records instead of blocking"""
+    handler = DeferredQueueHandler(queue.Queue(2))
+    for _ in range(5):
+        handler.handle(make_record(level=logging.INFO))
+
+    assert handler.dropped == 3
+    # Formatting is left to the writer thread
+    assert handler.queue.get_nowait().msg == 'line %s'
+
+def test_log_pipeline_writes_from_thread():
+    """Test records reach the original handlers through the writer thread"""
+    root = logging.getLogger()
+    saved = list(root.handlers)
+    records = []
+    target = logging.Handler()
+    target.emit = records.append
+    for handler in saved:
+        root.removeHandler(handler)
+    root.addHandler(target)
+    pipeline = LogPipeline()
+    try:
+        pipeline.start()
+        logging.getLogger('unittest').warning('relay %s', 'stalled')
+        pipeline.stop()
+    finally:
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        for handler in saved:
+            root.addHandler(handler)
+
+    assert [record.getMessage() for record in records] == ['relay stalled']
@@ -0,0 +1,150 @@
+"""
+This file is part of CatPuppetBridge.
+
+CatPuppetBridge is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+CatPuppetBridge is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+CatPuppetBridge. If not, see <https://www.gnu.org/licenses/>.
+
+Copyright (C) 2025 Lisa Marie Maginnis
+"""
+
+import threading
+import urllib.request
+from unittest.mock import patch
+
+from modules.metrics_server import render_metrics, start_metrics_server
+from modules.stats_data import StatsData, histogram_percentile
+from modules.tracing import record_trace, start_trace, mark
+from modules.flight_recorder import FlightRecorder
+
+def test_render_counters_with_labels():
+    """Test labelled counters are rendered, hiding the unlabelled total"""
+    data = StatsData()
+    data.increment('irc_messages')
+    data.increment('irc_messages')
+    data.increment(('irc_messages', '#test1'))
+    data.increment(('irc_messages', '#test2'))
+    data.update('total_puppets', 3)
+    text = render_metrics(data)
+
+    assert '# TYPE catpuppetbridge_irc_messages_total counter' in text
+    assert 'catpuppetbridge_irc_messages_total{channel="#test1"} 1' in text
+    assert 'catpuppetbridge_irc_messages_total 2' not in text
+    assert 'catpuppetbridge_total_puppets 3' in text
+
+def test_render_gauges_and_histograms():
+    """Test gauge callbacks and histograms are rendered"""
+    data = StatsData()
+    data.register_gauge(('queue_depth', 'puppet_queue'), lambda: 7)
+    data.observe(('delivery_latency', 'irc_to_discord'), 0.02)
+    data.observe(('delivery_latency', 'irc_to_discord'), 3)
+    text = render_metrics(data)
+
+    assert 'catpuppetbridge_queue_depth{queue="puppet_queue"} 7' in text
+    assert ('catpuppetbridge_delivery_latency_seconds_bucket'
+            '{direction="irc_to_discord",le="0.025"} 1') in text
+    assert ('catpuppetbridge_delivery_latency_seconds_bucket'
+            '{direction="irc_to_discord",le="+Inf"} 2') in text
+    assert 'catpuppetbridge_delivery_latency_seconds_count{direction="irc_to_discord"} 2' in text
+
+def test_metrics_server_scrape():
+    """Test the metrics endpoint serves the rendered metrics"""
+    data = StatsData()
+    data.increment('webhook_rate_limits')
+    server = start_metrics_server(data, '127.0.0.1:0')
+    try:
+        port = server.server_address[1]
+        with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics', timeout=5) as response:
+            body = response.read().decode('utf8')
+    finally:
+        server.shutdown()
+
+    assert 'catpuppetbridge_webhook_rate_limits_total 1' in body
+
+def test_histogram_percentile():
+    """Test percentiles are interpolated within the bucket they fall in"""
+    data = StatsData()
+    assert histogram_percentile([0] * 15, 0.5) is None
+    for _ in range(10):
+        data.observe('delivery_latency', 0.003)
+    histogram = data.histogram_snapshot()['delivery_latency']
+
+    assert 0.001 < histogram_percentile(histogram, 0.5) <= 0.005
+    assert histogram_percentile(histogram, 0.99) <= 0.005
+
+def test_record_trace_stage_labels():
+    """Test a trace is recorded per stage, and rendered with both labels"""
+    data = StatsData()
+    trace = [('ingress', 100.0), ('filters', 100.001), ('puppet_queue', 100.2)]
+    record_trace(data, 'discord_to_irc', trace)
+    histograms = data.histogram_snapshot()
+    text = render_metrics(data)
+
+    assert histograms[('stage_latency', 'discord_to_irc', 'puppet_queue')][-1] > 0.19
+    assert histograms[('delivery_latency', 'discord_to_irc')][-1] > 0.19
+    assert ('catpuppetbridge_stage_latency_seconds_count'
+            '{direction="discord_to_irc",stage="filters"} 1') in text
+
+def test_stats_shards_summed():
+    """Test counters and histograms written from many threads are all counted"""
+    data = StatsData()
+    data.update('uptime', 5)
+
+    def work():
+        for _ in range(1000):
+            data.increment('irc_messages')
+        data.observe('delivery_latency', 0.02)
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    data.increment('irc_messages')
+
+    assert data.snapshot()['irc_messages'] == 8001
+    assert data.snapshot()['uptime'] == 5
+    assert sum(data.histogram_snapshot()['delivery_latency'][:-1]) == 8
+    # Shards of the exited threads are folded into the shared totals
+    assert len(data.shards) == 1
+
+def test_stats_rates():
+    """Test rate meters tick lazily and decay once counting stops"""
+    data = StatsData(meter_tick=1000.0)
+    for _ in range(300):
+        data.increment('discord_messages')
+    one_minute, five_minutes, fifteen_minutes = data.rates(now=1060.0)['discord_messages']
+    assert 5 * 0.6 < one_minute < 5
+    assert fifteen_minutes < five_minutes < one_minute
+
+    later = data.rates(now=1660.0)['discord_messages']
+    assert later[0] < 0.01
+    assert later[2] > later[0]
+    assert 'catpuppetbridge_discord_messages_rate{window="15m"}' in render_metrics(data)
+
+def test_flight_recorder_follows_trace(tmp_path):
+    """Test a traced message can be followed through the flight recorder"""
+    recorder = FlightRecorder(size=5)
+    with patch('modules.tracing.recorder', recorder):
+        trace = start_trace('irc', '#test1', 'alice')
+        mark(trace, 'queue')
+        mark(trace, 'discord_send')
+        record_trace(StatsData(), 'irc_to_discord', trace)
+    for i in range(3):
+        recorder.record('queue_drop', i)
+
+    lines = recorder.lines()
+    assert len(lines) == 5
+    assert lines[0].endswith(f' discord_send {trace[0][2]}')
+    assert f' delivered {trace[0][2]} irc_to_discord ' in lines[1]
+    path = recorder.dump(str(tmp_path))
+    with open(path, encoding='utf8') as events:
+        assert events.read().splitlines() == lines
@@ -0,0 +1,91 @@
+"""
+This file is part of CatPuppetBridge.
+
+CatPuppetBridge is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+CatPuppetBridge is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+CatPuppetBridge. If not, see <https://www.gnu.org/licenses/>.
+
+Copyright (C) 2025 Lisa Marie Maginnis
+"""
+
+import threading
+import time
+import logging
+from unittest.mock import MagicMock
+
+from modules.irc_bridge import IRCBot
+from modules.profiler import SamplingProfiler, frame_label
+
+def busy_loop(stop):
+    """Spin until told to stop"""
+    while not stop.is_set():
+        sum(range(100))
+
+def test_profiler_samples_busy_thread(tmp_path):
+    """Test the profiler finds a busy thread and writes collapsed stacks"""
+    stop = threading.Event()
+    worker = threading.Thread(target=busy_loop, args=[stop], name='busy')
+    worker.start()
+    profiler = SamplingProfiler(interval=0.001)
+    profiler.start()
+    time.sleep(0.2)
+    profiler.stop()
+    stop.set()
+    worker.join()
+
+    assert profiler.samples > 0
+    assert any('busy_loop' in label for label, _, _ in profiler.top_functions())
+    path = profiler.write_collapsed(str(tmp_path))
+    with open(path, encoding='utf8') as collapsed:
+        assert any(line.startswith('busy;') for line in collapsed)
+
+def test_profiler_idle_without_qualnames():
+    """Test idle threads are skipped whether frames are labelled by qualname or plain name"""
+    frame = MagicMock()
+    frame.f_code = MagicMock(spec=['co_filename', 'co_name'], co_filename='/usr/lib/threading.py',
+                             co_name='wait')
+    # Python 3.10 has no co_qualname
+    assert frame_label(frame) == ('threading.py', 'wait')
+
+    profiler = SamplingProfiler()
+    work = ('bridge.py', 'relay')
+    profiler.stacks[('old', (work, ('threading.py', 'wait')))] = 5
+    profiler.stacks[('new', (work, ('threading.py', 'Condition.wait')))] = 5
+    profiler.stacks[('poll', (work, ('selectors.py', 'EpollSelector.select')))] = 5
+    profiler.stacks[('busy', (work,))] = 2
+
+    assert profiler.top_functions() == [('bridge.py:relay', 2, 2)]
+
+def test_bot_profile_command(tmp_path):
+    """Test a timed profile replies with the top functions when it finishes"""
+    bot = IRCBot.__new__(IRCBot)
+    bot.connection = MagicMock()
+    bot.reactor = MagicMock()
+    bot.log = logging.getLogger('unittest')
+    bot.profiler = SamplingProfiler(interval=0.001)
+    bot.profile_directory = str(tmp_path)
+    event = MagicMock(type='pubmsg', target='#bots')
+    event.source.nick = 'admin'
+    bot.channel = '#bots'
+
+    bot.do_command(event, 'profile 30')
+    assert bot.profiler.running
+    bot.do_command(event, 'profile start')
+    time.sleep(0.05)
+    # The scheduled stop finishes the profile
+    bot.reactor.scheduler.execute_after.call_args.args[1]()
+
+    assert not bot.profiler.running
+    lines = [call.args[1] for call in bot.connection.privmsg.call_args_list]
+    assert lines[0] == 'Profiling for 30s'
+    assert lines[1].startswith('Profiler is already running')
+    assert lines[2].startswith('Profiled ')
+    assert len(list(tmp_path.iterdir())) == 1
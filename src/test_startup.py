@@ -0,0 +1,36 @@
+"""
+This file is part of CatPuppetBridge.
+
+CatPuppetBridge is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+CatPuppetBridge is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+CatPuppetBridge. If not, see <https://www.gnu.org/licenses/>.
+
+Copyright (C) 2025 Lisa Marie Maginnis
+"""
+
+from modules.startup import StartupTimer
+from modules.stats_data import StatsData
+
+def test_startup_stages():
+    """Test stages are only timed the first time, and exported once stats start"""
+    timer = StartupTimer()
+    timer.mark('import')
+    stats = StatsData()
+    timer.start(stats)
+    timer.mark('config')
+    timer.mark('import')
+
+    assert list(timer.stages) == ['import', 'config']
+    assert ('startup_seconds', 'import') in stats.snapshot()
+    assert ('startup_seconds', 'config') in stats.snapshot()
+    report = timer.report()
+    assert report[0].startswith('import: ')
+    assert report[-1].startswith('Waiting for: discord_import')
@@ -0,0 +1,92 @@
+"""
+This file is part of CatPuppetBridge.
+
+CatPuppetBridge is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+CatPuppetBridge is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+CatPuppetBridge. If not, see <https://www.gnu.org/licenses/>.
+
+Copyright (C) 2025 Lisa Marie Maginnis
+"""
+
+import threading
+import time
+
+from modules.bridge_queue import BridgeQueue
+from modules.stats_data import StatsData
+from modules.thread_stats import ThreadAccounting, accounting
+
+def busy_loop(stop):
+    """Spin until told to stop"""
+    while not stop.is_set():
+        sum(range(100))
+
+def busy_for(cpu_seconds, used, stop):
+    """Spin until this thread has used cpu_seconds, then until told to stop"""
+    started = time.thread_time()
+    while time.thread_time() - started < cpu_seconds:
+        sum(range(100))
+    used.set()
+    busy_loop(stop)
+
+def test_thread_accounting_cpu():
+    """Test CPU time is attributed to named threads and grouped for metrics"""
+    data = StatsData()
+    tracker = ThreadAccounting()
+    tracker.stats = data
+    used = threading.Event()
+    stop = threading.Event()
+    tracker.sample()
+    # Wait on CPU time used rather than wall time, however contended the CPU is
+    worker = threading.Thread(target=busy_for, args=[0.1, used, stop], name='puppet:busy_d2')
+    worker.start()
+    used.wait()
+    tracker.sample()
+    top = tracker.top(1)
+    stop.set()
+    worker.join()
+
+    assert top[0][0] == 'puppet:busy_d2'
+    assert top[0][1] > 0
+    # The OS counts thread CPU time in clock ticks, so allow for rounding down
+    assert data.snapshot()[('thread_cpu', 'puppet')] > 0.05
+
+def test_queue_wait_accounting():
+    """Test time blocked on a bridge queue is counted for the waiting thread"""
+    q = BridgeQueue(name='test')
+    threading.Timer(0.1, q.put, args=[1]).start()
+
+    def consumer():
+        q.get()
+
+    thread = threading.Thread(target=consumer, name='puppet-inbox:waiting_d2')
+    thread.start()
+    thread.join()
+
+    assert accounting.wait_seconds('puppet-inbox:waiting_d2') >= 0.09
+
+def test_exited_thread_waits_folded():
+    """Test waits of threads which exited are kept in their group, not by name"""
+    data = StatsData()
+    tracker = ThreadAccounting()
+    tracker.stats = data
+    threads = [threading.Thread(target=tracker.add_wait, args=[0.5], name=f'puppet:gone{i}_d2')
+               for i in range(3)]
+    for thread in threads:
+        thread.start()
+        thread.join()
+    tracker.add_wait(0.25)
+
+    tracker.sample()
+    tracker.sample()
+
+    assert list(tracker.waits) == [threading.current_thread()]
+    assert data.snapshot()[('queue_wait', 'puppet')] == 1.5
+    assert data.snapshot()[('queue_wait', threading.current_thread().name)] == 0.25
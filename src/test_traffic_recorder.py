@@ -0,0 +1,90 @@
+"""
+This file is part of CatPuppetBridge.
+
+CatPuppetBridge is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+CatPuppetBridge is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+CatPuppetBridge. If not, see <https://www.gnu.org/licenses/>.
+
+Copyright (C) 2025 Lisa Marie Maginnis
+"""
+
+import queue
+import random
+import time
+
+from modules.traffic_recorder import (TrafficRecorder, message_shape, read_recording,
+                                      shaped_text)
+
+def test_message_shape():
+    """Test text is reduced to its length and counts of what affects processing"""
+    assert message_shape("hi <@123> :cat: 猫\nbye") == [21, 1, 1, 1, 2]
+
+def test_shaped_text_matches_shape():
+    """Test made up text has the recorded shape"""
+    shape = [120, 16, 2, 1, 1]
+    text = shaped_text(shape, random.Random(1))
+
+    assert len(text) == 120
+    assert message_shape(text)[1:] == shape[1:]
+
+def test_record_is_noop_until_started():
+    """Test recording does nothing unless a recording was started"""
+    traffic = TrafficRecorder()
+    traffic.record('irc_msg', user='alice', channel='#cats', text='hello')
+
+    assert not traffic.enabled
+
+def test_recording_is_anonymised(tmp_path):
+    """Test users, channels and text never reach the recording"""
+    path = str(tmp_path / 'traffic.jsonl.gz')
+    traffic = TrafficRecorder()
+    traffic.start(path)
+    traffic.record('irc_msg', user='alice', channel='#cats', text='my secret plans')
+    traffic.record('discord_msg', user=1234, channel='#cats', text='hi', dm=False)
+    traffic.stop()
+
+    header, irc_msg, discord_msg = read_recording(path)
+    assert header['v'] == 1
+    assert irc_msg['k'] == 'irc_msg'
+    assert irc_msg['user'] != 'alice' and len(irc_msg['user']) == 12
+    assert irc_msg['s'] == [15, 0, 0, 0, 1]
+    assert 'text' not in irc_msg
+    # The same channel hashes the same within a recording
+    assert discord_msg['channel'] == irc_msg['channel']
+    assert discord_msg['dm'] is False
+    assert discord_msg['t'] >= irc_msg['t']
+
+def test_read_truncated_recording(tmp_path):
+    """Test a gzipped recording that was never closed is read up to its last flush"""
+    path = str(tmp_path / 'traffic.jsonl.gz')
+    traffic = TrafficRecorder()
+    traffic.start(path)
+    for _ in range(3):
+        traffic.record('irc_msg', user='alice', channel='#cats', text='hello')
+    # Wait for the writer to flush, without closing the file
+    while traffic.written < 3 or not traffic.queue.empty():
+        time.sleep(0.01)
+    time.sleep(0.05)
+
+    records = read_recording(path)
+    traffic.stop()
+    assert [record.get('k') for record in records] == [None, 'irc_msg', 'irc_msg', 'irc_msg']
+
+def test_record_queue_is_bounded():
+    """Test records beyond the queue bound are dropped and counted"""
+    traffic = TrafficRecorder()
+    traffic.max_queued = 2
+    traffic.queue = queue.Queue(traffic.max_queued)
+    for _ in range(5):
+        traffic.record('irc_msg', user='alice', channel='#cats', text='hello')
+
+    assert traffic.queue.qsize() == 2
+    assert traffic.dropped == 3
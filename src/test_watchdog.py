@@ -0,0 +1,113 @@
+"""
+This file is part of CatPuppetBridge.
+
+CatPuppetBridge is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+CatPuppetBridge is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+CatPuppetBridge. If not, see <https://www.gnu.org/licenses/>.
+
+Copyright (C) 2025 Lisa Marie Maginnis
+"""
+
+import asyncio
+import socket
+import threading
+import time
+from unittest.mock import MagicMock
+
+import pytest
+
+from modules.stats_data import StatsData
+from modules.watchdog import Watchdog, sd_notify
+
+def test_watchdog_stall_dumps_stack(caplog):
+    """Test a loop which stops beating is reported once, with its stack"""
+    watchdog = Watchdog()
+    watchdog.stats = StatsData()
+    watchdog.threshold = 0.05
+    release = threading.Event()
+
+    def stuck_loop():
+        watchdog.beat('puppet:stuck_d2', interval=0.01)
+        release.wait()
+
+    thread = threading.Thread(target=stuck_loop)
+    thread.start()
+    watchdog.beat('listener', interval=10)
+    time.sleep(0.1)
+    lag = watchdog.check()
+    watchdog.check()
+    release.set()
+    thread.join()
+
+    assert lag['puppet'] > 0.05
+    assert lag['listener'] < 0.05
+    assert watchdog.stalled() == ['puppet:stuck_d2']
+    assert 'stuck_loop' in caplog.text
+    assert caplog.text.count('puppet:stuck_d2 is') == 1
+    assert watchdog.stats.snapshot()[('watchdog_stalls', 'puppet')] == 1
+    assert watchdog.stats.snapshot()[('loop_lag', 'puppet')] > 0.05
+    assert watchdog.stats.snapshot()[('stalled_loops', 'puppet')] == 1
+    assert watchdog.stats.snapshot()[('stalled_loops', 'listener')] == 0
+
+def test_watchdog_health_ignores_puppets():
+    """Test only a stalled core loop stops the systemd watchdog being petted"""
+    watchdog = Watchdog()
+    watchdog.threshold = 0.05
+    # eg/ a puppet sleeping before reconnecting, or one whose thread died
+    watchdog.beat('puppet:asleep_d2', interval=0.01)
+    watchdog.beat('listener', interval=10)
+    time.sleep(0.1)
+    watchdog.check()
+    assert watchdog.healthy()
+    assert watchdog.stalled() == ['puppet:asleep_d2']
+
+    watchdog.beat('bot', interval=0.01)
+    time.sleep(0.1)
+    watchdog.check()
+    assert not watchdog.healthy()
+    assert watchdog.stalled() == ['bot', 'puppet:asleep_d2']
+
+@pytest.mark.asyncio
+async def test_watchdog_loop_lag():
+    """Test blocking the event loop shows up as lag"""
+    watchdog = Watchdog()
+    watchdog.interval = 0.01
+    task = asyncio.create_task(watchdog.watch_loop('discord'))
+    await asyncio.sleep(0.02)
+    time.sleep(0.1)
+    await asyncio.sleep(0.02)
+    task.cancel()
+
+    assert 0.05 < watchdog.check()['discord'] < 0.5
+    assert watchdog.check()['discord'] < 0.05
+
+def test_watchdog_reactor_beats():
+    """Test reactors beat from their scheduler"""
+    watchdog = Watchdog()
+    reactor = MagicMock()
+    watchdog.watch_reactor('bot', reactor)
+    beat = reactor.scheduler.execute_every.call_args.args[1]
+    beat()
+
+    assert 'bot' in watchdog.heartbeats
+    watchdog.forget('bot')
+    assert watchdog.check() == {}
+
+def test_sd_notify(tmp_path, monkeypatch):
+    """Test systemd notifications are sent to NOTIFY_SOCKET"""
+    path = str(tmp_path / 'notify')
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as server:
+        server.bind(path)
+        monkeypatch.setenv('NOTIFY_SOCKET', path)
+        assert sd_notify('WATCHDOG=1')
+        assert server.recv(64) == b'WATCHDOG=1'
+    monkeypatch.delenv('NOTIFY_SOCKET')
+    assert not sd_notify('WATCHDOG=1')
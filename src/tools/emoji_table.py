@@ -0,0 +1,46 @@
+"""
+This file is part of CatPuppetBridge.
+
+CatPuppetBridge is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+CatPuppetBridge is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+CatPuppetBridge. If not, see <https://www.gnu.org/licenses/>.
+
+Copyright (C) 2025 Lisa Marie Maginnis
+
+Rebuild modules/emoji_shortcodes.txt from the emoji package, a dev requirement
+"""
+
+from emoji import EMOJI_DATA, STATUS
+
+from modules.emoji_table import SHORTCODE_RE, SHORTCODES_FILE
+
+def build_shortcodes() -> dict:
+    """ Compute the table with the emoji package, as emojize() looks names up """
+    names = {}
+    aliases = {}
+    for emoji, data in EMOJI_DATA.items():
+        if data['status'] > STATUS['fully_qualified']:
+            continue
+        names.setdefault(data['en'].strip(':'), emoji)
+        for alias in data.get('alias', []):
+            aliases.setdefault(alias.strip(':'), emoji)
+    # Aliases are looked up before English names
+    names.update(aliases)
+    return {name: emoji for name, emoji in names.items() if SHORTCODE_RE.fullmatch(name)}
+
+def write_shortcodes(path: str = SHORTCODES_FILE):
+    """ Write the table, one 'shortcode emoji' per line """
+    with open(path, 'w', encoding='utf8') as table:
+        for name, emoji in sorted(build_shortcodes().items()):
+            table.write(f'{name} {emoji}\n')
+
+if __name__ == '__main__':
+    write_shortcodes()